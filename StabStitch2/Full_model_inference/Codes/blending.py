@@ -0,0 +1,100 @@
+# coding: utf-8
+import torch
+import torch.nn.functional as F
+from device_utils import cached_constant
+
+
+# gaussian blur of the blending weights in linear_blender
+BLUR_KERNEL_SIZE = 21
+BLUR_SIGMA = 20
+
+
+# normalized 1D gaussian, the same taps as torchvision's GaussianBlur (cached per device)
+def get_gaussian_kernel1d(kernel_size, sigma, device=None):
+
+    def _build():
+        ksize_half = (kernel_size - 1) * 0.5
+        x = torch.linspace(-ksize_half, ksize_half, steps=kernel_size)
+        pdf = torch.exp(-0.5 * (x / sigma).pow(2))
+        return pdf / pdf.sum()
+
+    return cached_constant(('gaussian_kernel1d', kernel_size, float(sigma)), device, _build)
+
+# separable gaussian blur with reflect padding: two 1D passes instead of one k x k convolution
+# each pass is a weighted sum of k shifted views, which is much faster than a single-channel conv2d on cpu
+# img: bs, c, h, w
+def gaussian_blur(img, kernel_size=21, sigma=20):
+    bs, c, h, w = img.size()
+    kernel = get_gaussian_kernel1d(kernel_size, sigma, img.device).tolist()
+    pad = kernel_size // 2
+
+    x = F.pad(img, [pad, pad, pad, pad], mode='reflect')
+    out = x[..., 0:w] * kernel[0]
+    for i in range(1, kernel_size):
+        out = out.add_(x[..., i:i+w], alpha=kernel[i])
+    x = out
+    out = x[..., 0:h, :] * kernel[0]
+    for i in range(1, kernel_size):
+        out = out.add_(x[..., i:i+h, :], alpha=kernel[i])
+
+    return out
+
+
+# centroid (row, col) of the nonzero pixels of each mask, mask: bs, h, w -> two [bs] tensors
+# pixels are counted per row/column (exact in float32), only these short sums are done in float64
+def mask_centroid(mask):
+    bs, h, w = mask.size()
+    nonzero = (mask != 0).float()
+    row_count = nonzero.sum(2).double()
+    col_count = nonzero.sum(1).double()
+    rows = torch.arange(h, dtype=torch.float64, device=mask.device)
+    cols = torch.arange(w, dtype=torch.float64, device=mask.device)
+
+    count = row_count.sum(1).clamp(min=1)
+    center_r = (row_count * rows).sum(1) / count
+    center_c = (col_count * cols).sum(1) / count
+
+    return center_r.float(), center_c.float()
+
+
+def linear_blender(ref, tgt, ref_m, tgt_m, mask=False, centers=None):
+    """
+    Linear blending of two warped images along the direction between their centroids.
+    ref, tgt: bs, 3, h, w warped images
+    ref_m, tgt_m: bs, 1, h, w warped masks
+    Every sample of the batch is blended with its own centroids and overlap; the overlap
+    weights are computed with masked reductions instead of torch.nonzero.
+    mask: return the blending weight of ref instead of the blended image
+    centers: optional (center1_r, center1_c, center2_r, center2_c) [bs] tensors, the mask
+        centroids in the pixel coordinates of the inputs. Given when the inputs are crops of
+        larger images, whose masks do not lie entirely inside the crop.
+    """
+    bs, _, h, w = ref_m.size()
+
+    if centers is None:
+        center1_r, center1_c = mask_centroid(ref_m[:, 0])
+        center2_r, center2_c = mask_centroid(tgt_m[:, 0])
+    else:
+        center1_r, center1_c, center2_r, center2_c = centers
+    vec_r = (center2_r - center1_r).reshape(bs, 1, 1, 1)
+    vec_c = (center2_c - center1_c).reshape(bs, 1, 1, 1)
+
+    ovl = (ref_m * tgt_m).round()[:, 0].unsqueeze(1)
+    ref_m_ = ref_m[:, 0].unsqueeze(1) - ovl
+    ovl_bool = ovl.bool()
+
+    # projection of the pixels on the centroid direction, normalized to 0 ~ 1 over the overlap
+    rows = torch.arange(h, dtype=ref_m.dtype, device=ref_m.device).reshape(1, 1, h, 1)
+    cols = torch.arange(w, dtype=ref_m.dtype, device=ref_m.device).reshape(1, 1, 1, w)
+    proj_val = (rows - center1_r.reshape(bs, 1, 1, 1)) * vec_r + (cols - center1_c.reshape(bs, 1, 1, 1)) * vec_c
+    proj_min = proj_val.masked_fill(~ovl_bool, float('inf')).amin(dim=(1, 2, 3), keepdim=True)
+    proj_max = proj_val.masked_fill(~ovl_bool, float('-inf')).amax(dim=(1, 2, 3), keepdim=True)
+    ovl_mask = torch.where(ovl_bool, (proj_val - proj_min) / (proj_max - proj_min + 1e-3), torch.zeros_like(proj_val))
+
+    mask1 = (gaussian_blur(ref_m_ + (1-ovl_mask)*ref_m[:,0].unsqueeze(1), BLUR_KERNEL_SIZE, BLUR_SIGMA) * ref_m + ref_m_).clamp(0,1)
+    if mask: return mask1
+
+    mask2 = (1-mask1) * tgt_m
+    stit = ref * mask1 + tgt * mask2
+
+    return stit
@@ -0,0 +1,47 @@
+# coding: utf-8
+import torch
+
+
+
+# resolve the execution device: an explicit device ('cpu', 'cuda', 'cuda:1', ...) or cuda if available
+def get_device(device=None):
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    device = torch.device(device)
+    # 'cuda' and 'cuda:0' must share the same constants
+    if device.type == 'cuda' and device.index is None:
+        device = torch.device('cuda', torch.cuda.current_device())
+
+    return device
+
+# the device the parameters of a network live on
+def module_device(net):
+    return next(net.parameters()).device
+
+
+# intra-op / inter-op thread pools for the cpu path
+# num_threads <= 0 keeps the torch default (one thread per physical core)
+def set_num_threads(num_threads=0, num_interop_threads=0):
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads > 0:
+        # can only be set once, before any inter-op parallel work has started
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            pass
+
+    return torch.get_num_threads()
+
+
+# constant tensors created once per (key, device) and reused on every call
+# build_fn() returns the tensor (on any device); callers must not modify the result in place
+_constant_cache = {}
+
+def cached_constant(key, device, build_fn):
+    device = get_device(device)
+    cache_key = (key, device)
+    if cache_key not in _constant_cache:
+        _constant_cache[cache_key] = build_fn().to(device)
+
+    return _constant_cache[cache_key]
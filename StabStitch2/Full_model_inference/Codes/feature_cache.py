@@ -0,0 +1,130 @@
+import torch
+from collections import OrderedDict
+from spatial_network import build_SpatialNet_batch
+from temporal_network import build_TemporalNet_batch
+from device_utils import module_device
+
+
+
+# check whether two stage1 extractors compute the same features (same architecture and weights)
+def stems_match(stem1, stem2):
+    state1 = stem1.state_dict()
+    state2 = stem2.state_dict()
+    if state1.keys() != state2.keys():
+        return False
+    for key in state1:
+        if state1[key].shape != state2[key].shape or not torch.equal(state1[key], state2[key].to(state1[key].device)):
+            return False
+
+    return True
+
+
+
+class FeatureCache(object):
+    """
+    Per-frame cache of the ResNet18 stage1 features (conv1..layer2), keyed by (view, frame index).
+
+    SpatialNet and TemporalNet both run their stage1 extractor on the same 360x480 frames.
+    If the two checkpoints have identical stems, the features computed for SpatialNet are
+    served to TemporalNet (and vice versa). Otherwise the entries are kept per network, which
+    still saves TemporalNet from recomputing the previous frame.
+
+    window: number of frames per view that have to stay cached (the temporal window)
+    view_num: number of views
+    device: where the inputs are moved to, defaults to the device of the networks
+    The entries of the oldest frames are evicted beyond window*view_num features per network,
+    so with window = chunk_size + 1 the last frame of a chunk of estimate_motion() stays
+    cached until TemporalNet reads it with the next chunk, whatever the order of the views.
+    """
+
+    def __init__(self, spatial_net, temporal_net, window=2, view_num=2, device=None):
+        self.device = module_device(spatial_net) if device is None else device
+        self.extractors = {'spatial': spatial_net.feature_extractor_stage1, 'temporal': temporal_net.feature_extractor_stage1}
+        self.shared = stems_match(self.extractors['spatial'], self.extractors['temporal'])
+        self.capacity = window * view_num * (1 if self.shared else 2)
+
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.
+
+    def clear(self):
+        self.cache.clear()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, net, view, index_list, img_tensor_list):
+        """
+        Return the stage1 features of the frames `index_list` of `view`, concatenated along the batch dimension.
+        net: 'spatial' or 'temporal', the network asking for the features
+        img_tensor_list: the input tensors of these frames, [bs, 3, H, W] each
+        Only the missing frames go through the extractor, in one stacked pass.
+        """
+        owner = 'shared' if self.shared else net
+        key_list = [(owner, view, index) for index in index_list]
+
+        feature_dict = {}
+        missing = []
+        for i, key in enumerate(key_list):
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                feature_dict[key] = self.cache[key]
+                self.hits += 1
+            else:
+                missing.append(i)
+                self.misses += 1
+
+        if len(missing) > 0:
+            img_tensor = torch.cat([img_tensor_list[i] for i in missing], 0).to(self.device, non_blocking=True)
+            feature = self.extractors[net](img_tensor)
+            for i, f in zip(missing, torch.split(feature, img_tensor_list[missing[0]].size()[0], 0)):
+                feature_dict[key_list[i]] = f
+                self.cache[key_list[i]] = f
+
+        while len(self.cache) > self.capacity:
+            # the least recently used entry among those of the oldest frame
+            del self.cache[min(self.cache, key=lambda key: key[2])]
+
+        return torch.cat([feature_dict[key] for key in key_list], 0)
+
+
+
+# spatial and temporal motion estimation over a clip, chunk_size frames at a time
+# interleaving both networks per chunk keeps the shared stage1 features in a window-sized cache
+def estimate_motion(spatial_net, temporal_net, img1_tensor_list, img2_tensor_list, chunk_size=8, feature_cache=None, device=None):
+    frame_num = len(img1_tensor_list)
+    batch_size = img1_tensor_list[0].size()[0]
+
+    smotion_list1 = []
+    smotion_list2 = []
+    tmotion_list1 = []
+    tmotion_list2 = []
+    for start in range(0, frame_num, chunk_size):
+        end = min(start + chunk_size, frame_num)
+
+        # step 1: spatial warp
+        spatial_batch_out = build_SpatialNet_batch(spatial_net, img1_tensor_list[start:end], img2_tensor_list[start:end], chunk_size, feature_cache, start, device)
+        smotion_list1.extend(torch.split(spatial_batch_out['motion1'], batch_size, 0))
+        smotion_list2.extend(torch.split(spatial_batch_out['motion2'], batch_size, 0))
+
+        # step 2: temporal warp (the previous frame is included for the motion across the chunk boundary)
+        t_start = max(start - 1, 0)
+        temporal_batch_out = build_TemporalNet_batch(temporal_net, [img1_tensor_list[t_start:end], img2_tensor_list[t_start:end]], end - t_start, feature_cache, t_start, device)
+        motion_list1, motion_list2 = temporal_batch_out['motion_lists']
+        if start > 0:
+            # drop the zero motion inserted for the first frame of the chunk
+            motion_list1 = motion_list1[1:]
+            motion_list2 = motion_list2[1:]
+        tmotion_list1.extend(motion_list1)
+        tmotion_list2.extend(motion_list2)
+
+    out_dict = {}
+    out_dict.update(smotion_list1 = smotion_list1, smotion_list2 = smotion_list2, tmotion_list1 = tmotion_list1, tmotion_list2 = tmotion_list2)
+
+    return out_dict
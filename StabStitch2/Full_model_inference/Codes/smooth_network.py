@@ -13,6 +13,7 @@ import torchvision.transforms as T
 import random
 from torch import nn, einsum
 from einops import rearrange
+from geometry import get_rigid_mesh, get_norm_mesh, get_norm_rigid_mesh, recover_mesh
 
 import grid_res
 grid_h = grid_res.GRID_H
@@ -42,6 +43,188 @@ def build_SmoothNet(net, tsmotion_list1, tsmotion_list2, smesh_list1, smesh_list
 
 
 
+# convert the motions of a whole clip into SmoothNet inputs in one batched pass
+# smotion1/2, tmotion1/2: T, h, w, 2 (spatial / temporal motions of the frames, stacked along dim 0)
+# smesh_k = rigid + smotion_k, and tsmotion_k is the (k-1)-th smesh warped by the k-th temporal
+# mesh minus smesh_k (tsmotion_0 = 0); both views share one TPS solve of 2*(T-1) meshes
+# return smesh1, smesh2, tsmotion1, tsmotion2: T, h, w, 2
+def get_tsmotion_clip(smotion1, smotion2, tmotion1, tmotion2, img_h, img_w):
+    frame_num = smotion1.size()[0]
+
+    rigid_mesh = get_rigid_mesh(1, img_h, img_w, smotion1.device)
+    smesh = rigid_mesh + torch.cat([smotion1, smotion2], 0)   # 2T, h, w, 2
+    tsmotion = torch.zeros_like(smesh)
+
+    if frame_num > 1:
+        norm_rigid_mesh = get_norm_rigid_mesh(1, img_h, img_w, smotion1.device)
+        tps_solver = torch_tps_transform_point.get_point_solver(norm_rigid_mesh)
+
+        tmesh = rigid_mesh + torch.cat([tmotion1[1:], tmotion2[1:]], 0)   # 2(T-1), h, w, 2
+        smesh_1 = torch.cat([smesh[0:frame_num-1], smesh[frame_num:-1]], 0)
+        norm_tmesh = get_norm_mesh(tmesh, img_h, img_w)
+        norm_smesh_1 = get_norm_mesh(smesh_1, img_h, img_w)
+        tsmesh = tps_solver(norm_tmesh, norm_smesh_1)   # 2(T-1), pn, 2
+
+        tsmesh = recover_mesh(tsmesh, img_h, img_w)
+        tsmotion[1:frame_num] = tsmesh[0:frame_num-1] - smesh[1:frame_num]
+        tsmotion[frame_num+1:] = tsmesh[frame_num-1:] - smesh[frame_num+1:]
+
+    return smesh[0:frame_num], smesh[frame_num:], tsmotion[0:frame_num], tsmotion[frame_num:]
+
+
+
+# smooth a whole clip with a sliding window of buffer_len frames
+# the first window gives the smooth meshes of its buffer_len frames, every later window only the last one
+# offline, all windows are known in advance: the later windows are gathered along the batch dimension
+# and their last frames are predicted chunk_size windows at a time (chunk_size bounds the memory)
+# smesh_list/tsmotion_list: T x [bs, h, w, 2]
+def smooth_clip(net, tsmotion_list1, tsmotion_list2, smesh_list1, smesh_list2, buffer_len = 7, chunk_size = 64):
+    frame_num = len(smesh_list1)
+
+    # clips shorter than one window are smoothed as a single window
+    first_len = min(buffer_len, frame_num)
+    tsmotion_sublist1 = list(tsmotion_list1[0:first_len])
+    tsmotion_sublist1[0] = tsmotion_sublist1[0] * 0
+    tsmotion_sublist2 = list(tsmotion_list2[0:first_len])
+    tsmotion_sublist2[0] = tsmotion_sublist2[0] * 0
+    smooth_batch_out = build_SmoothNet(net, tsmotion_sublist1, tsmotion_sublist2, list(smesh_list1[0:first_len]), list(smesh_list2[0:first_len]))
+    if frame_num <= buffer_len:
+        return smooth_batch_out
+
+    smesh1 = torch.stack(list(smesh_list1), 1)    # bs, T, h, w, 2
+    smesh2 = torch.stack(list(smesh_list2), 1)
+    tsmotion1 = torch.stack(list(tsmotion_list1), 1)
+    tsmotion2 = torch.stack(list(tsmotion_list2), 1)
+    batch_size = smesh1.size()[0]
+
+    # preallocated outputs: bs, T, h, w, 2
+    out_dict = {}
+    for name in ['ori_mesh1', 'smooth_mesh1', 'ori_path1', 'smooth_path1', 'ori_mesh2', 'smooth_mesh2', 'ori_path2', 'smooth_path2']:
+        out_dict[name] = smesh1.new_zeros([batch_size, frame_num, grid_h+1, grid_w+1, 2])
+        out_dict[name][:, 0:buffer_len] = smooth_batch_out[name]
+    out_dict['ori_mesh1'][:, buffer_len:] = smesh1[:, buffer_len:]
+    out_dict['ori_mesh2'][:, buffer_len:] = smesh2[:, buffer_len:]
+
+    # the smesh embeddings are shared by all windows containing the frame
+    hidden1 = net.MotionPre.embedding1(smesh1)   # bs, T, h, w, 32
+    hidden2 = net.MotionPre.embedding1(smesh2)
+
+    # frame indices of the windows ending at frame k: k-buffer_len+1 ... k
+    offset = torch.arange(1 - buffer_len, 1, device=smesh1.device)
+    for start in range(buffer_len, frame_num, chunk_size):
+        end = min(start + chunk_size, frame_num)
+        index = torch.arange(start, end, device=smesh1.device).unsqueeze(1) + offset   # n, buffer_len
+        window_num = end - start
+
+        # bs, n, buffer_len, ... -> bs*n, buffer_len, ...
+        window_tsmotion1 = tsmotion1[:, index].flatten(0, 1)
+        window_tsmotion1[:, 0] = 0
+        window_tsmotion2 = tsmotion2[:, index].flatten(0, 1)
+        window_tsmotion2[:, 0] = 0
+        ori_path1, ori_path2, delta_motion1, delta_motion2 = net.forward_last(hidden1[:, index].flatten(0, 1), hidden2[:, index].flatten(0, 1), window_tsmotion1, window_tsmotion2)
+
+        # the path of the last frame is accumulated along the whole clip below, store its step for now
+        for i, ori_path, delta_motion in [('1', ori_path1, delta_motion1), ('2', ori_path2, delta_motion2)]:
+            delta_motion = delta_motion.reshape(batch_size, window_num, grid_h+1, grid_w+1, 2)
+            out_dict['smooth_mesh'+i][:, start:end] = out_dict['ori_mesh'+i][:, start:end] - delta_motion
+            out_dict['ori_path'+i][:, start:end] = (ori_path[:, -1] - ori_path[:, -2]).reshape(batch_size, window_num, grid_h+1, grid_w+1, 2)
+            out_dict['smooth_path'+i][:, start:end] = delta_motion
+
+    # accumulate the path along the whole clip instead of inside the window
+    for i in ['1', '2']:
+        ori_path = out_dict['ori_path'+i]
+        ori_path[:, buffer_len:] = ori_path[:, buffer_len-1:buffer_len] + torch.cumsum(ori_path[:, buffer_len:], 1)
+        out_dict['smooth_path'+i][:, buffer_len:] += ori_path[:, buffer_len:]
+
+    return out_dict
+
+
+
+# sliding-window SmoothNet evaluation over a preallocated ring buffer
+# Only the smesh embeddings can be reused across windows: tsflow is accumulated from the first frame
+# of each window, so it changes whenever the window moves. Instead of recomputing the whole window,
+# smooth_last() only evaluates the temporal slices the last frame depends on.
+class IncrementalSmoothNet(object):
+
+    def __init__(self, net, buffer_len = 7):
+        self.net = net
+        self.buffer_len = buffer_len
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.smesh1 = None
+        self.smesh2 = None
+        self.tsmotion1 = None
+        self.tsmotion2 = None
+        self.hidden1 = None
+        self.hidden2 = None
+
+    def ready(self):
+        return self.count >= self.buffer_len
+
+    # smesh, tsmotion: bs, h, w, 2
+    def push(self, smesh1, smesh2, tsmotion1, tsmotion2):
+        hidden1 = self.net.MotionPre.embedding1(smesh1)
+        hidden2 = self.net.MotionPre.embedding1(smesh2)
+
+        if self.smesh1 is None:
+            self.smesh1 = self._alloc(smesh1)
+            self.smesh2 = self._alloc(smesh2)
+            self.tsmotion1 = self._alloc(tsmotion1)
+            self.tsmotion2 = self._alloc(tsmotion2)
+            self.hidden1 = self._alloc(hidden1)
+            self.hidden2 = self._alloc(hidden2)
+
+        idx = self.count % self.buffer_len
+        self.smesh1[:, idx] = smesh1
+        self.smesh2[:, idx] = smesh2
+        self.tsmotion1[:, idx] = tsmotion1
+        self.tsmotion2[:, idx] = tsmotion2
+        self.hidden1[:, idx] = hidden1
+        self.hidden2[:, idx] = hidden2
+        self.count += 1
+
+    # run the full SmoothNet over the current window (bs, T, h, w, 2 outputs)
+    def smooth_all(self):
+        order = self._order()
+        tsmotion_sublist1 = [self.tsmotion1[:, i] for i in order]
+        tsmotion_sublist1[0] = tsmotion_sublist1[0] * 0
+        tsmotion_sublist2 = [self.tsmotion2[:, i] for i in order]
+        tsmotion_sublist2[0] = tsmotion_sublist2[0] * 0
+
+        return build_SmoothNet(self.net, tsmotion_sublist1, tsmotion_sublist2, [self.smesh1[:, i] for i in order], [self.smesh2[:, i] for i in order])
+
+    # smooth only the last frame of the current window (bs, h, w, 2 outputs)
+    def smooth_last(self):
+        order = self._order()
+        tsmotion1 = self.tsmotion1[:, order]
+        tsmotion1[:, 0] = 0
+        tsmotion2 = self.tsmotion2[:, order]
+        tsmotion2[:, 0] = 0
+
+        ori_path1, ori_path2, delta_motion1, delta_motion2 = self.net.forward_last(self.hidden1[:, order], self.hidden2[:, order], tsmotion1, tsmotion2)
+        ori_mesh1 = self.smesh1[:, order[-1]]
+        ori_mesh2 = self.smesh2[:, order[-1]]
+
+        out_dict = {}
+        out_dict.update(ori_path1 = ori_path1[:, -1], smooth_path1 = ori_path1[:, -1] + delta_motion1, ori_mesh1 = ori_mesh1, smooth_mesh1 = ori_mesh1 - delta_motion1,
+                        ori_path2 = ori_path2[:, -1], smooth_path2 = ori_path2[:, -1] + delta_motion2, ori_mesh2 = ori_mesh2, smooth_mesh2 = ori_mesh2 - delta_motion2,
+                        ori_path_prev1 = ori_path1[:, -2], ori_path_prev2 = ori_path2[:, -2])
+
+        return out_dict
+
+    def _alloc(self, x):
+        return x.new_zeros([x.size()[0], self.buffer_len] + list(x.size()[1:]))
+
+    # ring buffer slots from the oldest to the newest frame of the window
+    def _order(self):
+        length = min(self.count, self.buffer_len)
+        start = self.count - length
+        return [(start + i) % self.buffer_len for i in range(length)]
+
+
+
 
 # define and forward
 class SmoothNet(nn.Module):
@@ -100,6 +283,19 @@ class SmoothNet(nn.Module):
 
         return smesh1, smesh2, tsflow1, tsflow2, delta_tsflow1, delta_tsflow2
 
+    # predict the delta motion of the last frame only
+    # hidden1/hidden2: embedded smesh (bs, T, h, w, 32), tsmotion1/tsmotion2: bs, T, h, w, 2
+    def forward_last(self, hidden1, hidden2, tsmotion1, tsmotion2):
+
+        tsflow1 = torch.cumsum(tsmotion1, 1)  # bs, T, h, w, 2
+        tsflow2 = torch.cumsum(tsmotion2, 1)  # bs, T, h, w, 2
+
+        delta_tsflow = self.MotionPre.forward_last(hidden1, hidden2, tsflow1, tsflow2)
+        delta_tsflow1 = delta_tsflow[...,0:2]
+        delta_tsflow2 = delta_tsflow[...,2:4]
+
+        return tsflow1, tsflow2, delta_tsflow1, delta_tsflow2
+
 
 
 
@@ -156,5 +352,41 @@ class MotionPrediction(nn.Module):
 
         return delta_tsflow
 
+    # same as forward, but only the last frame is decoded
+    # the smesh embeddings (embedding1) are computed by the caller so that they can be cached per frame
+    def forward_last(self, hidden11, hidden21, tsflow1, tsflow2):
 
+        hidden13 = self.embedding3(tsflow1)       # bs, T, H, W, 32
+        hidden1 = torch.cat([hidden11, hidden13], 4)    # bs, T, H, W, 64
+
+        hidden23 = self.embedding3(tsflow2)       # bs, T, H, W, 32
+        hidden2 = torch.cat([hidden21, hidden23], 4)    # bs, T, H, W, 64
+
+        hidden = torch.cat([hidden1, hidden2], 4) # bs, T, H, W, 128
+        hidden = hidden.permute(0, 4, 1, 2, 3)   # bs, 128, T, H, W
+
+        # each conv layer only evaluates the frames needed by the next one:
+        # for T = 7 and kernel = 5, the three layers output 5, 3 and 1 frames instead of 7, 7 and 7
+        frame_num = hidden.size()[2]
+        conv_list = [m for m in self.MotionConv3D if isinstance(m, nn.Conv3d)]
+        first = 0   # index of the first frame held in hidden
+        layer = 0
+        for m in self.MotionConv3D:
+            if not isinstance(m, nn.Conv3d):
+                hidden = m(hidden)
+                continue
+            layer += 1
+            out_first = max(frame_num - 1 - self.pad * (len(conv_list) - layer), 0)
+            in_first = out_first - self.pad
+            if in_first >= first:
+                hidden = hidden[:, :, in_first - first:]
+                left = 0
+            else:
+                left = first - in_first
+            hidden = F.pad(hidden, [0, 0, 0, 0, left, self.pad])
+            hidden = F.conv3d(hidden, m.weight, m.bias, padding=(0, 1, 1))
+            first = out_first
+
+        delta_tsflow = self.decoding(hidden[:, :, -1].permute(0, 2, 3, 1))   # bs, H, W, 4
 
+        return delta_tsflow
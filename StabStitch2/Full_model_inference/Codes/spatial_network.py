@@ -8,6 +8,8 @@ import torch.nn.functional as F
 import cv2
 import numpy as np
 import torchvision.models as models
+from device_utils import get_device, module_device, cached_constant
+from geometry import H2Mesh, get_rigid_mesh, get_norm_mesh, inverse_3x3
 
 
 import grid_res
@@ -16,88 +18,74 @@ grid_w = grid_res.GRID_W
 
 
 
-#Covert global homo into mesh
-def H2Mesh(H, rigid_mesh):
+# corner points of a height x width image: bs x 4 x 2 (cached per resolution and device)
+def get_corner_points(batch_size, height, width, device=None):
 
-    H_inv = torch.inverse(H)
-    ori_pt = rigid_mesh.reshape(rigid_mesh.size()[0], -1, 2)
-    ones = torch.ones(rigid_mesh.size()[0], (grid_h+1)*(grid_w+1),1)
-    if torch.cuda.is_available():
-        ori_pt = ori_pt.cuda()
-        ones = ones.cuda()
+    src_p = cached_constant(('corner_points', height, width), device, lambda: torch.tensor([[0., 0.], [width, 0.], [0., height], [width, height]]))
 
-    ori_pt = torch.cat((ori_pt, ones), 2) # bs*(grid_h+1)*(grid_w+1)*3
-    tar_pt = torch.matmul(H_inv, ori_pt.permute(0,2,1)) # bs*3*(grid_h+1)*(grid_w+1)
+    return src_p.unsqueeze(0).expand(batch_size, -1, -1)
 
-    mesh_x = torch.unsqueeze(tar_pt[:,0,:]/tar_pt[:,2,:], 2)
-    mesh_y = torch.unsqueeze(tar_pt[:,1,:]/tar_pt[:,2,:], 2)
-    mesh = torch.cat((mesh_x, mesh_y), 2).reshape([rigid_mesh.size()[0], grid_h+1, grid_w+1, 2])
+# matrix from normalized (-1 ~ 1) to pixel coordinates and its inverse (cached per resolution and device)
+def get_norm_matrix(height, width, device=None):
 
-    return mesh
+    def _build():
+        return torch.tensor([[width / 2.0, 0., width / 2.0],
+                      [0., height / 2.0, height / 2.0],
+                      [0., 0., 1.]])
 
-# get rigid mesh
-def get_rigid_mesh(batch_size, height, width):
+    M_tensor = cached_constant(('norm_matrix', height, width), device, _build)
+    M_tensor_inv = cached_constant(('norm_matrix_inv', height, width), device, lambda: torch.inverse(M_tensor))
 
-    ww = torch.matmul(torch.ones([grid_h+1, 1]), torch.unsqueeze(torch.linspace(0., float(width), grid_w+1), 0))
-    hh = torch.matmul(torch.unsqueeze(torch.linspace(0.0, float(height), grid_h+1), 1), torch.ones([1, grid_w+1]))
-    if torch.cuda.is_available():
-        ww = ww.cuda()
-        hh = hh.cuda()
+    return M_tensor, M_tensor_inv
 
-    ori_pt = torch.cat((ww.unsqueeze(2), hh.unsqueeze(2)),2) # (grid_h+1)*(grid_w+1)*2
-    ori_pt = ori_pt.unsqueeze(0).expand(batch_size, -1, -1, -1)
+# coordinate buffers of the contextual correlation layer (cached per feature size and device)
+# match_coords: [2, h*w] (x, y) of every candidate, pixel_coords: [1, 2, h, w] (x, y) of every pixel
+def get_ccl_coords(height, width, device=None):
 
-    return ori_pt
+    def _build_match():
+        c_one = torch.arange(height*width, dtype=torch.float32)
+        return torch.stack([c_one % width, c_one // width], 0)
 
-# normalize mesh from -1 ~ 1
-def get_norm_mesh(mesh, height, width):
-    batch_size = mesh.size()[0]
-    mesh_w = mesh[...,0]*2./float(width) - 1.
-    mesh_h = mesh[...,1]*2./float(height) - 1.
-    norm_mesh = torch.stack([mesh_w, mesh_h], 3) # bs*(grid_h+1)*(grid_w+1)*2
+    def _build_pixel():
+        h_one = torch.arange(height, dtype=torch.float32).reshape(height, 1).expand(-1, width)
+        w_one = torch.arange(width, dtype=torch.float32).reshape(1, width).expand(height, -1)
+        return torch.stack([w_one, h_one], 0).unsqueeze(0)
 
-    return norm_mesh.reshape([batch_size, -1, 2]) # bs*-1*2
+    match_coords = cached_constant(('ccl_match_coords', height, width), device, _build_match)
+    pixel_coords = cached_constant(('ccl_pixel_coords', height, width), device, _build_pixel)
 
+    return match_coords, pixel_coords
 
-
-def build_SpatialNet(net, input1_tensor, input2_tensor):
+# feature_1_64/feature_2_64: optional precomputed stage1 features of the inputs
+def build_SpatialNet(net, input1_tensor, input2_tensor, feature_1_64=None, feature_2_64=None):
     batch_size, _, img_h, img_w = input1_tensor.size()
 
-    H_motion, mesh_motion_ref, mesh_motion_tgt = net(input1_tensor, input2_tensor)
+    H_motion, mesh_motion_ref, mesh_motion_tgt = net(input1_tensor, input2_tensor, feature_1_64, feature_2_64)
 
     H_motion = H_motion.reshape(-1, 4, 2)
     mesh_motion_ref = mesh_motion_ref.reshape(-1, grid_h+1, grid_w+1, 2)
     mesh_motion_tgt = mesh_motion_tgt.reshape(-1, grid_h+1, grid_w+1, 2)
 
-    # initialize the source points bs x 4 x 2
-    src_p = torch.tensor([[0., 0.], [img_w, 0.], [0., img_h], [img_w, img_h]])
-    if torch.cuda.is_available():
-        src_p = src_p.cuda()
-    src_p = src_p.unsqueeze(0).expand(batch_size, -1, -1)
+    # initialize the source points 1 x 4 x 2
+    device = input1_tensor.device
+    src_p = get_corner_points(1, img_h, img_w, device)
     # target points
     dst_p = src_p + H_motion
-    # solve homo using DLT
-    H = torch_DLT.tensor_DLT(src_p, dst_p)
-
-    M_tensor = torch.tensor([[img_w / 2.0, 0., img_w / 2.0],
-                      [0., img_h / 2.0, img_h / 2.0],
-                      [0., 0., 1.]]).cuda()
-    M_tile = M_tensor.unsqueeze(0).expand(batch_size, -1, -1)
-    M_tensor_inv = torch.inverse(M_tensor)
-    M_tile_inv = M_tensor_inv.unsqueeze(0).expand(batch_size, -1, -1)
-    mask = torch.ones_like(input2_tensor).cuda()
+    # mask = torch.ones_like(input2_tensor)
 
     ########  homography decomposition #######
     dst_p_tgt = src_p + (H_motion/2.)
-    H_tgt = torch_DLT.tensor_DLT(src_p, dst_p_tgt)
-    H_ref = torch.matmul(torch.inverse(H), H_tgt)
+    # solve H and H_tgt using DLT in one batch
+    H_all = torch_DLT.solve_DLT(src_p, torch.cat([dst_p, dst_p_tgt], 0))
+    H, H_tgt = H_all[0:batch_size], H_all[batch_size:]
+    H_ref = torch.matmul(inverse_3x3(H), H_tgt)
     # H_mat_ref = torch.matmul(torch.matmul(M_tile_inv, H_ref), M_tile)
     # H_mat_tgt = torch.matmul(torch.matmul(M_tile_inv, H_tgt), M_tile)
     # output_H_ref = torch_homo_transform.transformer(torch.cat((input1_tensor, mask), 1), H_mat_ref, (img_h, img_w))
     # output_H_tgt = torch_homo_transform.transformer(torch.cat((input2_tensor, mask), 1), H_mat_tgt, (img_h, img_w))
 
     ##### stage 2 ####
-    rigid_mesh = get_rigid_mesh(batch_size, img_h, img_w)
+    rigid_mesh = get_rigid_mesh(batch_size, img_h, img_w, device)
     ini_mesh_ref = H2Mesh(H_ref, rigid_mesh)
     mesh_ref = ini_mesh_ref + mesh_motion_ref
     ini_mesh_tgt = H2Mesh(H_tgt, rigid_mesh)
@@ -118,6 +106,39 @@ def build_SpatialNet(net, input1_tensor, input2_tensor):
     return out_dict
 
 
+# run SpatialNet over N frame pairs, batch_size pairs per forward pass
+# input1_tensor_list/input2_tensor_list: N x [1, 3, img_h, img_w]
+# feature_cache: optional FeatureCache shared with TemporalNet, frames are keyed from index `start`
+# device: where the inputs are moved to, defaults to the device of the network
+def build_SpatialNet_batch(net, input1_tensor_list, input2_tensor_list, batch_size=8, feature_cache=None, start=0, device=None):
+    if device is None:
+        device = module_device(net)
+
+    motion1_list = []
+    motion2_list = []
+    for k in range(0, len(input1_tensor_list), batch_size):
+        input1_tensor = torch.cat(input1_tensor_list[k:k+batch_size], 0)
+        input2_tensor = torch.cat(input2_tensor_list[k:k+batch_size], 0)
+        input1_tensor = input1_tensor.to(device, non_blocking=True)
+        input2_tensor = input2_tensor.to(device, non_blocking=True)
+
+        feature_1_64 = None
+        feature_2_64 = None
+        if feature_cache is not None:
+            index_list = range(start+k, start+k+input1_tensor.size()[0])
+            feature_1_64 = feature_cache.get('spatial', 0, index_list, input1_tensor_list[k:k+batch_size])
+            feature_2_64 = feature_cache.get('spatial', 1, index_list, input2_tensor_list[k:k+batch_size])
+
+        batch_out = build_SpatialNet(net, input1_tensor, input2_tensor, feature_1_64, feature_2_64)
+        motion1_list.append(batch_out['motion1'])
+        motion2_list.append(batch_out['motion2'])
+
+    # N, grid_h+1, grid_w+1, 2
+    out_dict = {}
+    out_dict.update(motion1 = torch.cat(motion1_list, 0), motion2 = torch.cat(motion2_list, 0))
+
+    return out_dict
+
 
 
 def get_res18_FeatureMap(resnet18_model):
@@ -265,20 +286,25 @@ class SpatialNet(nn.Module):
                 m.weight.data.fill_(1)
                 m.bias.data.zero_()
 
+        # moved together with the other parameters by net.to(device)
         resnet18_model = models.resnet.resnet18(weights="DEFAULT")
-        if torch.cuda.is_available():
-            resnet18_model = resnet18_model.cuda()
         self.feature_extractor_stage1, self.feature_extractor_stage2 = get_res18_FeatureMap(resnet18_model)
+
+        # memory budget (bytes) of the cost volume, None: build it at once with F.unfold
+        self.cost_memory = None
         #-----------------------------------------
 
 
     # forward
-    def forward(self, input1_tesnor, input2_tesnor):
+    def forward(self, input1_tesnor, input2_tesnor, feature_1_64=None, feature_2_64=None):
         batch_size, _, img_h, img_w = input1_tesnor.size()
 
-        feature_1_64 = self.feature_extractor_stage1(input1_tesnor)
+        # stage1 features can be provided by a FeatureCache
+        if feature_1_64 is None:
+            feature_1_64 = self.feature_extractor_stage1(input1_tesnor)
+        if feature_2_64 is None:
+            feature_2_64 = self.feature_extractor_stage1(input2_tesnor)
         feature_1_32 = self.feature_extractor_stage2(feature_1_64)
-        feature_2_64 = self.feature_extractor_stage1(input2_tesnor)
         feature_2_32 = self.feature_extractor_stage2(feature_2_64)
 
         ######### stage 1
@@ -289,40 +315,35 @@ class SpatialNet(nn.Module):
 
         # homo decomposition
         H_motion_1 = offset_1.reshape(-1, 4, 2)
-        src_p = torch.tensor([[0., 0.], [img_w, 0.], [0., img_h], [img_w, img_h]])
-        if torch.cuda.is_available():
-            src_p = src_p.cuda()
-        src_p = src_p.unsqueeze(0).expand(batch_size, -1, -1)
+        device = offset_1.device
+        src_p = get_corner_points(1, img_h, img_w, device)
         dst_p = src_p + H_motion_1
         dst_p_tgt = src_p + (H_motion_1 / 2.)
-        H = torch_DLT.tensor_DLT(src_p/8, dst_p/8)
-        H_tgt = torch_DLT.tensor_DLT(src_p/8, dst_p_tgt/8)
-        H_ref = torch.matmul(torch.inverse(H), H_tgt)
+        # H and H_tgt in one batched DLT
+        H_all = torch_DLT.solve_DLT(src_p/8, torch.cat([dst_p, dst_p_tgt], 0)/8)
+        H, H_tgt = H_all[0:batch_size], H_all[batch_size:]
+        H_ref = torch.matmul(inverse_3x3(H), H_tgt)
 
-        M_tensor = torch.tensor([[img_w/8 / 2.0, 0., img_w/8 / 2.0],
-                      [0., img_h/8 / 2.0, img_h/8 / 2.0],
-                      [0., 0., 1.]]).cuda()
-        M_tile = M_tensor.unsqueeze(0).expand(batch_size, -1, -1)
-        M_tensor_inv = torch.inverse(M_tensor)
-        M_tile_inv = M_tensor_inv.unsqueeze(0).expand(batch_size, -1, -1)
+        # both homos from pixel to normalized coordinates at once (M is broadcast over the batch)
+        M_tensor, M_tensor_inv = get_norm_matrix(img_h/8, img_w/8, device)
+        H_mat = torch.matmul(torch.matmul(M_tensor_inv, torch.cat([H_ref, H_tgt], 0)), M_tensor)
+        H_mat_ref, H_mat_tgt = H_mat[0:batch_size], H_mat[batch_size:]
 
         # warping by two homo
-        H_mat_ref = torch.matmul(torch.matmul(M_tile_inv, H_ref), M_tile)
         warp_feature_1_64_ref = torch_homo_transform.transformer(feature_1_64, H_mat_ref, (int(img_h/8), int(img_w/8)))
-        H_mat_tgt = torch.matmul(torch.matmul(M_tile_inv, H_tgt), M_tile)
         warp_feature_2_64_tgt = torch_homo_transform.transformer(feature_2_64, H_mat_tgt, (int(img_h/8), int(img_w/8)))
 
        ######### stage 2
         # for img1
         # img1_temp_2 = self.regressNet2_part1_ref(torch.cat([warp_feature_1_64_ref, warp_feature_2_64_tgt], 1))
-        correlation_ref = self.cost_volume(warp_feature_1_64_ref, warp_feature_2_64_tgt, search_range=5, norm=False)
+        correlation_ref = self.cost_volume(warp_feature_1_64_ref, warp_feature_2_64_tgt, search_range=5, norm=False, memory_budget=self.cost_memory)
         img1_temp_2 = self.regressNet2_part1_ref(correlation_ref)
         img1_temp_2 = img1_temp_2.reshape(img1_temp_2.size()[0], -1)
         offset_2_ref = self.regressNet2_part2_ref(img1_temp_2)
 
         # for img2
         # img2_temp_2 = self.regressNet2_part1_tgt(torch.cat([warp_feature_2_64_tgt, warp_feature_1_64_ref], 1))
-        correlation_tgt = self.cost_volume(warp_feature_2_64_tgt, warp_feature_1_64_ref, search_range=5, norm=False)
+        correlation_tgt = self.cost_volume(warp_feature_2_64_tgt, warp_feature_1_64_ref, search_range=5, norm=False, memory_budget=self.cost_memory)
         img2_temp_2 = self.regressNet2_part1_tgt(correlation_tgt)
         img2_temp_2 = img2_temp_2.reshape(img2_temp_2.size()[0], -1)
         offset_2_tgt = self.regressNet2_part2_tgt(img2_temp_2)
@@ -331,7 +352,10 @@ class SpatialNet(nn.Module):
         return offset_1, offset_2_ref, offset_2_tgt
 
     @staticmethod
-    def cost_volume(x1, x2, search_range, norm=True, fast=True):
+    # memory_budget: bytes for the temporaries of the correlation (None: fast or slow as below)
+    # the chunked correlation is only approximately equal to fast: the mean over the channels is reduced
+    # over differently laid-out tensors, so the results differ by float rounding (about 1e-7)
+    def cost_volume(x1, x2, search_range, norm=True, fast=True, memory_budget=None):
         if norm:
             x1 = F.normalize(x1, p=2, dim=1)
             x2 = F.normalize(x2, p=2, dim=1)
@@ -339,7 +363,18 @@ class SpatialNet(nn.Module):
         padded_x2 = F.pad(x2, [search_range] * 4)  # [b,c,h,w] -> [b,c,h+sr*2,w+sr*2]
         max_offset = search_range * 2 + 1
 
-        if fast:
+        if memory_budget is not None:
+            # same as fast, but only a chunk of the max_offset**2 displacements is expanded at a time
+            # (the shifted views and their product with x1: 2 feature maps per displacement)
+            disp_num = max_offset ** 2
+            chunk = max(1, min(disp_num, memory_budget // (2 * x1.element_size() * bs * c * h * w)))
+            cost_vol = x1.new_empty(bs, disp_num, h, w)
+            for start in range(0, disp_num, chunk):
+                end = min(start + chunk, disp_num)
+                # displacement d = j * max_offset + i, the order of F.unfold
+                patches = torch.stack([padded_x2[:, :, d // max_offset:d // max_offset + h, d % max_offset:d % max_offset + w] for d in range(start, end)], 2)
+                cost_vol[:, start:end] = (x1.unsqueeze(2) * patches).mean(dim=1, keepdim=False)
+        elif fast:
             # faster(*2) but cost higher(*n) GPU memory
             patches = F.unfold(padded_x2, (max_offset, max_offset)).reshape(bs, c, max_offset ** 2, h, w)
             cost_vol = (x1.unsqueeze(2) * patches).mean(dim=1, keepdim=False)
@@ -374,52 +409,21 @@ class SpatialNet(nn.Module):
         #print(norm_feature_2.size())
 
         patches = self.extract_patches(norm_feature_2)
-        if torch.cuda.is_available():
-            patches = patches.cuda()
 
         matching_filters  = patches.reshape((patches.size()[0], -1, patches.size()[3], patches.size()[4], patches.size()[5]))
 
-        match_vol = []
-        for i in range(bs):
-            single_match = F.conv2d(norm_feature_1[i].unsqueeze(0), matching_filters[i], padding=1)
-            match_vol.append(single_match)
-
-        match_vol = torch.cat(match_vol, 0)
+        # one grouped convolution for the whole batch: group i matches sample i with its own filters
+        match_vol = F.conv2d(norm_feature_1.reshape(1, bs*c, h, w), matching_filters.reshape(-1, c, patches.size()[4], patches.size()[5]), padding=1, groups=bs)
+        match_vol = match_vol.reshape(bs, -1, h, w)
         #print(match_vol .size())
 
         # scale softmax
         softmax_scale = 10
         match_vol = F.softmax(match_vol*softmax_scale,1)
 
-        channel = match_vol.size()[1]
-
-        h_one = torch.linspace(0, h-1, h)
-        one1w = torch.ones(1, w)
-        if torch.cuda.is_available():
-            h_one = h_one.cuda()
-            one1w = one1w.cuda()
-        h_one = torch.matmul(h_one.unsqueeze(1), one1w)
-        h_one = h_one.unsqueeze(0).unsqueeze(0).expand(bs, channel, -1, -1)
-
-        w_one = torch.linspace(0, w-1, w)
-        oneh1 = torch.ones(h, 1)
-        if torch.cuda.is_available():
-            w_one = w_one.cuda()
-            oneh1 = oneh1.cuda()
-        w_one = torch.matmul(oneh1, w_one.unsqueeze(0))
-        w_one = w_one.unsqueeze(0).unsqueeze(0).expand(bs, channel, -1, -1)
-
-        c_one = torch.linspace(0, channel-1, channel)
-        if torch.cuda.is_available():
-            c_one = c_one.cuda()
-        c_one = c_one.unsqueeze(0).unsqueeze(2).unsqueeze(3).expand(bs, -1, h, w)
-
-        flow_h = match_vol*(c_one//w - h_one)
-        flow_h = torch.sum(flow_h, dim=1, keepdim=True)
-        flow_w = match_vol*(c_one%w - w_one)
-        flow_w = torch.sum(flow_w, dim=1, keepdim=True)
-
-        feature_flow = torch.cat([flow_w, flow_h], 1)
+        # soft-argmax: expected (x, y) of the match minus the pixel position, as one matmul over the h*w candidates
+        match_coords, pixel_coords = get_ccl_coords(h, w, feature_1.device)
+        feature_flow = torch.matmul(match_coords, match_vol.reshape(bs, h*w, h*w)).reshape(bs, 2, h, w) - pixel_coords
         #print(flow.size())
 
         return feature_flow
@@ -0,0 +1,216 @@
+# coding: utf-8
+# warping and blending of one frame pair onto the stitching canvas
+import math
+import torch
+from geometry import get_norm_mesh
+from blending import linear_blender, mask_centroid, BLUR_KERNEL_SIZE
+import utils.torch_tps_transform as torch_tps_transform
+import utils.torch_tps_transform_point as torch_tps_transform_point
+
+
+# margin (canvas pixels) added around the bounding box of a warped mesh
+BOX_MARGIN = 2
+# the TPS bends the image borders between the control points, so the box of the mesh may cut them:
+# each side of the box is checked on lines BOX_GROW pixels apart out to the canvas border, and pushed
+# one line past the outermost line whose pixels still sample the image
+BOX_GROW = 16
+
+
+# candidate positions of a side of the box, from `start` to the border `stop` of the canvas, `step` apart
+def _side_lines(start, stop, step):
+    return list(range(start, stop, step)) + [stop]
+
+# flags of the canvas rows, then of the canvas columns, whose pixels sample the image of a view
+# T: the TPS parameters of the view (from its normalized mesh to the rigid mesh), in_size: (height, width) of its image
+def _lines_inside(T, norm_mesh, rows, cols, out_height, out_width, in_size):
+    x_c = torch.linspace(-1.0, 1.0, out_width, device=T.device)
+    y_c = torch.linspace(-1.0, 1.0, out_height, device=T.device)
+    rows, cols = torch.tensor(rows, device=T.device), torch.tensor(cols, device=T.device)
+    row_point = torch.stack([x_c.expand(len(rows), -1), y_c[rows].unsqueeze(1).expand(-1, out_width)], 2)
+    col_point = torch.stack([x_c[cols].unsqueeze(1).expand(-1, out_height), y_c.expand(len(cols), -1)], 2)
+    point = torch.cat([row_point.reshape(-1, 2), col_point.reshape(-1, 2)], 0).unsqueeze(0).expand(T.size()[0], -1, -1)
+    # sampling position of the pixels, with a pixel of slack around the image (FAST and COARSE sample half a pixel out)
+    limit = torch.tensor([1. + 4./in_size[1], 1. + 4./in_size[0]], device=T.device)
+    inside = (torch_tps_transform_point.transform_points(point, norm_mesh, T).abs() <= limit).all(2).any(0)
+    row_inside, col_inside = torch.split(inside, [len(rows)*out_width, len(cols)*out_height])
+
+    return torch.cat([row_inside.view(len(rows), out_width).any(1), col_inside.view(len(cols), out_height).any(1)])
+
+# windows (row, col, height, width) of the canvas covered by normalized meshes (bs, pn, 2), one per view, over the whole batch
+# pixel j of the canvas is at -1 + 2*j/(size-1), as in the pixel grid of the TPS warp
+# Ts, in_sizes: the TPS parameters of the warp of each view (see torch_tps_transform.solve_system) and the (height, width)
+# of the warped images, to check the borders of the boxes (see BOX_GROW), None to use the boxes of the meshes as they are
+# the views are checked together: one device sync for the bounds of the meshes and one for the borders
+def mesh_boxes(norm_meshes, out_height, out_width, Ts=None, in_sizes=None, margin=BOX_MARGIN):
+    out_height, out_width = int(out_height), int(out_width)
+    bounds = torch.stack([torch.stack([norm_mesh[...,0].min(), norm_mesh[...,0].max(), norm_mesh[...,1].min(), norm_mesh[...,1].max()])
+                          for norm_mesh in norm_meshes])
+
+    boxes = []
+    for x_min, x_max, y_min, y_max in bounds.tolist():
+        col0 = min(max(0, int(math.floor((x_min+1) * (out_width-1) / 2.)) - margin), out_width-1)
+        col1 = max(min(out_width, int(math.ceil((x_max+1) * (out_width-1) / 2.)) + margin + 1), col0+1)
+        row0 = min(max(0, int(math.floor((y_min+1) * (out_height-1) / 2.)) - margin), out_height-1)
+        row1 = max(min(out_height, int(math.ceil((y_max+1) * (out_height-1) / 2.)) + margin + 1), row0+1)
+        boxes.append((row0, col0, row1-row0, col1-col0))
+    if Ts is None:
+        return boxes
+
+    # top, bottom, left and right lines of every box, the last lines of bottom and right are row1-1 and col1-1
+    sides, flags = [], []
+    for (row0, col0, height, width), T, norm_mesh, in_size in zip(boxes, Ts, norm_meshes, in_sizes):
+        lines = [_side_lines(row0, 0, -BOX_GROW), _side_lines(row0+height-1, out_height-1, BOX_GROW),
+                 _side_lines(col0, 0, -BOX_GROW), _side_lines(col0+width-1, out_width-1, BOX_GROW)]
+        sides.append(lines)
+        flags.append(_lines_inside(T, norm_mesh, lines[0] + lines[1], lines[2] + lines[3], out_height, out_width, in_size))
+    flags = torch.cat(flags).tolist()
+
+    grown = []
+    for lines in sides:
+        ends = []
+        for side in lines:
+            inside, flags = flags[:len(side)], flags[len(side):]
+            last = max([k for k in range(len(side)) if inside[k]], default=None)
+            ends.append(side[0] if last is None else side[min(last+1, len(side)-1)])
+        top, bottom, left, right = ends
+        grown.append((top, left, bottom+1-top, right+1-left))
+
+    return grown
+
+# the window grown by `margin` pixels on every side, clipped to the canvas
+def _grow_box(box, margin, out_height, out_width):
+    row, col, height, width = box
+    row0, col0 = max(0, row-margin), max(0, col-margin)
+    row1, col1 = min(int(out_height), row+height+margin), min(int(out_width), col+width+margin)
+
+    return (row0, col0, row1-row0, col1-col0)
+
+def _box_slice(box):
+    row, col, height, width = box
+    return (slice(None), slice(None), slice(row, row+height), slice(col, col+width))
+
+# warped view of its window, put back on a zero canvas: bs, c, out_height, out_width
+def _paste(warp, box, out_height, out_width):
+    bs, c, _, _ = warp.size()
+    canvas = warp.new_zeros(bs, c, int(out_height), int(out_width))
+    canvas[_box_slice(box)] = warp
+
+    return canvas
+
+
+class CanvasPlanner(object):
+    """
+    Plans the output canvas (width_min, height_min, out_width, out_height) of a clip from its smooth meshes.
+
+    By default the canvas is the bounding box of all the meshes of the clip, so nothing can be
+    rendered before the whole clip is smoothed, and a single outlier mesh enlarges the canvas of
+    every frame. The planner can instead fix the canvas from:
+  frame_num: the first frame_num frames only (0: all the given frames), later frames are cropped to it
+  envelope: (x_min, y_min, x_max, y_max), a configured envelope of the rig, the meshes are not used
+  outlier: fraction of the frames ignored at each side, the extent of the canvas is the
+    outlier / 1-outlier quantile of the per-frame extents instead of their min / max
+  out_size: (out_height, out_width), a fixed output size centered on the planned canvas
+    All the coordinates are in the pixels of the meshes (the resolution of the warped images).
+
+    Usage:
+        planner = CanvasPlanner(frame_num = 7, outlier = 0.05)
+        width_min, height_min, out_width, out_height = planner.plan([smooth_mesh1, smooth_mesh2])
+    """
+
+    def __init__(self, frame_num = 0, envelope = None, outlier = 0., out_size = None):
+        self.frame_num = frame_num
+        self.envelope = envelope
+        self.outlier = outlier
+        self.out_size = out_size
+
+    # meshes: one [bs, T, grid_h+1, grid_w+1, 2] tensor per view -> four 0-dim tensors
+    def plan(self, meshes):
+        if self.envelope is not None:
+            bounds = torch.tensor([float(v) for v in self.envelope])
+        else:
+            # per-frame extents over the views and the batch: T x [x_min, y_min, x_max, y_max]
+            meshes = torch.cat([mesh[:, :self.frame_num] if self.frame_num > 0 else mesh for mesh in meshes], 0)
+            meshes = meshes.transpose(0, 1).reshape(meshes.size()[1], -1, 2)
+            frame_min, frame_max = meshes.min(1)[0], meshes.max(1)[0]
+            if self.outlier > 0:
+                bounds = torch.cat([torch.quantile(frame_min, self.outlier, 0), torch.quantile(frame_max, 1-self.outlier, 0)])
+            else:
+                bounds = torch.cat([frame_min.min(0)[0], frame_max.max(0)[0]])
+
+        width_min, height_min, width_max, height_max = bounds.unbind(0)
+        out_width = width_max - width_min
+        out_height = height_max - height_min
+        if self.out_size is not None:
+            width_min = width_min + (out_width - self.out_size[1]) / 2.
+            height_min = height_min + (out_height - self.out_size[0]) / 2.
+            out_width = torch.full_like(out_width, float(self.out_size[1]))
+            out_height = torch.full_like(out_height, float(self.out_size[0]))
+
+        return width_min, height_min, out_width, out_height
+
+
+# warp a single frame pair onto the canvas and blend it
+# mesh1/mesh2: bs, h, w, 2 (in the resolution of img1/img2)
+# warpers: optional pair of TPSWarper for (out_height, out_width), one per view, reused across the frames of a clip
+# each view is only warped inside the bounding box of its mesh (the warp is zero outside),
+# and only the part of the canvas where the blending weights can differ from 0 or 1 goes through the blender
+# the output matches the full-canvas path (both views warped over the whole canvas and blended there); for it,
+# NORMAL + LINEAR still warps the masks over the whole canvas for the centroids of the blender
+def stitch_frame(img1, img2, mesh1, mesh2, norm_rigid_mesh, width_min, height_min, out_width, out_height, warp_mode, fusion_mode, device=None, warpers=None):
+    if warpers is None:
+        warpers = [torch_tps_transform.TPSWarper((out_height.int(), out_width.int()), warp_mode) for _ in range(2)]
+    if device is None:
+        device = mesh1.device
+    canvas_h, canvas_w = int(out_height.int()), int(out_width.int())
+
+    # img1, img2: bs, 3, h, w and mesh1, mesh2: bs, grid_h+1, grid_w+1, 2 -> fusion: bs, 3, out_height, out_width
+    bs = img1.size()[0]
+    norm_rigid_mesh = norm_rigid_mesh.expand(bs, -1, -1)
+
+    mesh_trans1 = torch.stack([mesh1[...,0]-width_min, mesh1[...,1]-height_min], 3)
+    norm_mesh1 = get_norm_mesh(mesh_trans1, out_height, out_width)
+    img1 = img1.to(device, non_blocking=True)
+
+    mesh_trans2 = torch.stack([mesh2[...,0]-width_min, mesh2[...,1]-height_min], 3)
+    norm_mesh2 = get_norm_mesh(mesh_trans2, out_height, out_width)
+    img2 = img2.to(device, non_blocking=True)
+
+    if fusion_mode != 'AVERAGE':
+        mask = torch.ones_like(img1[:,0,...].unsqueeze(1))
+        img1 = torch.cat([img1, mask], 1)
+        img2 = torch.cat([img2, mask], 1)
+
+    # the TPS of both views is solved once, for the border check of the boxes and for the warps
+    T1, T2 = torch_tps_transform.solve_system(torch.cat([norm_mesh1, norm_mesh2]), torch.cat([norm_rigid_mesh, norm_rigid_mesh])).split(bs)
+    box1, box2 = mesh_boxes([norm_mesh1, norm_mesh2], canvas_h, canvas_w, [T1, T2], [img1.size()[2:], img2.size()[2:]])
+    warp1 = warpers[0](img1, norm_mesh1, norm_rigid_mesh, box1, T1)
+    warp2 = warpers[1](img2, norm_mesh2, norm_rigid_mesh, box2, T2)
+    full1 = _paste(warp1, box1, canvas_h, canvas_w)
+    full2 = _paste(warp2, box2, canvas_h, canvas_w)
+
+    fusion = full1.new_zeros(bs, 3, canvas_h, canvas_w)
+    if fusion_mode == 'AVERAGE':
+        # zero where neither view is warped, the overlap of the boxes is computed twice with the same values
+        for box in (box1, box2):
+            w1, w2 = full1[_box_slice(box)], full2[_box_slice(box)]
+            fusion[_box_slice(box)] = w1 * (w1/ (w1+w2+1e-6)) + w2 * (w2/ (w1+w2+1e-6))
+    else:
+        # outside the support of view 1, the blender gives tgt * tgt_m
+        fusion[_box_slice(box2)] = warp2[:,0:3,...] * warp2[:,3:4,...]
+        # the weights of view 1 are blurred: blend its box grown by the blur radius, with the centroids of the whole masks
+        region = _grow_box(box1, BLUR_KERNEL_SIZE // 2, canvas_h, canvas_w)
+        if warp_mode == 'NORMAL':
+            # NORMAL leaves rounding residuals of its sampler (nonzero mask values) all over the canvas out of the image,
+            # and the centroids count them: the masks alone are warped over the whole canvas to find the same centroids
+            center1_r, center1_c = mask_centroid(torch_tps_transform.transformer(img1[:,3:4,...], norm_mesh1, norm_rigid_mesh, (canvas_h, canvas_w), warp_mode, warpers[0].memory_budget)[:,0])
+            center2_r, center2_c = mask_centroid(torch_tps_transform.transformer(img2[:,3:4,...], norm_mesh2, norm_rigid_mesh, (canvas_h, canvas_w), warp_mode, warpers[1].memory_budget)[:,0])
+        else:
+            # FAST and COARSE are exactly zero out of the boxes
+            center1_r, center1_c = mask_centroid(warp1[:,3,...])
+            center2_r, center2_c = mask_centroid(warp2[:,3,...])
+            center1_r, center1_c, center2_r, center2_c = center1_r + box1[0], center1_c + box1[1], center2_r + box2[0], center2_c + box2[1]
+        centers = (center1_r - region[0], center1_c - region[1], center2_r - region[0], center2_c - region[1])
+        ref, tgt = full1[_box_slice(region)], full2[_box_slice(region)]
+        fusion[_box_slice(region)] = linear_blender(ref[:,0:3,...], tgt[:,0:3,...], ref[:,3:4,...], tgt[:,3:4,...], centers=centers)
+
+    return fusion
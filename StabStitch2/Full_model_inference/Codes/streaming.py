@@ -0,0 +1,256 @@
+# coding: utf-8
+import torch
+import numpy as np
+import cv2
+from collections import deque
+from spatial_network import build_SpatialNet
+from smooth_network import IncrementalSmoothNet
+from feature_cache import FeatureCache
+from device_utils import get_device, module_device
+import utils.torch_tps_transform as torch_tps_transform
+import utils.torch_tps_transform_point as torch_tps_transform_point
+from stitching import stitch_frame, CanvasPlanner
+from video_io import to_uint8_frame
+from geometry import get_rigid_mesh, get_norm_mesh, get_norm_rigid_mesh, recover_mesh
+
+import grid_res
+grid_h = grid_res.GRID_H
+grid_w = grid_res.GRID_W
+
+
+
+class StreamingStabStitcher(object):
+    """
+    Online video stitcher that consumes one frame pair at a time.
+
+    Spatial and temporal motions are estimated as soon as a pair arrives, the
+    last `buffer_len` motions are kept in a rolling window for SmoothNet, and a
+    stitched frame is emitted with a fixed latency of `buffer_len-1` frames.
+    Only the rolling window and the not-yet-rendered frames are kept in memory,
+    so memory stays constant no matter how long the video is.
+
+    The output canvas cannot be planned over the whole video, so it is fixed
+    from the smooth meshes of the first window, or by `canvas_planner` (a
+    stitching.CanvasPlanner, e.g. with a rig envelope or a fixed output size).
+    Content that moves outside this canvas later on is cropped.
+
+    With the canvas planned the same way (CanvasPlanner(frame_num = buffer_len)), the frames
+    match the offline path (estimate_motion, smooth_clip and stitch_frame) up to float rounding
+    of the motions: within a quantization step in AVERAGE mode, and in LINEAR mode except for a
+    few pixels where the blend is steep. Both are quantized by video_io.to_uint8_frame, clamped
+    to 0 ~ 255.
+
+    Usage:
+        stitcher = StreamingStabStitcher(spatial_net, temporal_net, smooth_net)
+        for img1, img2 in frame_pairs:
+            for frame in stitcher.push(img1, img2):
+                writer.write(frame)
+        for frame in stitcher.flush():
+            writer.write(frame)
+    """
+
+    def __init__(self, spatial_net, temporal_net, smooth_net, warp_mode = 'NORMAL', fusion_mode = 'LINEAR', buffer_len = 7, img_h = 360, img_w = 480, device = None, warp_memory = 0, canvas_planner = None):
+
+        self.spatial_net = spatial_net
+        self.temporal_net = temporal_net
+        self.smooth_net = smooth_net
+        self.warp_mode = warp_mode
+        self.fusion_mode = fusion_mode
+        self.buffer_len = buffer_len
+        self.img_h = img_h
+        self.img_w = img_w
+        # memory budget (MB) of the warp, 0 warps the whole canvas at once
+        self.memory_budget = warp_memory * 1024 * 1024 if warp_memory > 0 else None
+        # bounding box of the meshes of the first window unless planned otherwise
+        self.canvas_planner = CanvasPlanner() if canvas_planner is None else canvas_planner
+        # device of the networks unless given explicitly
+        self.device = module_device(spatial_net) if device is None else get_device(device)
+
+        # stage1 features of the current and the previous frame pairs
+        self.feature_cache = FeatureCache(spatial_net, temporal_net, window = 2, view_num = 2, device = self.device)
+
+        self.rigid_mesh = get_rigid_mesh(1, img_h, img_w, self.device)
+        self.norm_rigid_mesh = get_norm_rigid_mesh(1, img_h, img_w, self.device)
+        self.tps_solver = torch_tps_transform_point.get_point_solver(self.norm_rigid_mesh)
+
+        self.reset()
+
+    # number of frames between pushing a pair and getting its stitched frame
+    @property
+    def latency(self):
+        return self.buffer_len - 1
+
+    # (out_width, out_height) of the output canvas, None before it is fixed
+    @property
+    def canvas_size(self):
+        if self.canvas is None:
+            return None
+        return int(self.canvas[2].item()), int(self.canvas[3].item())
+
+    def reset(self):
+
+        self.frame_num = 0
+        self.emit_num = 0
+
+        # previous frame: spatial motions and inputs
+        self.prev_smotion1 = None
+        self.prev_smotion2 = None
+        self.prev_img1_tensor = None
+        self.prev_img2_tensor = None
+        self.feature_cache.clear()
+
+        # rolling window of SmoothNet inputs
+        self.smooth_window = IncrementalSmoothNet(self.smooth_net, self.buffer_len)
+
+        # frames waiting for rendering and their smooth meshes (at 360x480)
+        self.hr_buffer = deque()
+        self.mesh_buffer = deque()
+
+        # width_min, height_min, out_width, out_height
+        self.canvas = None
+        self.hr_norm_rigid_mesh = None
+        self.warpers = None
+
+    def push(self, img1, img2):
+        """
+        Feed one frame pair (BGR uint8 images of shape [H, W, 3] as returned by cv2)
+        and return the list of stitched frames (uint8 [H, W, 3]) that became ready.
+        """
+
+        img1_tensor, img1_hr_tensor = self._prepare(img1)
+        img2_tensor, img2_hr_tensor = self._prepare(img2)
+        self.hr_buffer.append((img1_hr_tensor, img2_hr_tensor))
+
+        with torch.no_grad():
+            self._estimate_motion(img1_tensor, img2_tensor)
+        self.frame_num += 1
+
+        if self.frame_num < self.buffer_len:
+            return []
+
+        if self.frame_num == self.buffer_len:
+            # the first window also yields the smooth meshes of its leading frames
+            self._smooth_all()
+            self._fix_canvas()
+        else:
+            with torch.no_grad():
+                smooth_batch_out = self.smooth_window.smooth_last()
+            self.mesh_buffer.append((smooth_batch_out["smooth_mesh1"], smooth_batch_out["smooth_mesh2"]))
+
+        return [self._render()]
+
+    def flush(self):
+        """
+        Render all the frames that are still buffered. Call it once after the last push.
+        """
+
+        if self.frame_num == 0:
+            return []
+
+        if self.frame_num < self.buffer_len:
+            # the video is shorter than one window: smooth what we have
+            self._smooth_all()
+            self._fix_canvas()
+
+        stable_list = []
+        while len(self.hr_buffer) > 0:
+            stable_list.append(self._render())
+
+        return stable_list
+
+    def _prepare(self, img):
+
+        # get high-resolution input
+        img_hr = img.astype(dtype=np.float32)
+        img_hr = np.transpose(img_hr, [2, 0, 1])
+        img_hr_tensor = torch.tensor(img_hr).unsqueeze(0)
+        # get 360x480 input
+        img = cv2.resize(img, (self.img_w, self.img_h))
+        img = img.astype(dtype=np.float32)
+        img = np.transpose(img, [2, 0, 1])
+        img = (img / 127.5) - 1.0
+        img_tensor = torch.tensor(img).unsqueeze(0).to(self.device)
+
+        return img_tensor, img_hr_tensor
+
+    def _estimate_motion(self, img1_tensor, img2_tensor):
+
+        k = self.frame_num
+
+        # step 1: spatial warp
+        feature_1_64 = self.feature_cache.get('spatial', 0, [k], [img1_tensor])
+        feature_2_64 = self.feature_cache.get('spatial', 1, [k], [img2_tensor])
+        spatial_batch_out = build_SpatialNet(self.spatial_net, img1_tensor, img2_tensor, feature_1_64, feature_2_64)
+        smotion1 = spatial_batch_out['motion1']
+        smotion2 = spatial_batch_out['motion2']
+        smesh1 = self.rigid_mesh + smotion1
+        smesh2 = self.rigid_mesh + smotion2
+
+        # converting tmotion (t-th frame) into tsmotion ( (t-1)-th frame )
+        if k == 0:
+            tsmotion1 = smotion1.clone() * 0
+            tsmotion2 = smotion2.clone() * 0
+        else:
+            # step 2: temporal warp (the previous frame features are still cached)
+            feature1 = self.feature_cache.get('temporal', 0, [k-1, k], [self.prev_img1_tensor, img1_tensor])
+            feature2 = self.feature_cache.get('temporal', 1, [k-1, k], [self.prev_img2_tensor, img2_tensor])
+            tmotion1 = self.temporal_net.regress_motion(feature1[0:1], feature1[1:2])
+            tmotion2 = self.temporal_net.regress_motion(feature2[0:1], feature2[1:2])
+            tsmotion1 = self._get_tsmotion(self.prev_smotion1, tmotion1, smesh1)
+            tsmotion2 = self._get_tsmotion(self.prev_smotion2, tmotion2, smesh2)
+
+        self.smooth_window.push(smesh1, smesh2, tsmotion1, tsmotion2)
+
+        self.prev_smotion1 = smotion1
+        self.prev_smotion2 = smotion2
+        self.prev_img1_tensor = img1_tensor
+        self.prev_img2_tensor = img2_tensor
+
+    def _get_tsmotion(self, prev_smotion, tmotion, smesh):
+
+        smesh_1 = self.rigid_mesh + prev_smotion
+        tmesh = self.rigid_mesh + tmotion
+        norm_smesh_1 = get_norm_mesh(smesh_1, self.img_h, self.img_w)
+        norm_tmesh = get_norm_mesh(tmesh, self.img_h, self.img_w)
+        tsmesh = self.tps_solver(norm_tmesh, norm_smesh_1)
+
+        return recover_mesh(tsmesh, self.img_h, self.img_w) - smesh
+
+    def _smooth_all(self):
+
+        with torch.no_grad():
+            smooth_batch_out = self.smooth_window.smooth_all()
+        smooth_mesh1 = smooth_batch_out["smooth_mesh1"]
+        smooth_mesh2 = smooth_batch_out["smooth_mesh2"]
+        for k in range(smooth_mesh1.shape[1]):
+            self.mesh_buffer.append((smooth_mesh1[:,k], smooth_mesh2[:,k]))
+
+    def _fix_canvas(self):
+
+        batch_size, _, img_h, img_w = self.hr_buffer[0][1].shape
+
+        self.hr_norm_rigid_mesh = get_norm_rigid_mesh(batch_size, img_h, img_w, self.device)
+
+        # one [bs, T, grid_h+1, grid_w+1, 2] tensor per view, resized to the original resolution
+        meshes = [torch.stack([mesh[v] for mesh in self.mesh_buffer], 1) for v in range(2)]
+        meshes = [torch.stack([mesh[...,0]*img_w/self.img_w, mesh[...,1]*img_h/self.img_h], -1) for mesh in meshes]
+
+        self.canvas = self.canvas_planner.plan(meshes)
+        self.warpers = [torch_tps_transform.TPSWarper((self.canvas[3].int(), self.canvas[2].int()), self.warp_mode, self.memory_budget) for _ in range(2)]
+
+    def _render(self):
+
+        img1_hr_tensor, img2_hr_tensor = self.hr_buffer.popleft()
+        mesh1, mesh2 = self.mesh_buffer.popleft()
+        _, _, img_h, img_w = img1_hr_tensor.shape
+
+        # resize the mesh to the original resolution
+        mesh1 = torch.stack([mesh1[...,0]*img_w/self.img_w, mesh1[...,1]*img_h/self.img_h], 3)
+        mesh2 = torch.stack([mesh2[...,0]*img_w/self.img_w, mesh2[...,1]*img_h/self.img_h], 3)
+
+        width_min, height_min, out_width, out_height = self.canvas
+        with torch.no_grad():
+            fusion = stitch_frame(img1_hr_tensor, img2_hr_tensor, mesh1, mesh2, self.hr_norm_rigid_mesh, width_min, height_min, out_width, out_height, self.warp_mode, self.fusion_mode, self.device, self.warpers)
+        self.emit_num += 1
+
+        return to_uint8_frame(fusion[0])
@@ -12,6 +12,7 @@ import torchvision.transforms as T
 import random
 from torch import nn, einsum
 from einops import rearrange
+from device_utils import module_device
 
 import grid_res
 grid_h = grid_res.GRID_H
@@ -20,12 +21,15 @@ grid_w = grid_res.GRID_W
 
 
 
-def build_TemporalNet(net, img_tensor_list):
+# device: where the inputs are moved to, defaults to the device of the network
+def build_TemporalNet(net, img_tensor_list, device=None):
     batch_size, _, img_h, img_w = img_tensor_list[0].size()
     frame_num = len(img_tensor_list)
+    if device is None:
+        device = module_device(net)
 
-    motion_list = net(img_tensor_list)
-    motion_list.insert(0, torch.zeros([batch_size, grid_h+1, grid_w+1,2]).cuda())
+    motion_list = net(img_tensor_list, device)
+    motion_list.insert(0, torch.zeros([batch_size, grid_h+1, grid_w+1,2], device=device))
 
     out_dict = {}
     out_dict.update(motion_list = motion_list)
@@ -34,6 +38,27 @@ def build_TemporalNet(net, img_tensor_list):
     return out_dict
 
 
+# run TemporalNet over several views of the same clip in one pass
+# img_tensor_lists: view_num x (frame_num x [bs, 3, img_h, img_w])
+# frames are processed chunk_size at a time (for all views together) to bound the memory
+# feature_cache: optional FeatureCache shared with SpatialNet, frames are keyed from index `start`
+# device: where the inputs are moved to, defaults to the device of the network
+def build_TemporalNet_batch(net, img_tensor_lists, chunk_size=16, feature_cache=None, start=0, device=None):
+    batch_size, _, img_h, img_w = img_tensor_lists[0][0].size()
+    if device is None:
+        device = module_device(net)
+
+    motion_lists = net.forward_batch(img_tensor_lists, chunk_size, feature_cache, start, device)
+    for motion_list in motion_lists:
+        motion_list.insert(0, torch.zeros([batch_size, grid_h+1, grid_w+1,2], device=device))
+
+    out_dict = {}
+    out_dict.update(motion_lists = motion_lists)
+
+
+    return out_dict
+
+
 
 
 def get_res18_FeatureMap(resnet18_model):
@@ -110,16 +135,20 @@ class TemporalNet(nn.Module):
                 m.weight.data.fill_(1)
                 m.bias.data.zero_()
 
+        # moved together with the other parameters by net.to(device)
         resnet18_model = models.resnet.resnet18(weights="DEFAULT")
-        if torch.cuda.is_available():
-            resnet18_model = resnet18_model.cuda()
         self.feature_extractor_stage1, self.feature_extractor_stage2 = get_res18_FeatureMap(resnet18_model)
 
+        # memory budget (bytes) of the cost volume, None: build it at once with F.unfold
+        self.cost_memory = None
+
 
     # forward
-    def forward(self, img_tensor_list):
+    def forward(self, img_tensor_list, device=None):
         batch_size, _, img_h, img_w = img_tensor_list[0].size()
         frame_num = len(img_tensor_list)
+        if device is None:
+            device = module_device(self)
 
         Mesh_motion_list = []
 
@@ -128,17 +157,12 @@ class TemporalNet(nn.Module):
         feature2 = 0
         for i in range(0, frame_num-1):
             if i == 0 :
-                feature1 = self.feature_extractor_stage1(img_tensor_list[0].cuda())
-                feature2 = self.feature_extractor_stage1(img_tensor_list[1].cuda())
+                feature1 = self.feature_extractor_stage1(img_tensor_list[0].to(device))
+                feature2 = self.feature_extractor_stage1(img_tensor_list[1].to(device))
             else:
-                feature2 = self.feature_extractor_stage1(img_tensor_list[i+1].cuda())
+                feature2 = self.feature_extractor_stage1(img_tensor_list[i+1].to(device))
 
-            # cost volume and regression
-            cv2 = self.cost_volume(feature1, feature2, search_range=3, norm=False)
-            temp_2 = self.regressNet2_part1(cv2)
-            temp_2 = temp_2.view(temp_2.size()[0], -1)
-            offset_2 = self.regressNet2_part2(temp_2)
-            M_motion_2 = offset_2.reshape(-1, grid_h+1, grid_w+1, 2)
+            M_motion_2 = self.regress_motion(feature1, feature2)
 
             Mesh_motion_list.append(M_motion_2)
 
@@ -146,8 +170,65 @@ class TemporalNet(nn.Module):
 
         return Mesh_motion_list
 
+    # batched version of forward over several views
+    # the features of all views are extracted in one stacked pass per chunk of frames,
+    # and all the consecutive pairs of the chunk are regressed as one batch
+    def forward_batch(self, img_tensor_lists, chunk_size=16, feature_cache=None, start=0, device=None):
+        batch_size, _, img_h, img_w = img_tensor_lists[0][0].size()
+        view_num = len(img_tensor_lists)
+        frame_num = len(img_tensor_lists[0])
+        if device is None:
+            device = module_device(self)
+
+        Mesh_motion_lists = [[] for _ in range(view_num)]
+
+        # features of the last frame of the previous chunk: view_num, bs, c, h, w
+        last_feature = None
+        for chunk_start in range(0, frame_num, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, frame_num)
+
+            if feature_cache is None:
+                img_tensor = torch.cat([torch.cat(img_tensor_list[chunk_start:chunk_end], 0) for img_tensor_list in img_tensor_lists], 0).to(device, non_blocking=True)
+                feature = self.feature_extractor_stage1(img_tensor)
+            else:
+                index_list = range(start+chunk_start, start+chunk_end)
+                feature = torch.cat([feature_cache.get('temporal', v, index_list, img_tensor_lists[v][chunk_start:chunk_end]) for v in range(view_num)], 0)
+            _, c, h, w = feature.size()
+            feature = feature.reshape(view_num, chunk_end-chunk_start, batch_size, c, h, w)
+            if last_feature is not None:
+                feature = torch.cat([last_feature.unsqueeze(1), feature], 1)
+            last_feature = feature[:, -1]
+
+            pair_num = feature.size()[1] - 1
+            if pair_num == 0:
+                continue
+            feature1 = feature[:, :-1].reshape(-1, c, h, w)
+            feature2 = feature[:, 1:].reshape(-1, c, h, w)
+            M_motion_2 = self.regress_motion(feature1, feature2)
+            M_motion_2 = M_motion_2.reshape(view_num, pair_num, batch_size, grid_h+1, grid_w+1, 2)
+
+            for v in range(view_num):
+                Mesh_motion_lists[v].extend(torch.unbind(M_motion_2[v], 0))
+
+        return Mesh_motion_lists
+
+    # regress the mesh motion between two adjacent frames from their stage1 features
+    def regress_motion(self, feature1, feature2):
+
+        # cost volume and regression
+        cv2 = self.cost_volume(feature1, feature2, search_range=3, norm=False, memory_budget=self.cost_memory)
+        temp_2 = self.regressNet2_part1(cv2)
+        temp_2 = temp_2.view(temp_2.size()[0], -1)
+        offset_2 = self.regressNet2_part2(temp_2)
+        M_motion_2 = offset_2.reshape(-1, grid_h+1, grid_w+1, 2)
+
+        return M_motion_2
+
     @staticmethod
-    def cost_volume(x1, x2, search_range, norm=True, fast=True):
+    # memory_budget: bytes for the temporaries of the correlation (None: fast or slow as below)
+    # the chunked correlation is only approximately equal to fast: the mean over the channels is reduced
+    # over differently laid-out tensors, so the results differ by float rounding (about 1e-7)
+    def cost_volume(x1, x2, search_range, norm=True, fast=True, memory_budget=None):
         if norm:
             x1 = F.normalize(x1, p=2, dim=1)
             x2 = F.normalize(x2, p=2, dim=1)
@@ -155,7 +236,18 @@ class TemporalNet(nn.Module):
         padded_x2 = F.pad(x2, [search_range] * 4)  # [b,c,h,w] -> [b,c,h+sr*2,w+sr*2]
         max_offset = search_range * 2 + 1
 
-        if fast:
+        if memory_budget is not None:
+            # same as fast, but only a chunk of the max_offset**2 displacements is expanded at a time
+            # (the shifted views and their product with x1: 2 feature maps per displacement)
+            disp_num = max_offset ** 2
+            chunk = max(1, min(disp_num, memory_budget // (2 * x1.element_size() * bs * c * h * w)))
+            cost_vol = x1.new_empty(bs, disp_num, h, w)
+            for start in range(0, disp_num, chunk):
+                end = min(start + chunk, disp_num)
+                # displacement d = j * max_offset + i, the order of F.unfold
+                patches = torch.stack([padded_x2[:, :, d // max_offset:d // max_offset + h, d % max_offset:d % max_offset + w] for d in range(start, end)], 2)
+                cost_vol[:, start:end] = (x1.unsqueeze(2) * patches).mean(dim=1, keepdim=False)
+        elif fast:
             # faster(*2) but cost higher(*n) GPU memory
             patches = F.unfold(padded_x2, (max_offset, max_offset)).reshape(bs, c, max_offset ** 2, h, w)
             cost_vol = (x1.unsqueeze(2) * patches).mean(dim=1, keepdim=False)
@@ -5,8 +5,14 @@ from torch.utils.data import DataLoader
 import torch.nn as nn
 import imageio
 from spatial_network import build_SpatialNet, SpatialNet
+from geometry import get_norm_mesh, get_norm_rigid_mesh
 from temporal_network import build_TemporalNet, TemporalNet
-from smooth_network import build_SmoothNet, SmoothNet
+from smooth_network import build_SmoothNet, SmoothNet, smooth_clip, get_tsmotion_clip
+from feature_cache import FeatureCache, estimate_motion
+from device_utils import get_device, set_num_threads
+from blending import linear_blender
+from frame_source import FrameSource
+from video_io import find_view
 import os
 import numpy as np
 import skimage
@@ -16,7 +22,6 @@ import utils.torch_tps_transform_point as torch_tps_transform_point
 from PIL import Image
 import glob
 import time
-from torchvision.transforms import GaussianBlur
 import torch.nn.functional as F
 
 import matplotlib.pyplot as plt
@@ -86,92 +91,36 @@ def intra_grid_loss(pts):
 
     return loss
 
-def linear_blender(ref, tgt, ref_m, tgt_m, mask=False):
-    blur = GaussianBlur(kernel_size=(21,21), sigma=20)
-    r1, c1 = torch.nonzero(ref_m[0, 0], as_tuple=True)
-    r2, c2 = torch.nonzero(tgt_m[0, 0], as_tuple=True)
-
-    center1 = (r1.float().mean(), c1.float().mean())
-    center2 = (r2.float().mean(), c2.float().mean())
-
-    vec = (center2[0] - center1[0], center2[1] - center1[1])
-
-    ovl = (ref_m * tgt_m).round()[:, 0].unsqueeze(1)
-    ref_m_ = ref_m[:, 0].unsqueeze(1) - ovl
-    r, c = torch.nonzero(ovl[0, 0], as_tuple=True)
-
-    ovl_mask = torch.zeros_like(ref_m_).cuda()
-    proj_val = (r - center1[0]) * vec[0] + (c - center1[1]) * vec[1]
-    ovl_mask[ovl.bool()] = (proj_val - proj_val.min()) / (proj_val.max() - proj_val.min() + 1e-3)
-
-    mask1 = (blur(ref_m_ + (1-ovl_mask)*ref_m[:,0].unsqueeze(1)) * ref_m + ref_m_).clamp(0,1)
-    if mask: return mask1
-
-    mask2 = (1-mask1) * tgt_m
-    stit = ref * mask1 + tgt * mask2
-
-    return stit
-
-
-def recover_mesh(norm_mesh, height, width):
-    #from [bs, pn, 2] to [bs, grid_h+1, grid_w+1, 2]
-
-    batch_size = norm_mesh.size()[0]
-    mesh_w = (norm_mesh[...,0]+1) * float(width) / 2.
-    mesh_h = (norm_mesh[...,1]+1) * float(height) / 2.
-    mesh = torch.stack([mesh_w, mesh_h], 2) # [bs,(grid_h+1)*(grid_w+1),2]
-
-    return mesh.reshape([batch_size, grid_h+1, grid_w+1, 2])
-
-def get_rigid_mesh(batch_size, height, width):
-
-
-    ww = torch.matmul(torch.ones([grid_h+1, 1]), torch.unsqueeze(torch.linspace(0., float(width), grid_w+1), 0))
-    hh = torch.matmul(torch.unsqueeze(torch.linspace(0.0, float(height), grid_h+1), 1), torch.ones([1, grid_w+1]))
-    if torch.cuda.is_available():
-        ww = ww.cuda()
-        hh = hh.cuda()
-
-    ori_pt = torch.cat((ww.unsqueeze(2), hh.unsqueeze(2)),2) # (grid_h+1)*(grid_w+1)*2
-    ori_pt = ori_pt.unsqueeze(0).expand(batch_size, -1, -1, -1)
-
-    return ori_pt
-
-def get_norm_mesh(mesh, height, width):
-    batch_size = mesh.size()[0]
-    mesh_w = mesh[...,0]*2./float(width) - 1.
-    mesh_h = mesh[...,1]*2./float(height) - 1.
-    norm_mesh = torch.stack([mesh_w, mesh_h], 3) # bs*(grid_h+1)*(grid_w+1)*2
-
-    return norm_mesh.reshape([batch_size, -1, 2]) # bs*-1*2
-
-
-
 # bs, T, h, w, 2  smooth_path
-def get_stable_sqe(img1_list, img2_list, smooth_mesh1, smooth_mesh2):
+# device: where the frames are warped, defaults to the device of the meshes
+def get_stable_sqe(img1_list, img2_list, smooth_mesh1, smooth_mesh2, device=None):
     batch_size, _, img_h, img_w = img2_list[0].shape
     print(img2_list[0].shape)
+    if device is None:
+        device = smooth_mesh1.device
 
-    rigid_mesh = get_rigid_mesh(batch_size, img_h, img_w)
-    norm_rigid_mesh = get_norm_mesh(rigid_mesh, img_h, img_w)
+    norm_rigid_mesh = get_norm_rigid_mesh(batch_size, img_h, img_w, device)
 
 
     stable_list1 = []
     stable_list2 = []
+    # one warper per view reuses the TPS pixel grid across frames
+    warper1 = torch_tps_transform.TPSWarper((img_h, img_w), 'NORMAL')
+    warper2 = torch_tps_transform.TPSWarper((img_h, img_w), 'NORMAL')
     # mesh_tran_list = []
     for i in range(len(img2_list)):
 
         mesh1 = smooth_mesh1[:,i,:,:,:]
         norm_mesh1 = get_norm_mesh(mesh1, img_h, img_w)
-        img1 = (img1_list[i].cuda()+1)*127.5
+        img1 = (img1_list[i].to(device, non_blocking=True)+1)*127.5
 
         mesh2 = smooth_mesh2[:,i,:,:,:]
         norm_mesh2 = get_norm_mesh(mesh2, img_h, img_w)
-        img2 = (img2_list[i].cuda()+1)*127.5
+        img2 = (img2_list[i].to(device, non_blocking=True)+1)*127.5
 
-        mask = torch.ones_like(img2).cuda()
-        img1_warp = torch_tps_transform.transformer(torch.cat([img1, mask], 1), norm_mesh1, norm_rigid_mesh, (img_h, img_w), mode = 'NORMAL')
-        img2_warp = torch_tps_transform.transformer(torch.cat([img2, mask], 1), norm_mesh2, norm_rigid_mesh, (img_h, img_w), mode = 'NORMAL')
+        mask = torch.ones_like(img2)
+        img1_warp = warper1(torch.cat([img1, mask], 1), norm_mesh1, norm_rigid_mesh)
+        img2_warp = warper2(torch.cat([img2, mask], 1), norm_mesh2, norm_rigid_mesh)
 
         stable_list1.append(img1_warp[0].cpu().detach().numpy().transpose(1,2,0))
         stable_list2.append(img2_warp[0].cpu().detach().numpy().transpose(1,2,0))
@@ -191,10 +140,13 @@ def test(args):
     spatial_net = SpatialNet()
     temporal_net = TemporalNet()
     smooth_net = SmoothNet()
-    if torch.cuda.is_available():
-        spatial_net = spatial_net.cuda()
-        temporal_net = temporal_net.cuda()
-        smooth_net = smooth_net.cuda()
+    device = get_device(args.device)
+    print("device: {}, threads: {}".format(device, set_num_threads(args.num_threads)))
+    spatial_net = spatial_net.to(device)
+    temporal_net = temporal_net.to(device)
+    smooth_net = smooth_net.to(device)
+    if args.cost_memory > 0:
+        spatial_net.cost_memory = temporal_net.cost_memory = args.cost_memory * 1024 * 1024
 
     #load the existing models if it exists
     ckpt_list = glob.glob(MODEL_DIR + "/*.pth")
@@ -202,17 +154,17 @@ def test(args):
     if len(ckpt_list) == 3:
         # load spatial warp model
         spatial_model_path = MODEL_DIR + "/spatial_warp.pth"
-        spatial_checkpoint = torch.load(spatial_model_path)
+        spatial_checkpoint = torch.load(spatial_model_path, map_location=device)
         spatial_net.load_state_dict(spatial_checkpoint['model'])
         print('load model from {}!'.format(spatial_model_path))
         # load temporal warp model
         temporal_model_path = MODEL_DIR + "/temporal_warp.pth"
-        temporal_checkpoint = torch.load(temporal_model_path)
+        temporal_checkpoint = torch.load(temporal_model_path, map_location=device)
         temporal_net.load_state_dict(temporal_checkpoint['model'])
         print('load model from {}!'.format(temporal_model_path))
         # load smooth warp model
         smooth_model_path = MODEL_DIR + "/smooth_warp.pth"
-        smooth_checkpoint = torch.load(smooth_model_path)
+        smooth_checkpoint = torch.load(smooth_model_path, map_location=device)
         smooth_net.load_state_dict(smooth_checkpoint['model'])
         print('load model from {}!'.format(smooth_model_path))
     else:
@@ -224,6 +176,10 @@ def test(args):
     temporal_net.eval()
     smooth_net.eval()
 
+    # stage1 features shared by SpatialNet and TemporalNet (if their stems are identical)
+    feature_cache = FeatureCache(spatial_net, temporal_net, window = args.chunk_size + 1, view_num = 2, device = device)
+    print("shared stage1 features: {}".format(feature_cache.shared))
+
     print("##################start testing#######################")
 
 
@@ -274,11 +230,9 @@ def test(args):
         tmotion_tensor_list2 = []
         smotion_tensor_list2 = []
 
-        # img name list
-        img1_name_list = glob.glob(os.path.join(video_name_list[i]+ "/video1/", '*.jpg'))
-        img2_name_list = glob.glob(os.path.join(video_name_list[i]+ "/video2/", '*.jpg'))
-        img1_name_list = sorted(img1_name_list)
-        img2_name_list = sorted(img2_name_list)
+        # input views: folders of .jpg frames, or video files (e.g. video1.mp4) decoded on the fly (see video_io.find_view)
+        img1_view = find_view(video_name_list[i], "video1")
+        img2_view = find_view(video_name_list[i], "video2")
 
 
         #img1_list = []
@@ -287,44 +241,28 @@ def test(args):
 
         img_h = 360
         img_w = 480
-        # load imgs
-        for k in range(0, len(img2_name_list)):
-            img1 = cv2.imread(img1_name_list[k])
-            img1 = cv2.resize(img1, (img_w, img_h))
-            img1 = img1.astype(dtype=np.float32)
-            img1 = np.transpose(img1, [2, 0, 1])
-            img1 = (img1 / 127.5) - 1.0
-            img1_tensor = torch.tensor(img1).unsqueeze(0)
-            img1_tensor_list.append(img1_tensor)
-
-            img2 = cv2.imread(img2_name_list[k])
-            img2 = cv2.resize(img2, (img_w, img_h))
-            img2 = img2.astype(dtype=np.float32)
-            img2 = np.transpose(img2, [2, 0, 1])
-            img2 = (img2 / 127.5) - 1.0
-            img2_tensor = torch.tensor(img2).unsqueeze(0)
-            img2_tensor_list.append(img2_tensor)
+        # load imgs: 360x480 inputs decoded by a pool of threads ahead of their use (see frame_source.FrameSource)
+        # the views are read in lockstep, up to the end of the shortest one
+        img1_source = FrameSource(img1_view, num_workers = args.decode_workers)
+        img2_source = FrameSource(img2_view, num_workers = args.decode_workers)
+        for (img1_tensor, _), (img2_tensor, _) in zip(img1_source, img2_source):
+            img1_tensor_list.append(img1_tensor.unsqueeze(0))
+            img2_tensor_list.append(img2_tensor.unsqueeze(0))
+        NOF = len(img2_tensor_list)
 
 
         start_time1 = time.time()
-        NOF = len(img2_name_list)
         # motion estimation
-        for k in range(0, len(img2_name_list)):
-
-            # step 1: spatial warp
-            with torch.no_grad():
-                spatial_batch_out = build_SpatialNet(spatial_net, img1_tensor_list[k].cuda(), img2_tensor_list[k].cuda())
-            smotion1 = spatial_batch_out['motion1']
-            smotion2 = spatial_batch_out['motion2']
-            smotion_tensor_list1.append(smotion1)
-            smotion_tensor_list2.append(smotion2)
-
-        # step 2: temporal warp
+        # step 1 & 2: spatial and temporal warp, batched over chunks of frames and sharing the stage1 features
+        feature_cache.clear()
         with torch.no_grad():
-            temporal_batch_out1 = build_TemporalNet(temporal_net, img1_tensor_list)
-            temporal_batch_out2 = build_TemporalNet(temporal_net, img2_tensor_list)
-        tmotion_tensor_list1 = temporal_batch_out1['motion_list']
-        tmotion_tensor_list2 = temporal_batch_out2['motion_list']
+            motion_batch_out = estimate_motion(spatial_net, temporal_net, img1_tensor_list, img2_tensor_list, args.chunk_size, feature_cache, device)
+        smotion_tensor_list1 = motion_batch_out['smotion_list1']
+        smotion_tensor_list2 = motion_batch_out['smotion_list2']
+        tmotion_tensor_list1 = motion_batch_out['tmotion_list1']
+        tmotion_tensor_list2 = motion_batch_out['tmotion_list2']
+        print("feature cache hit rate:")
+        print(feature_cache.hit_rate)
 
 
         print("fps (spatial & temporal warp):")
@@ -334,106 +272,30 @@ def test(args):
         ##############################################
         #############   data preparation  ############
         # converting tmotion (t-th frame) into tsmotion ( (t-1)-th frame )
-        rigid_mesh = get_rigid_mesh(1, img_h, img_w)
-        norm_rigid_mesh = get_norm_mesh(rigid_mesh, img_h, img_w)
-        smesh_list1 = []
-        smesh_list2 = []
-        tsmotion_list1 = []
-        tsmotion_list2 = []
-        for k in range(len(tmotion_tensor_list1)):
-            smotion1 = smotion_tensor_list1[k]
-            smesh1 = rigid_mesh + smotion1
-            smotion2 = smotion_tensor_list2[k]
-            smesh2 = rigid_mesh + smotion2
-            if k == 0:
-                tsmotion1 = smotion1.clone() * 0
-                tsmotion2 = smotion2.clone() * 0
-            else:
-                smotion1_1 = smotion_tensor_list1[k-1]
-                smesh1_1 = rigid_mesh + smotion1_1
-                tmotion1 = tmotion_tensor_list1[k]
-                tmesh1 = rigid_mesh + tmotion1
-                norm_smesh1_1 = get_norm_mesh(smesh1_1, img_h, img_w)
-                norm_tmesh1 = get_norm_mesh(tmesh1, img_h, img_w)
-                tsmesh1 = torch_tps_transform_point.transformer(norm_tmesh1, norm_rigid_mesh, norm_smesh1_1)
-                tsmotion1 = recover_mesh(tsmesh1, img_h, img_w) - smesh1
-
-                smotion2_1 = smotion_tensor_list2[k-1]
-                smesh2_1 = rigid_mesh + smotion2_1
-                tmotion2 = tmotion_tensor_list2[k]
-                tmesh2 = rigid_mesh + tmotion2
-                norm_smesh2_1 = get_norm_mesh(smesh2_1, img_h, img_w)
-                norm_tmesh2 = get_norm_mesh(tmesh2, img_h, img_w)
-                tsmesh2 = torch_tps_transform_point.transformer(norm_tmesh2, norm_rigid_mesh, norm_smesh2_1)
-                tsmotion2 = recover_mesh(tsmesh2, img_h, img_w) - smesh2
-
-
-            # append
-            smesh_list1.append(smesh1)
-            smesh_list2.append(smesh2)
-            tsmotion_list1.append(tsmotion1)
-            tsmotion_list2.append(tsmotion2)
+        # all frames of both views are converted in one batched pass
+        smesh1, smesh2, tsmotion1, tsmotion2 = get_tsmotion_clip(torch.cat(smotion_tensor_list1, 0), torch.cat(smotion_tensor_list2, 0),
+                                                                 torch.cat(tmotion_tensor_list1, 0), torch.cat(tmotion_tensor_list2, 0), img_h, img_w)
+        # T x [1, h, w, 2]
+        smesh_list1 = smesh1.split(1, 0)
+        smesh_list2 = smesh2.split(1, 0)
+        tsmotion_list1 = tsmotion1.split(1, 0)
+        tsmotion_list2 = tsmotion2.split(1, 0)
 
 
         # step 3: smooth warp
-        ori_mesh1 = 0
-        smooth_mesh1 = 0
-        delta_motion1 = 0
-
-        ori_mesh2 = 0
-        smooth_mesh2 = 0
-        delta_motion2 = 0
-
-        # ori_path
-        ori_path2 = 0
-        smooth_path2 = 0
-
-
-        for k in range(len(tmotion_tensor_list1)-6):
-
-            tsmotion_sublist1 = tsmotion_list1[k:k+7]
-            tsmotion_sublist1[0] = tsmotion_sublist1[0] * 0
-
-            tsmotion_sublist2 = tsmotion_list2[k:k+7]
-            tsmotion_sublist2[0] = tsmotion_sublist2[0] * 0
-
-
-            with torch.no_grad():
-                smooth_batch_out = build_SmoothNet(smooth_net, tsmotion_sublist1, tsmotion_sublist2, smesh_list1[k:k+7], smesh_list2[k:k+7])
-
-            _ori_mesh1 = smooth_batch_out["ori_mesh1"]
-            _smooth_mesh1 = smooth_batch_out["smooth_mesh1"]
-
-            _ori_mesh2 = smooth_batch_out["ori_mesh2"]
-            _smooth_mesh2 = smooth_batch_out["smooth_mesh2"]
-
-            _ori_path2 = smooth_batch_out["ori_path2"]
-            _smooth_path2 = smooth_batch_out["smooth_path2"]
-
-
-            if k == 0:
-                ori_mesh1 = _ori_mesh1
-                smooth_mesh1 = _smooth_mesh1
-
-                ori_mesh2 = _ori_mesh2
-                smooth_mesh2 = _smooth_mesh2
-
-                ori_path2 = _ori_path2
-                smooth_path2 = _smooth_path2
+        # sliding window of 7 frames, the windows are evaluated in batches of smooth_chunk
+        with torch.no_grad():
+            smooth_batch_out = smooth_clip(smooth_net, tsmotion_list1, tsmotion_list2, smesh_list1, smesh_list2, buffer_len = 7, chunk_size = args.smooth_chunk)
 
-            else:
-                # for ref
-                ori_mesh1 = torch.cat((ori_mesh1, _ori_mesh1[:,-1,...].unsqueeze(1)), 1)
-                smooth_mesh1 = torch.cat((smooth_mesh1, _smooth_mesh1[:,-1,...].unsqueeze(1)), 1)
+        ori_mesh1 = smooth_batch_out["ori_mesh1"]
+        smooth_mesh1 = smooth_batch_out["smooth_mesh1"]
 
-                # for tgt
-                ori_mesh2 = torch.cat((ori_mesh2, _ori_mesh2[:,-1,...].unsqueeze(1)), 1)
-                smooth_mesh2 = torch.cat((smooth_mesh2, _smooth_mesh2[:,-1,...].unsqueeze(1)), 1)
+        ori_mesh2 = smooth_batch_out["ori_mesh2"]
+        smooth_mesh2 = smooth_batch_out["smooth_mesh2"]
 
-                new_ori_path2 = ori_path2[:,-1,...] + (_ori_path2[:,-1,...] - _ori_path2[:,-2,...])
-                ori_path2 = torch.cat((ori_path2, new_ori_path2.unsqueeze(1)), 1)
-                new_smooth_path2 = ori_path2[:,-1,...] + (_smooth_path2[:,-1,...] - _ori_path2[:,-1,...])
-                smooth_path2 = torch.cat((smooth_path2, new_smooth_path2.unsqueeze(1)), 1)
+        # ori_path
+        ori_path2 = smooth_batch_out["ori_path2"]
+        smooth_path2 = smooth_batch_out["smooth_path2"]
 
 
         print("fps (smooth warp):")
@@ -503,7 +365,7 @@ def test(args):
         ####################################################################
 
 
-        stable_list1, stable_list2 = get_stable_sqe(img1_tensor_list, img2_tensor_list, smooth_mesh1, smooth_mesh2)
+        stable_list1, stable_list2 = get_stable_sqe(img1_tensor_list, img2_tensor_list, smooth_mesh1, smooth_mesh2, device)
 
 
         print("fps (warping & average blending):")
@@ -582,6 +444,18 @@ if __name__=="__main__":
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--gpu', type=str, default='0')
+    # 'cpu', 'cuda' or 'cuda:N' (default: cuda if available, otherwise cpu)
+    parser.add_argument('--device', type=str, default=None)
+    # number of cpu threads for intra-op parallelism (0: torch default)
+    parser.add_argument('--num_threads', type=int, default=0)
+    # number of frames per motion estimation chunk (SpatialNet batch and TemporalNet chunk)
+    parser.add_argument('--chunk_size', type=int, default=8)
+    # number of threads decoding the 360x480 input frames
+    parser.add_argument('--decode_workers', type=int, default=4)
+    # memory budget (MB) of the SpatialNet/TemporalNet cost volumes, computed in displacement chunks that fit into it (0: all at once)
+    parser.add_argument('--cost_memory', type=int, default=0)
+    # number of 7-frame SmoothNet windows evaluated in one batch
+    parser.add_argument('--smooth_chunk', type=int, default=64)
     parser.add_argument('--test_path', type=str, default='/opt/data/private/nl/Data/StabStitch-D/testing/')
 
 
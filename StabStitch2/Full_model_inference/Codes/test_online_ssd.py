@@ -5,8 +5,14 @@ from torch.utils.data import DataLoader
 import torch.nn as nn
 import imageio
 from spatial_network import build_SpatialNet, SpatialNet
+from geometry import get_norm_rigid_mesh
 from temporal_network import build_TemporalNet, TemporalNet
-from smooth_network import build_SmoothNet, SmoothNet
+from smooth_network import build_SmoothNet, SmoothNet, smooth_clip, get_tsmotion_clip
+from feature_cache import FeatureCache, estimate_motion
+from device_utils import get_device, set_num_threads
+from stitching import stitch_frame, CanvasPlanner
+from video_io import AsyncVideoWriter, find_view, LazyFrameList, to_uint8_frame
+from frame_source import FrameSource
 import os
 import numpy as np
 import skimage
@@ -16,7 +22,6 @@ import utils.torch_tps_transform_point as torch_tps_transform_point
 from PIL import Image
 import glob
 import time
-from torchvision.transforms import GaussianBlur
 
 import grid_res
 grid_h = grid_res.GRID_H
@@ -33,125 +38,50 @@ print("MODEL_DIR: ", MODEL_DIR)
 
 
 
-def linear_blender(ref, tgt, ref_m, tgt_m, mask=False):
-    blur = GaussianBlur(kernel_size=(21,21), sigma=20)
-    r1, c1 = torch.nonzero(ref_m[0, 0], as_tuple=True)
-    r2, c2 = torch.nonzero(tgt_m[0, 0], as_tuple=True)
-
-    center1 = (r1.float().mean(), c1.float().mean())
-    center2 = (r2.float().mean(), c2.float().mean())
-
-    vec = (center2[0] - center1[0], center2[1] - center1[1])
-
-    ovl = (ref_m * tgt_m).round()[:, 0].unsqueeze(1)
-    ref_m_ = ref_m[:, 0].unsqueeze(1) - ovl
-    r, c = torch.nonzero(ovl[0, 0], as_tuple=True)
-
-    ovl_mask = torch.zeros_like(ref_m_).cuda()
-    proj_val = (r - center1[0]) * vec[0] + (c - center1[1]) * vec[1]
-    ovl_mask[ovl.bool()] = (proj_val - proj_val.min()) / (proj_val.max() - proj_val.min() + 1e-3)
-
-    mask1 = (blur(ref_m_ + (1-ovl_mask)*ref_m[:,0].unsqueeze(1)) * ref_m + ref_m_).clamp(0,1)
-    if mask: return mask1
-
-    mask2 = (1-mask1) * tgt_m
-    stit = ref * mask1 + tgt * mask2
-
-    return stit
-
-
-def recover_mesh(norm_mesh, height, width):
-    #from [bs, pn, 2] to [bs, grid_h+1, grid_w+1, 2]
-
-    batch_size = norm_mesh.size()[0]
-    mesh_w = (norm_mesh[...,0]+1) * float(width) / 2.
-    mesh_h = (norm_mesh[...,1]+1) * float(height) / 2.
-    mesh = torch.stack([mesh_w, mesh_h], 2) # [bs,(grid_h+1)*(grid_w+1),2]
-
-    return mesh.reshape([batch_size, grid_h+1, grid_w+1, 2])
-
-def get_rigid_mesh(batch_size, height, width):
-
-
-    ww = torch.matmul(torch.ones([grid_h+1, 1]), torch.unsqueeze(torch.linspace(0., float(width), grid_w+1), 0))
-    hh = torch.matmul(torch.unsqueeze(torch.linspace(0.0, float(height), grid_h+1), 1), torch.ones([1, grid_w+1]))
-    if torch.cuda.is_available():
-        ww = ww.cuda()
-        hh = hh.cuda()
-
-    ori_pt = torch.cat((ww.unsqueeze(2), hh.unsqueeze(2)),2) # (grid_h+1)*(grid_w+1)*2
-    ori_pt = ori_pt.unsqueeze(0).expand(batch_size, -1, -1, -1)
-
-    return ori_pt
-
-def get_norm_mesh(mesh, height, width):
-    batch_size = mesh.size()[0]
-    mesh_w = mesh[...,0]*2./float(width) - 1.
-    mesh_h = mesh[...,1]*2./float(height) - 1.
-    norm_mesh = torch.stack([mesh_w, mesh_h], 3) # bs*(grid_h+1)*(grid_w+1)*2
-
-    return norm_mesh.reshape([batch_size, -1, 2]) # bs*-1*2
-
-
-
 # bs, T, h, w, 2  smooth_path
-def get_stable_sqe(img1_list, img2_list, smooth_mesh1, smooth_mesh2, warp_mode, fusion_mode):
+# device: where the frames are warped, defaults to the device of the meshes
+# warp_memory: memory budget (MB) of the warp, 0 for no tiling
+# canvas_planner: CanvasPlanner fixing the output canvas, None for the bounding box of the whole clip
+# open_writer: optional callable (out_width, out_height) -> video writer (e.g. video_io.AsyncVideoWriter), the frames
+#   are written as soon as they are rendered and the writer is released at the end, instead of returning them
+def get_stable_sqe(img1_list, img2_list, smooth_mesh1, smooth_mesh2, warp_mode, fusion_mode, device=None, warp_memory=0, canvas_planner=None, open_writer=None):
     batch_size, _, img_h, img_w = img2_list[0].shape
     print(img2_list[0].shape)
+    if device is None:
+        device = smooth_mesh1.device
 
-    rigid_mesh = get_rigid_mesh(batch_size, img_h, img_w)
-    norm_rigid_mesh = get_norm_mesh(rigid_mesh, img_h, img_w)
+    norm_rigid_mesh = get_norm_rigid_mesh(batch_size, img_h, img_w, device)
 
     smooth_mesh1 = torch.stack([smooth_mesh1[...,0]*img_w/480, smooth_mesh1[...,1]*img_h/360], 4)
     smooth_mesh2 = torch.stack([smooth_mesh2[...,0]*img_w/480, smooth_mesh2[...,1]*img_h/360], 4)
 
-    width_max1 = torch.max(torch.max(smooth_mesh1[...,0]))
-    width_max2 = torch.max(torch.max(smooth_mesh2[...,0]))
-    width_max = torch.maximum(width_max1, width_max2)
-    width_min1 = torch.min(smooth_mesh1[...,0])
-    width_min2 = torch.min(smooth_mesh2[...,0])
-    width_min = torch.minimum(width_min1, width_min2)
-    height_max1 = torch.max(smooth_mesh1[...,1])
-    height_max2 = torch.max(smooth_mesh2[...,1])
-    height_max = torch.maximum(height_max1, height_max2)
-    height_min1 = torch.min(smooth_mesh1[...,1])
-    height_min2 = torch.min(smooth_mesh2[...,1])
-    height_min = torch.minimum(height_min1, height_min2)
-
-    out_width = width_max - width_min
-    out_height = height_max - height_min
+    # bounding box of all the meshes unless planned otherwise (see CanvasPlanner)
+    if canvas_planner is None:
+        canvas_planner = CanvasPlanner()
+    width_min, height_min, out_width, out_height = canvas_planner.plan([smooth_mesh1, smooth_mesh2])
 
     print(out_width)
     print(out_height)
 
     stable_list = []
 
+    memory_budget = warp_memory * 1024 * 1024 if warp_memory > 0 else None
+    # the canvas is fixed for the whole clip: reuse the TPS pixel grid across frames
+    warpers = [torch_tps_transform.TPSWarper((out_height.int(), out_width.int()), warp_mode, memory_budget) for _ in range(2)]
+    writer = None if open_writer is None else open_writer(int(out_width.int()), int(out_height.int()))
     for i in range(len(img2_list)):
 
-        mesh1 = smooth_mesh1[:,i,:,:,:]
-        mesh_trans1 = torch.stack([mesh1[...,0]-width_min, mesh1[...,1]-height_min], 3)
-        norm_mesh1 = get_norm_mesh(mesh_trans1, out_height, out_width)
-        img1 = img1_list[i].cuda()
-
-        mesh2 = smooth_mesh2[:,i,:,:,:]
-        mesh_trans2 = torch.stack([mesh2[...,0]-width_min, mesh2[...,1]-height_min], 3)
-        norm_mesh2 = get_norm_mesh(mesh_trans2, out_height, out_width)
-        img2 = img2_list[i].cuda()
-
-        if fusion_mode == 'AVERAGE':
-            img_warp = torch_tps_transform.transformer(torch.cat([img1, img2], 0), torch.cat([norm_mesh1, norm_mesh2], 0), torch.cat([norm_rigid_mesh, norm_rigid_mesh], 0), (out_height.int(), out_width.int()), mode = warp_mode)
+        fusion = stitch_frame(img1_list[i], img2_list[i], smooth_mesh1[:,i,:,:,:], smooth_mesh2[:,i,:,:,:], norm_rigid_mesh, width_min, height_min, out_width, out_height, warp_mode, fusion_mode, device, warpers)
 
-            fusion = img_warp[0] * (img_warp[0]/ (img_warp[0]+img_warp[1]+1e-6)) + img_warp[1] * (img_warp[1]/ (img_warp[0]+img_warp[1]+1e-6))
+        # uint8 HWC frames, quantized on the device
+        frame = to_uint8_frame(fusion[0])
+        if writer is None:
+            stable_list.append(frame)
         else:
-            mask = torch.ones_like(img1[:,0,...].unsqueeze(1)).cuda()
-            img1 = torch.cat([img1, mask], 1)
-            img2 = torch.cat([img2, mask], 1)
-            img_warp = torch_tps_transform.transformer(torch.cat([img1, img2], 0), torch.cat([norm_mesh1, norm_mesh2], 0), torch.cat([norm_rigid_mesh, norm_rigid_mesh], 0), (out_height.int(), out_width.int()), mode = warp_mode)
+            writer.write(frame)
 
-            fusion = linear_blender(img_warp[0,0:3,...].unsqueeze(0), img_warp[1,0:3,...].unsqueeze(0), img_warp[0,3,...].unsqueeze(0).unsqueeze(0), img_warp[1,3,...].unsqueeze(0).unsqueeze(0))
-            fusion = fusion[0]
-
-        stable_list.append(fusion.cpu().numpy().transpose(1,2,0))
+    if writer is not None:
+        writer.release()
 
     return stable_list, out_width.int(), out_height.int()
 
@@ -166,10 +96,14 @@ def test(args):
     spatial_net = SpatialNet()
     temporal_net = TemporalNet()
     smooth_net = SmoothNet()
-    if torch.cuda.is_available():
-        spatial_net = spatial_net.cuda()
-        temporal_net = temporal_net.cuda()
-        smooth_net = smooth_net.cuda()
+    device = get_device(args.device)
+    print("device: {}, threads: {}".format(device, set_num_threads(args.num_threads)))
+    spatial_net = spatial_net.to(device)
+    temporal_net = temporal_net.to(device)
+    smooth_net = smooth_net.to(device)
+    if args.cost_memory > 0:
+        spatial_net.cost_memory = temporal_net.cost_memory = args.cost_memory * 1024 * 1024
+    canvas_planner = CanvasPlanner(args.canvas_frames, args.canvas_envelope, args.canvas_outlier, args.canvas_size)
 
     #load the existing models if it exists
     ckpt_list = glob.glob(MODEL_DIR + "/*.pth")
@@ -178,17 +112,17 @@ def test(args):
     if len(ckpt_list) == 3:
         # load spatial warp model
         spatial_model_path = MODEL_DIR + "/spatial_warp.pth"
-        spatial_checkpoint = torch.load(spatial_model_path)
+        spatial_checkpoint = torch.load(spatial_model_path, map_location=device)
         spatial_net.load_state_dict(spatial_checkpoint['model'])
         print('load model from {}!'.format(spatial_model_path))
         # load temporal warp model
         temporal_model_path = MODEL_DIR + "/temporal_warp.pth"
-        temporal_checkpoint = torch.load(temporal_model_path)
+        temporal_checkpoint = torch.load(temporal_model_path, map_location=device)
         temporal_net.load_state_dict(temporal_checkpoint['model'])
         print('load model from {}!'.format(temporal_model_path))
         # load smooth warp model
         smooth_model_path = MODEL_DIR + "/smooth_warp.pth"
-        smooth_checkpoint = torch.load(smooth_model_path)
+        smooth_checkpoint = torch.load(smooth_model_path, map_location=device)
         smooth_net.load_state_dict(smooth_checkpoint['model'])
         print('load model from {}!'.format(smooth_model_path))
     else:
@@ -202,6 +136,10 @@ def test(args):
     temporal_net.eval()
     smooth_net.eval()
 
+    # stage1 features shared by SpatialNet and TemporalNet (if their stems are identical)
+    feature_cache = FeatureCache(spatial_net, temporal_net, window = args.chunk_size + 1, view_num = 2, device = device)
+    print("shared stage1 features: {}".format(feature_cache.shared))
+
     print("##################start testing#######################")
 
     video_name_list = glob.glob(os.path.join(args.test_path, '*'))
@@ -224,14 +162,9 @@ def test(args):
         tmotion_tensor_list2 = []
         smotion_tensor_list2 = []
 
-        # img name list
-        img1_name_list = glob.glob(os.path.join(video_name_list[i]+ "/video1/", '*.jpg'))
-        img2_name_list = glob.glob(os.path.join(video_name_list[i]+ "/video2/", '*.jpg'))
-        img1_name_list = sorted(img1_name_list)
-        img2_name_list = sorted(img2_name_list)
-
-        print(len(img1_name_list))
-        print(len(img2_name_list))
+        # input views: folders of .jpg frames, or video files (e.g. video1.mp4) decoded on the fly (see video_io.find_view)
+        img1_view = find_view(video_name_list[i], "video1")
+        img2_view = find_view(video_name_list[i], "video2")
 
         # prepare folders
         if not os.path.exists(args.output_path):
@@ -245,62 +178,39 @@ def test(args):
 
         img1_tensor_list = []
         img2_tensor_list = []
-        img1_hr_tensor_list = []
-        img2_hr_tensor_list = []
 
         img_h = 360
         img_w = 480
-        # load imgs
-        for k in range(0, len(img2_name_list)):
-
-            img1 = cv2.imread(img1_name_list[k])
-            # get high-resolution input
-            img1_hr = img1.astype(dtype=np.float32)
-            img1_hr = np.transpose(img1_hr, [2, 0, 1])
-            img1_hr_tensor = torch.tensor(img1_hr).unsqueeze(0)
-            img1_hr_tensor_list.append(img1_hr_tensor)
-            # get 360x480 input
-            img1 = cv2.resize(img1, (img_w, img_h))
-            img1 = img1.astype(dtype=np.float32)
-            img1 = np.transpose(img1, [2, 0, 1])
-            img1 = (img1 / 127.5) - 1.0
-            img1_tensor = torch.tensor(img1).unsqueeze(0)
-            img1_tensor_list.append(img1_tensor)
-
-            img2 = cv2.imread(img2_name_list[k])
-            # get high-resolution input
-            img2_hr = img2.astype(dtype=np.float32)
-            img2_hr = np.transpose(img2_hr, [2, 0, 1])
-            img2_hr_tensor = torch.tensor(img2_hr).unsqueeze(0)
-            img2_hr_tensor_list.append(img2_hr_tensor)
-            # get 360x480 input
-            img2 = cv2.resize(img2, (img_w, img_h))
-            img2 = img2.astype(dtype=np.float32)
-            img2 = np.transpose(img2, [2, 0, 1])
-            img2 = (img2 / 127.5) - 1.0
-            img2_tensor = torch.tensor(img2).unsqueeze(0)
-            img2_tensor_list.append(img2_tensor)
+        # load imgs: 360x480 inputs decoded by a pool of threads ahead of their use (see frame_source.FrameSource)
+        # the views are read in lockstep, up to the end of the shortest one
+        # each frame is decoded once: the BGR uint8 frames are kept (views of the frame store if there is one)
+        # and only converted to high-resolution tensors when they are warped (see video_io.LazyFrameList)
+        img1_source = FrameSource(img1_view, num_workers = args.decode_workers, keep_raw = True)
+        img2_source = FrameSource(img2_view, num_workers = args.decode_workers, keep_raw = True)
+        img1_frames = []
+        img2_frames = []
+        for (img1_tensor, img1), (img2_tensor, img2) in zip(img1_source, img2_source):
+            img1_tensor_list.append(img1_tensor.unsqueeze(0))
+            img2_tensor_list.append(img2_tensor.unsqueeze(0))
+            img1_frames.append(img1)
+            img2_frames.append(img2)
+        NOF = len(img2_tensor_list)
+        img1_hr_tensor_list = LazyFrameList(img1_frames, args.hr_prefetch)
+        img2_hr_tensor_list = LazyFrameList(img2_frames, args.hr_prefetch)
 
 
         start_time1 = time.time()
-        NOF = len(img2_name_list)
         # motion estimation
-        for k in range(0, len(img2_name_list)):
-
-            # step 1: spatial warp
-            with torch.no_grad():
-                spatial_batch_out = build_SpatialNet(spatial_net, img1_tensor_list[k].cuda(), img2_tensor_list[k].cuda())
-            smotion1 = spatial_batch_out['motion1']
-            smotion2 = spatial_batch_out['motion2']
-            smotion_tensor_list1.append(smotion1)
-            smotion_tensor_list2.append(smotion2)
-
-        # step 2: temporal warp
+        # step 1 & 2: spatial and temporal warp, batched over chunks of frames and sharing the stage1 features
+        feature_cache.clear()
         with torch.no_grad():
-            temporal_batch_out1 = build_TemporalNet(temporal_net, img1_tensor_list)
-            temporal_batch_out2 = build_TemporalNet(temporal_net, img2_tensor_list)
-        tmotion_tensor_list1 = temporal_batch_out1['motion_list']
-        tmotion_tensor_list2 = temporal_batch_out2['motion_list']
+            motion_batch_out = estimate_motion(spatial_net, temporal_net, img1_tensor_list, img2_tensor_list, args.chunk_size, feature_cache, device)
+        smotion_tensor_list1 = motion_batch_out['smotion_list1']
+        smotion_tensor_list2 = motion_batch_out['smotion_list2']
+        tmotion_tensor_list1 = motion_batch_out['tmotion_list1']
+        tmotion_tensor_list2 = motion_batch_out['tmotion_list2']
+        print("feature cache hit rate:")
+        print(feature_cache.hit_rate)
 
 
         print("fps (spatial & temporal warp):")
@@ -310,125 +220,42 @@ def test(args):
         ##############################################
         #############   data preparation  ############
         # converting tmotion (t-th frame) into tsmotion ( (t-1)-th frame )
-        rigid_mesh = get_rigid_mesh(1, img_h, img_w)
-        norm_rigid_mesh = get_norm_mesh(rigid_mesh, img_h, img_w)
-        smesh_list1 = []
-        smesh_list2 = []
-        tsmotion_list1 = []
-        tsmotion_list2 = []
-        for k in range(len(tmotion_tensor_list1)):
-            smotion1 = smotion_tensor_list1[k]
-            smesh1 = rigid_mesh + smotion1
-            smotion2 = smotion_tensor_list2[k]
-            smesh2 = rigid_mesh + smotion2
-            if k == 0:
-                tsmotion1 = smotion1.clone() * 0
-                tsmotion2 = smotion2.clone() * 0
-            else:
-                smotion1_1 = smotion_tensor_list1[k-1]
-                smesh1_1 = rigid_mesh + smotion1_1
-                tmotion1 = tmotion_tensor_list1[k]
-                tmesh1 = rigid_mesh + tmotion1
-                norm_smesh1_1 = get_norm_mesh(smesh1_1, img_h, img_w)
-                norm_tmesh1 = get_norm_mesh(tmesh1, img_h, img_w)
-                tsmesh1 = torch_tps_transform_point.transformer(norm_tmesh1, norm_rigid_mesh, norm_smesh1_1)
-                tsmotion1 = recover_mesh(tsmesh1, img_h, img_w) - smesh1
-
-                smotion2_1 = smotion_tensor_list2[k-1]
-                smesh2_1 = rigid_mesh + smotion2_1
-                tmotion2 = tmotion_tensor_list2[k]
-                tmesh2 = rigid_mesh + tmotion2
-                norm_smesh2_1 = get_norm_mesh(smesh2_1, img_h, img_w)
-                norm_tmesh2 = get_norm_mesh(tmesh2, img_h, img_w)
-                tsmesh2 = torch_tps_transform_point.transformer(norm_tmesh2, norm_rigid_mesh, norm_smesh2_1)
-                tsmotion2 = recover_mesh(tsmesh2, img_h, img_w) - smesh2
-
-
-            # append
-            smesh_list1.append(smesh1)
-            smesh_list2.append(smesh2)
-            tsmotion_list1.append(tsmotion1)
-            tsmotion_list2.append(tsmotion2)
+        # all frames of both views are converted in one batched pass
+        smesh1, smesh2, tsmotion1, tsmotion2 = get_tsmotion_clip(torch.cat(smotion_tensor_list1, 0), torch.cat(smotion_tensor_list2, 0),
+                                                                 torch.cat(tmotion_tensor_list1, 0), torch.cat(tmotion_tensor_list2, 0), img_h, img_w)
+        # T x [1, h, w, 2]
+        smesh_list1 = smesh1.split(1, 0)
+        smesh_list2 = smesh2.split(1, 0)
+        tsmotion_list1 = tsmotion1.split(1, 0)
+        tsmotion_list2 = tsmotion2.split(1, 0)
 
 
         # step 3: smooth warp
-        ori_mesh1 = 0
-        smooth_mesh1 = 0
-        delta_motion1 = 0
-
-        ori_mesh2 = 0
-        smooth_mesh2 = 0
-        delta_motion2 = 0
-
-        for k in range(len(tmotion_tensor_list1)-6):
-
-            tsmotion_sublist1 = tsmotion_list1[k:k+7]
-            tsmotion_sublist1[0] = tsmotion_sublist1[0] * 0
-
-            tsmotion_sublist2 = tsmotion_list2[k:k+7]
-            tsmotion_sublist2[0] = tsmotion_sublist2[0] * 0
-
-
-            with torch.no_grad():
-                smooth_batch_out = build_SmoothNet(smooth_net, tsmotion_sublist1, tsmotion_sublist2, smesh_list1[k:k+7], smesh_list2[k:k+7])
-
-            _ori_mesh1 = smooth_batch_out["ori_mesh1"]
-            _smooth_mesh1 = smooth_batch_out["smooth_mesh1"]
-
-            _ori_mesh2 = smooth_batch_out["ori_mesh2"]
-            _smooth_mesh2 = smooth_batch_out["smooth_mesh2"]
-
-
-            if k == 0:
-                ori_mesh1 = _ori_mesh1
-                smooth_mesh1 = _smooth_mesh1
-
-                ori_mesh2 = _ori_mesh2
-                smooth_mesh2 = _smooth_mesh2
+        # sliding window of 7 frames, the windows are evaluated in batches of smooth_chunk
+        with torch.no_grad():
+            smooth_batch_out = smooth_clip(smooth_net, tsmotion_list1, tsmotion_list2, smesh_list1, smesh_list2, buffer_len = 7, chunk_size = args.smooth_chunk)
 
-            else:
-                # for ref
-                ori_mesh1 = torch.cat((ori_mesh1, _ori_mesh1[:,-1,...].unsqueeze(1)), 1)
-                smooth_mesh1 = torch.cat((smooth_mesh1, _smooth_mesh1[:,-1,...].unsqueeze(1)), 1)
+        ori_mesh1 = smooth_batch_out["ori_mesh1"]
+        smooth_mesh1 = smooth_batch_out["smooth_mesh1"]
 
-                # for tgt
-                ori_mesh2 = torch.cat((ori_mesh2, _ori_mesh2[:,-1,...].unsqueeze(1)), 1)
-                smooth_mesh2 = torch.cat((smooth_mesh2, _smooth_mesh2[:,-1,...].unsqueeze(1)), 1)
+        ori_mesh2 = smooth_batch_out["ori_mesh2"]
+        smooth_mesh2 = smooth_batch_out["smooth_mesh2"]
 
 
         print("fps (smooth warp):")
         print(NOF/(time.time() - start_time1))
 
-        #
-        stable_list, out_width, out_height = get_stable_sqe(img1_hr_tensor_list, img2_hr_tensor_list, smooth_mesh1, smooth_mesh2, args.warp_mode, args.fusion_mode)
+        # the frames are encoded in a background thread while the next ones are warped
+        open_writer = lambda width, height: AsyncVideoWriter(media_path, fourcc, fps, (width, height), args.write_queue)
+        stable_list, out_width, out_height = get_stable_sqe(img1_hr_tensor_list, img2_hr_tensor_list, smooth_mesh1, smooth_mesh2, args.warp_mode, args.fusion_mode, device, args.warp_memory, canvas_planner, open_writer)
 
 
-        print("fps (warping & average blending):")
+        print("fps (warping & blending & writing into video):")
         print(NOF/(time.time() - start_time1))
 
-
-
-        print(out_width)
-        print(out_height)
-
-        out_width = int(out_width.detach().cpu().item())
-        out_height = int(out_height.detach().cpu().item())
-
         print(out_width)
         print(out_height)
 
-        media_writer = cv2.VideoWriter(media_path, fourcc, fps, (out_width, out_height))
-
-
-        # get the stable video
-        for k in range(len(stable_list)):
-            media_writer.write(stable_list[k].astype(np.uint8 ))
-
-
-        media_writer.release()
-        print("FPS (write into video):")
-        print(NOF/(time.time() - start_time1))
-
 
 
 
@@ -442,17 +269,44 @@ if __name__=="__main__":
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--gpu', type=str, default='0')
+    # 'cpu', 'cuda' or 'cuda:N' (default: cuda if available, otherwise cpu)
+    parser.add_argument('--device', type=str, default=None)
+    # number of cpu threads for intra-op parallelism (0: torch default)
+    parser.add_argument('--num_threads', type=int, default=0)
+    # number of frames per motion estimation chunk (SpatialNet batch and TemporalNet chunk)
+    parser.add_argument('--chunk_size', type=int, default=8)
+    # memory budget (MB) of the SpatialNet/TemporalNet cost volumes, computed in displacement chunks that fit into it (0: all at once)
+    parser.add_argument('--cost_memory', type=int, default=0)
+    # number of 7-frame SmoothNet windows evaluated in one batch
+    parser.add_argument('--smooth_chunk', type=int, default=64)
     parser.add_argument('--test_path', type=str, default='/workspace/data/images/test_small/')
     parser.add_argument('--output_path', type=str, default='../results_ssd/')
 
-    # optional parameter: 'NORMAL' or 'FAST'
+    # optional parameter: 'NORMAL', 'FAST' or 'COARSE'
     # FAST: use F.grid_sample to interpolate. It's fast, but may produce thin black boundary.
     # NORMAL: use our implemented interpolation function. It's a bit slower, but avoid the black boundary.
+    # COARSE: evaluate the TPS every 8 pixels and upsample the sampling field. Much faster, sub-pixel deviation (see torch_tps_transform.coarse_error).
     parser.add_argument('--warp_mode', type=str, default='NORMAL') # optional parameter: 'Normal' or 'Fast'
     # optional parameter: 'AVERAGE' or 'LINEAR'
     # AVERAGE: faster but more artifacts
     # LINEAR: slower but less artifacts
     parser.add_argument('--fusion_mode', type=str, default='AVERAGE')
+    # memory budget (MB) of the hr TPS warp: the canvas is warped in bands of rows that fit into it
+    # the output is the same, 0 warps the whole canvas at once
+    parser.add_argument('--warp_memory', type=int, default=0)
+    # output canvas (see stitching.CanvasPlanner), by default the bounding box of all the smooth meshes of the clip
+    # canvas_frames: plan it from the first N frames only, canvas_outlier: fraction of outlier frames ignored at each side,
+    # canvas_envelope: fixed x_min y_min x_max y_max of the rig (in input pixels), canvas_size: fixed output height width
+    parser.add_argument('--canvas_frames', type=int, default=0)
+    parser.add_argument('--canvas_outlier', type=float, default=0.)
+    parser.add_argument('--canvas_envelope', type=float, nargs=4, default=None)
+    parser.add_argument('--canvas_size', type=int, nargs=2, default=None)
+    # number of rendered frames waiting for the background video encoder
+    parser.add_argument('--write_queue', type=int, default=8)
+    # number of high-resolution frames decoded ahead of the warp, the others stay on disk
+    parser.add_argument('--hr_prefetch', type=int, default=2)
+    # number of threads decoding the 360x480 input frames
+    parser.add_argument('--decode_workers', type=int, default=4)
 
 
 
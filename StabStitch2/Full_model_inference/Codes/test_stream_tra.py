@@ -0,0 +1,172 @@
+# coding: utf-8
+import argparse
+import torch
+from spatial_network import SpatialNet
+from temporal_network import TemporalNet
+from smooth_network import SmoothNet
+from streaming import StreamingStabStitcher
+from stitching import CanvasPlanner
+from video_io import AsyncVideoWriter, find_view
+from frame_source import FrameSource
+from device_utils import get_device, set_num_threads
+import os
+import numpy as np
+import cv2
+import glob
+import time
+
+
+last_path = os.path.abspath(os.path.join(os.path.dirname("__file__"), os.path.pardir))
+MODEL_DIR = os.path.join(last_path, 'full_model_tra')
+
+
+
+def test(args):
+
+    os.environ['CUDA_DEVICES_ORDER'] = "PCI_BUS_ID"
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+
+    # define the network
+    spatial_net = SpatialNet()
+    temporal_net = TemporalNet()
+    smooth_net = SmoothNet()
+    device = get_device(args.device)
+    print("device: {}, threads: {}".format(device, set_num_threads(args.num_threads)))
+    spatial_net = spatial_net.to(device)
+    temporal_net = temporal_net.to(device)
+    smooth_net = smooth_net.to(device)
+    if args.cost_memory > 0:
+        spatial_net.cost_memory = temporal_net.cost_memory = args.cost_memory * 1024 * 1024
+
+    #load the existing models if it exists
+    ckpt_list = glob.glob(MODEL_DIR + "/*.pth")
+    ckpt_list.sort()
+
+    if len(ckpt_list) == 3:
+        # load spatial warp model
+        spatial_model_path = MODEL_DIR + "/spatial_warp.pth"
+        spatial_checkpoint = torch.load(spatial_model_path, map_location=device)
+        spatial_net.load_state_dict(spatial_checkpoint['model'])
+        print('load model from {}!'.format(spatial_model_path))
+        # load temporal warp model
+        temporal_model_path = MODEL_DIR + "/temporal_warp.pth"
+        temporal_checkpoint = torch.load(temporal_model_path, map_location=device)
+        temporal_net.load_state_dict(temporal_checkpoint['model'])
+        print('load model from {}!'.format(temporal_model_path))
+        # load smooth warp model
+        smooth_model_path = MODEL_DIR + "/smooth_warp.pth"
+        smooth_checkpoint = torch.load(smooth_model_path, map_location=device)
+        smooth_net.load_state_dict(smooth_checkpoint['model'])
+        print('load model from {}!'.format(smooth_model_path))
+    else:
+        print('No checkpoint found!')
+        exit(0)
+
+
+    spatial_net.eval()
+    temporal_net.eval()
+    smooth_net.eval()
+
+    print("##################start testing#######################")
+
+    video_name_list = glob.glob(os.path.join(args.test_path, '*'))
+    video_name_list = sorted(video_name_list)
+    print(video_name_list)
+
+    canvas_planner = CanvasPlanner(envelope = args.canvas_envelope, outlier = args.canvas_outlier, out_size = args.canvas_size)
+    stitcher = StreamingStabStitcher(spatial_net, temporal_net, smooth_net, warp_mode = args.warp_mode, fusion_mode = args.fusion_mode, device = device, warp_memory = args.warp_memory, canvas_planner = canvas_planner)
+
+    for i in range(len(video_name_list)):
+        print()
+        print(i)
+        print(video_name_list[i])
+
+        # input views: folders of .jpg frames, or video files (e.g. video1.mp4) decoded on the fly (see video_io.find_view)
+        img1_view = find_view(video_name_list[i], "video1")
+        img2_view = find_view(video_name_list[i], "video2")
+
+        # prepare folders
+        if not os.path.exists(args.output_path):
+            os.makedirs(args.output_path)
+        video_name = video_name_list[i].split('/')[-1] + ".mp4"
+        media_path = args.output_path + video_name
+        fourcc = cv2.VideoWriter_fourcc('m', 'p', '4', 'v')
+        fps = 30
+
+        # the writer is opened once the canvas is fixed by the first window
+        media_writer = None
+        stitcher.reset()
+
+        start_time1 = time.time()
+        # the raw frames are read by a pool of threads ahead of the stitcher (see frame_source.FrameSource)
+        # the views are read in lockstep, up to the end of the shortest one
+        img1_source = FrameSource(img1_view, num_workers = args.decode_workers, raw = True)
+        img2_source = FrameSource(img2_view, num_workers = args.decode_workers, raw = True)
+        frame_pairs = zip(img1_source, img2_source)
+        while True:
+
+            # the end of the views is only known once it is reached: the buffered frames are flushed after the last pair
+            frame_pair = next(frame_pairs, None)
+            stable_list = stitcher.flush() if frame_pair is None else stitcher.push(*frame_pair)
+
+            if len(stable_list) > 0 and media_writer is None:
+                out_width, out_height = stitcher.canvas_size
+                print(out_width)
+                print(out_height)
+                # the frames are encoded in a background thread while the next ones are stitched
+                media_writer = AsyncVideoWriter(media_path, fourcc, fps, (out_width, out_height), args.write_queue)
+
+            for stable_frame in stable_list:
+                media_writer.write(stable_frame)
+
+            if frame_pair is None:
+                break
+        NOF = stitcher.frame_num
+
+        if media_writer is not None:
+            media_writer.release()
+        print("fps (streaming):")
+        print(NOF/(time.time() - start_time1))
+
+
+    print("##################end testing#######################")
+
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--gpu', type=str, default='0')
+    # 'cpu', 'cuda' or 'cuda:N' (default: cuda if available, otherwise cpu)
+    parser.add_argument('--device', type=str, default=None)
+    # number of cpu threads for intra-op parallelism (0: torch default)
+    parser.add_argument('--num_threads', type=int, default=0)
+    parser.add_argument('--test_path', type=str, default='/workspace/data/images/test_small/')
+    parser.add_argument('--output_path', type=str, default='../results_tra/')
+
+    # optional parameter: 'NORMAL', 'FAST' or 'COARSE'
+    parser.add_argument('--warp_mode', type=str, default='NORMAL')
+    # optional parameter: 'AVERAGE' or 'LINEAR'
+    parser.add_argument('--fusion_mode', type=str, default='LINEAR')
+    # memory budget (MB) of the hr TPS warp: the canvas is warped in bands of rows that fit into it
+    # the output is the same, 0 warps the whole canvas at once
+    parser.add_argument('--warp_memory', type=int, default=0)
+    # output canvas (see stitching.CanvasPlanner), by default the bounding box of the meshes of the first window
+    # canvas_outlier: fraction of outlier frames ignored at each side, canvas_envelope: fixed x_min y_min x_max y_max
+    # of the rig (in input pixels), canvas_size: fixed output height width
+    parser.add_argument('--canvas_outlier', type=float, default=0.)
+    parser.add_argument('--canvas_envelope', type=float, nargs=4, default=None)
+    parser.add_argument('--canvas_size', type=int, nargs=2, default=None)
+    # number of rendered frames waiting for the background video encoder
+    parser.add_argument('--write_queue', type=int, default=8)
+    # number of threads reading the input frames
+    parser.add_argument('--decode_workers', type=int, default=4)
+    # memory budget (MB) of the SpatialNet/TemporalNet cost volumes, computed in displacement chunks that fit into it (0: all at once)
+    parser.add_argument('--cost_memory', type=int, default=0)
+
+
+    print('<==================== Loading data ===================>\n')
+
+    args = parser.parse_args()
+    print(args)
+    test(args)
@@ -0,0 +1,30 @@
+# coding: utf-8
+# the modules of Codes are imported as top-level modules, as the test scripts do
+import os
+import sys
+import pytest
+import torch
+import torchvision.models as models
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+
+
+@pytest.fixture(scope='session')
+def nets():
+    """
+    SpatialNet, TemporalNet and SmoothNet with random weights and the same ResNet18 stem
+    (no checkpoint is downloaded).
+    """
+    resnet18 = models.resnet.resnet18
+    models.resnet.resnet18 = lambda weights=None, **kwargs: resnet18(weights=None, **kwargs)
+    try:
+        from spatial_network import SpatialNet
+        from temporal_network import TemporalNet
+        from smooth_network import SmoothNet
+        torch.manual_seed(0)
+        spatial_net, temporal_net, smooth_net = SpatialNet().eval(), TemporalNet().eval(), SmoothNet().eval()
+    finally:
+        models.resnet.resnet18 = resnet18
+    temporal_net.feature_extractor_stage1.load_state_dict(spatial_net.feature_extractor_stage1.state_dict())
+
+    return spatial_net, temporal_net, smooth_net
@@ -0,0 +1,32 @@
+# coding: utf-8
+import pytest
+import torch
+import torch.nn.functional as F
+from spatial_network import SpatialNet
+from temporal_network import TemporalNet
+
+
+# the unfolded correlation the networks used before memory_budget
+def _unfolded(x1, x2, search_range, norm):
+    if norm:
+        x1, x2 = F.normalize(x1, p=2, dim=1), F.normalize(x2, p=2, dim=1)
+    bs, c, h, w = x1.shape
+    max_offset = search_range * 2 + 1
+    patches = F.unfold(F.pad(x2, [search_range] * 4), (max_offset, max_offset)).reshape(bs, c, max_offset ** 2, h, w)
+    return F.leaky_relu((x1.unsqueeze(2) * patches).mean(dim=1), 0.1)
+
+
+@pytest.mark.parametrize('cost_volume', [SpatialNet.cost_volume, TemporalNet.cost_volume])
+@pytest.mark.parametrize('norm', [True, False])
+def test_cost_volume_memory_budget(cost_volume, norm):
+    generator = torch.Generator().manual_seed(0)
+    x1 = torch.randn(2, 16, 12, 15, generator=generator)
+    x2 = torch.randn(2, 16, 12, 15, generator=generator)
+    expected = _unfolded(x1, x2, 3, norm)
+
+    assert torch.equal(cost_volume(x1, x2, 3, norm), expected)
+    assert torch.equal(cost_volume(x1, x2, 3, norm, memory_budget=None), expected)
+    # from one displacement per chunk to all of them at once
+    feature_bytes = 2 * x1.element_size() * x1.numel()
+    for memory_budget in [0, 5 * feature_bytes, 49 * feature_bytes, 1 << 30]:
+        torch.testing.assert_close(cost_volume(x1, x2, 3, norm, memory_budget=memory_budget), expected, rtol=0, atol=1e-6)
@@ -0,0 +1,26 @@
+# coding: utf-8
+import copy
+import pytest
+import torch
+from feature_cache import FeatureCache, estimate_motion
+
+
+@pytest.mark.parametrize('shared', [True, False])
+def test_chunk_boundaries_hit_the_cache(nets, shared):
+    spatial_net, temporal_net, _ = nets
+    if not shared:
+        temporal_net = copy.deepcopy(temporal_net)
+        with torch.no_grad():
+            next(temporal_net.feature_extractor_stage1.parameters()).add_(1e-3)
+    frame_num, chunk_size = 5, 2
+    img1_list = [torch.rand(1, 3, 360, 480) * 2 - 1 for _ in range(frame_num)]
+    img2_list = [torch.rand(1, 3, 360, 480) * 2 - 1 for _ in range(frame_num)]
+
+    feature_cache = FeatureCache(spatial_net, temporal_net, window = chunk_size + 1, view_num = 2)
+    with torch.no_grad():
+        estimate_motion(spatial_net, temporal_net, img1_list, img2_list, chunk_size, feature_cache)
+
+    # every frame of every view is extracted once per network owning the entries, the previous
+    # frame of each chunk (frames 1 and 3) is served from the cache to TemporalNet
+    assert feature_cache.shared == shared
+    assert feature_cache.misses == frame_num * 2 * (1 if shared else 2)
@@ -0,0 +1,166 @@
+# coding: utf-8
+import ast
+import os
+import sys
+import cv2
+import numpy as np
+import pytest
+import torch
+import frame_source
+from frame_source import FrameSource, load_frame, prepare_frame
+
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), *[os.path.pardir] * 4, 'src'))
+
+
+# src/Utils/utils.py, imported only by the tests that need it (it depends on moviepy)
+def _utils():
+    pytest.importorskip('moviepy')
+    if SRC_DIR not in sys.path:
+        sys.path.insert(0, SRC_DIR)
+    from Utils import utils
+    return utils
+
+
+def test_video_extensions_match_src_utils():
+    # read from the source, the constant does not need moviepy
+    with open(os.path.join(SRC_DIR, 'Utils', 'utils.py')) as f:
+        tree = ast.parse(f.read())
+    values = [ast.literal_eval(node.value) for node in tree.body
+              if isinstance(node, ast.Assign) and any(getattr(target, 'id', None) == 'VIDEO_EXTENSIONS' for target in node.targets)]
+    assert values == [frame_source.VIDEO_EXTENSIONS]
+
+
+def test_read_synchronized_frames_raises_on_missing_video(tmp_path):
+    utils = _utils()
+    with pytest.raises(IOError):
+        next(utils.read_synchronized_frames([str(tmp_path / 'missing1.mp4'), str(tmp_path / 'missing2.mp4')]))
+
+
+NUM_FRAMES = 5
+
+
+# frames that differ from each other everywhere, so that a frame out of order cannot go unnoticed
+def _frames(h=48, w=64):
+    rng = np.random.RandomState(0)
+    return [rng.randint(0, 256, (h, w, 3)).astype(np.uint8) for _ in range(NUM_FRAMES)]
+
+def _write_images(folder):
+    folder.mkdir()
+    paths = []
+    for k, img in enumerate(_frames()):
+        paths.append(str(folder / 'frame_{:05d}.jpg'.format(k)))
+        cv2.imwrite(paths[-1], img)
+    return paths
+
+def _write_video(path):
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'MJPG'), 10, (64, 48))
+    for img in _frames():
+        writer.write(img)
+    writer.release()
+    return str(path)
+
+# frames of a video as decoded by a plain sequential read
+def _decode(path):
+    capture = cv2.VideoCapture(path)
+    frames = []
+    while True:
+        ok, img = capture.read()
+        if not ok:
+            break
+        frames.append(img)
+    capture.release()
+    return frames
+
+
+def test_frame_source_keeps_image_order(tmp_path):
+    paths = _write_images(tmp_path / 'view')
+    # fewer threads and a shorter lookahead than frames, so frames are decoded out of order
+    images = list(FrameSource(paths, num_workers = 3, lookahead = 2, raw = True))
+    assert len(images) == NUM_FRAMES
+    for path, img in zip(paths, images):
+        assert np.array_equal(img, cv2.imread(path))
+
+    for path, (img_lr, img_hr) in zip(paths, FrameSource(paths, hr = True, num_workers = 3, lookahead = 2)):
+        expected_lr, expected_hr = load_frame(path, True)
+        assert torch.equal(img_lr, expected_lr) and torch.equal(img_hr, expected_hr)
+
+    for path, (img_lr, img) in zip(paths, FrameSource(paths, num_workers = 3, lookahead = 2, keep_raw = True)):
+        assert torch.equal(img_lr, load_frame(path)[0])
+        assert np.array_equal(img, cv2.imread(path))
+
+
+def test_frame_source_keeps_video_order(tmp_path):
+    video = _write_video(tmp_path / 'view.avi')
+    expected = _decode(video)
+    assert len(expected) == NUM_FRAMES
+    images = list(FrameSource(video, num_workers = 3, lookahead = 2, raw = True))
+    assert len(images) == NUM_FRAMES
+    for img, expected_img in zip(images, expected):
+        assert np.array_equal(img, expected_img)
+
+    for (img_lr, img), expected_img in zip(FrameSource(video, num_workers = 3, lookahead = 2, keep_raw = True), expected):
+        assert torch.equal(img_lr, prepare_frame(expected_img)[0])
+        assert np.array_equal(img, expected_img)
+
+
+def test_frame_source_stops_early(tmp_path):
+    video = _write_video(tmp_path / 'view.avi')
+    expected = _decode(video)
+    # the consumer stops before the end: the pending frames are dropped and the capture is released
+    for k, img in enumerate(FrameSource(video, num_workers = 2, lookahead = 4, raw = True)):
+        assert np.array_equal(img, expected[k])
+        if k == 1:
+            break
+    assert len(list(FrameSource(video, raw = True))) == NUM_FRAMES
+
+
+def test_frame_store_round_trip(tmp_path):
+    utils = _utils()
+    paths = _write_images(tmp_path / 'view')
+    # a frame that is not a .jpg is not part of the store
+    cv2.imwrite(str(tmp_path / 'view' / 'mask.png'), _frames()[0])
+    store_path = utils.build_frame_store(str(tmp_path / 'view'))
+    assert store_path == str(tmp_path / 'view') + frame_source.STORE_SUFFIX
+
+    store = frame_source.find_store(str(tmp_path / 'view'))
+    assert store is frame_source.open_store(store_path)
+    assert store.names == [os.path.basename(path) for path in paths]
+    assert store.native.shape == (NUM_FRAMES, 48, 64, 3)
+    assert store.lr.shape == (NUM_FRAMES, frame_source.IMG_H, frame_source.IMG_W, 3)
+    for k, path in enumerate(paths):
+        img = cv2.imread(path)
+        assert np.array_equal(store.native[k], img)
+        assert np.array_equal(store.lr[k], cv2.resize(img, (frame_source.IMG_W, frame_source.IMG_H)))
+        # the image files are read from the store
+        assert np.array_equal(frame_source.read_frame(path), img)
+        assert torch.equal(load_frame(path)[0], prepare_frame(img)[0])
+
+    for k, img in enumerate(FrameSource(store_path, num_workers = 3, lookahead = 2, raw = True)):
+        assert np.array_equal(img, cv2.imread(paths[k]))
+
+
+def test_frame_store_of_video(tmp_path):
+    utils = _utils()
+    video = _write_video(tmp_path / 'view.avi')
+    store = frame_source.open_store(utils.build_frame_store(video))
+    assert store is frame_source.find_store(video)
+    expected = _decode(video)
+    assert store.names == ['frame_{:05d}'.format(k) for k in range(NUM_FRAMES)]
+    assert len(store) == NUM_FRAMES
+    for k, img in enumerate(expected):
+        assert np.array_equal(store.native[k], img)
+
+
+@pytest.mark.parametrize('start, end, stride', [(0, None, 1), (1, 5, 2), (2, None, 2), (0, 3, 1)])
+def test_extract_frames_range_and_stride(tmp_path, start, end, stride):
+    utils = _utils()
+    video = _write_video(tmp_path / 'view.avi')
+    expected = _decode(video)
+    indices = list(range(NUM_FRAMES))[start:end:stride]
+    count = utils.extract_frames_from_video(video, str(tmp_path / 'out'), 'png', start = start, end = end, stride = stride, num_workers = 2)
+    assert count == len(indices)
+    # frames keep their index in the video
+    assert sorted(os.listdir(tmp_path / 'out' / 'view')) == ['frame_{:05d}.png'.format(k) for k in indices]
+    for k in indices:
+        assert np.array_equal(cv2.imread(str(tmp_path / 'out' / 'view' / 'frame_{:05d}.png'.format(k))), expected[k])
@@ -0,0 +1,145 @@
+# coding: utf-8
+import pytest
+import torch
+import utils.torch_tps_transform as torch_tps_transform
+from geometry import get_rigid_mesh, get_norm_mesh, get_norm_rigid_mesh
+from blending import linear_blender
+from stitching import mesh_boxes, stitch_frame, CanvasPlanner, BOX_GROW
+
+
+IMG_H, IMG_W = 36, 48
+
+
+# rows and columns of the warp that sample the image (the weights of the pixels out of it only cancel up to rounding)
+def _support(warp):
+    rows = (warp.abs().amax((0, 1, 3)) > 1e-3).nonzero()
+    cols = (warp.abs().amax((0, 1, 2)) > 1e-3).nonzero()
+    return rows.min().item(), rows.max().item(), cols.min().item(), cols.max().item()
+
+def _check_box(img, norm_mesh, norm_rigid_mesh, out_h, out_w):
+    T = torch_tps_transform.solve_system(norm_mesh, norm_rigid_mesh)
+    box, = mesh_boxes([norm_mesh], out_h, out_w, [T], [img.size()[2:]])
+    row, col, height, width = box
+    row_min, row_max, col_min, col_max = _support(torch_tps_transform.transformer(img, norm_mesh, norm_rigid_mesh, (out_h, out_w)))
+    assert row <= row_min and row_max < row + height and col <= col_min and col_max < col + width
+    return box
+
+
+def test_mesh_boxes_cover_bent_borders():
+    img = torch.rand(1, 3, IMG_H, IMG_W) + 1
+    norm_rigid_mesh = get_norm_mesh(get_rigid_mesh(1, IMG_H, IMG_W), IMG_H, IMG_W)
+    generator = torch.Generator().manual_seed(0)
+    for _ in range(3):
+        mesh = get_rigid_mesh(1, IMG_H, IMG_W)
+        mesh = mesh * 1.5 + 10 + torch.randn(mesh.size(), generator=generator) * 3
+        _check_box(img, get_norm_mesh(mesh, 90, 100), norm_rigid_mesh, 90, 100)
+
+
+def test_mesh_boxes_grow_to_the_canvas_border():
+    # the mesh only covers the center of the image, which spans ten times its box on the canvas:
+    # the sides of the box are pushed out by far more than 8 BOX_GROW steps
+    img = torch.rand(1, 3, IMG_H, IMG_W) + 1
+    norm_rigid_mesh = get_norm_mesh(get_rigid_mesh(1, IMG_H, IMG_W), IMG_H, IMG_W)
+    out_h, out_w = 40 * BOX_GROW, 40 * BOX_GROW
+    box, = mesh_boxes([norm_rigid_mesh * 0.05], out_h, out_w)
+    assert box[2] < 3 * BOX_GROW and box[3] < 3 * BOX_GROW
+
+    box = _check_box(img, norm_rigid_mesh * 0.05, norm_rigid_mesh * 0.1, out_h, out_w)
+    assert box[2] > 2 * 8 * BOX_GROW + 3 * BOX_GROW and box[3] > 2 * 8 * BOX_GROW + 3 * BOX_GROW
+
+
+def _pair(seed):
+    generator = torch.Generator().manual_seed(seed)
+    img1 = torch.rand(1, 3, 2*IMG_H, 2*IMG_W, generator=generator) * 255
+    img2 = torch.rand(1, 3, 2*IMG_H, 2*IMG_W, generator=generator) * 255
+    rigid_mesh = get_rigid_mesh(1, 2*IMG_H, 2*IMG_W)
+    mesh1 = rigid_mesh + torch.randn(rigid_mesh.size(), generator=generator) * 2
+    mesh2 = rigid_mesh + torch.tensor([40., 6.]) + torch.randn(rigid_mesh.size(), generator=generator) * 2
+    return img1, img2, mesh1, mesh2
+
+# the full-canvas path: both views warped over the whole canvas, then blended everywhere
+def _full_canvas(img1, img2, mesh1, mesh2, canvas, warp_mode, fusion_mode):
+    width_min, height_min, out_width, out_height = canvas
+    out_size = (int(out_height.int()), int(out_width.int()))
+    norm_rigid_mesh = get_norm_rigid_mesh(1, img1.size()[2], img1.size()[3])
+    warps = []
+    for img, mesh in [(img1, mesh1), (img2, mesh2)]:
+        norm_mesh = get_norm_mesh(torch.stack([mesh[...,0]-width_min, mesh[...,1]-height_min], 3), out_height, out_width)
+        if fusion_mode != 'AVERAGE':
+            img = torch.cat([img, torch.ones_like(img[:,0:1])], 1)
+        warps.append(torch_tps_transform.transformer(img, norm_mesh, norm_rigid_mesh, out_size, warp_mode))
+    w1, w2 = warps
+    if fusion_mode == 'AVERAGE':
+        return w1 * (w1/ (w1+w2+1e-6)) + w2 * (w2/ (w1+w2+1e-6))
+    return linear_blender(w1[:,0:3], w2[:,0:3], w1[:,3:4], w2[:,3:4])
+
+
+@pytest.mark.parametrize('warp_mode', ['NORMAL', 'FAST', 'COARSE'])
+@pytest.mark.parametrize('fusion_mode', ['LINEAR', 'AVERAGE'])
+def test_stitch_frame_matches_full_canvas(warp_mode, fusion_mode):
+    # the views overlap by about half their width, with bent meshes
+    for seed in range(3):
+        img1, img2, mesh1, mesh2 = _pair(seed)
+        canvas = CanvasPlanner().plan([mesh1.unsqueeze(1), mesh2.unsqueeze(1)])
+        norm_rigid_mesh = get_norm_rigid_mesh(1, img1.size()[2], img1.size()[3])
+        fusion = stitch_frame(img1, img2, mesh1, mesh2, norm_rigid_mesh, *canvas, warp_mode, fusion_mode)
+        expected = _full_canvas(img1, img2, mesh1, mesh2, canvas, warp_mode, fusion_mode)
+        # NORMAL only differs where ULP-level coordinate changes cross the image-edge cutoff of its sampler
+        assert (fusion - expected).abs().max() < 1e-2
+
+
+def _clip_meshes(frame_num, seed):
+    generator = torch.Generator().manual_seed(seed)
+    rigid_mesh = get_rigid_mesh(1, 360, 480).unsqueeze(1)
+    mesh1 = rigid_mesh + torch.randn(1, frame_num, *rigid_mesh.size()[2:], generator=generator) * 10
+    mesh2 = rigid_mesh + torch.tensor([200., 20.]) + torch.randn(1, frame_num, *rigid_mesh.size()[2:], generator=generator) * 10
+    return mesh1, mesh2
+
+
+def test_canvas_planner_default_is_the_bounding_box_of_the_clip():
+    mesh1, mesh2 = _clip_meshes(12, 0)
+    width_min, height_min, out_width, out_height = CanvasPlanner().plan([mesh1, mesh2])
+
+    # the canvas of the drivers before CanvasPlanner
+    width_max = torch.maximum(mesh1[...,0].max(), mesh2[...,0].max())
+    expected_width_min = torch.minimum(mesh1[...,0].min(), mesh2[...,0].min())
+    height_max = torch.maximum(mesh1[...,1].max(), mesh2[...,1].max())
+    expected_height_min = torch.minimum(mesh1[...,1].min(), mesh2[...,1].min())
+    assert torch.equal(width_min, expected_width_min) and torch.equal(height_min, expected_height_min)
+    assert torch.equal(out_width, width_max - expected_width_min) and torch.equal(out_height, height_max - expected_height_min)
+
+
+def test_canvas_planner_first_frames():
+    mesh1, mesh2 = _clip_meshes(12, 1)
+    mesh2[:, 9] += 500.
+    assert all(torch.equal(a, b) for a, b in zip(CanvasPlanner(frame_num = 7).plan([mesh1, mesh2]), CanvasPlanner().plan([mesh1[:, :7], mesh2[:, :7]])))
+    assert CanvasPlanner().plan([mesh1, mesh2])[2] > CanvasPlanner(frame_num = 7).plan([mesh1, mesh2])[2] + 400
+
+
+def test_canvas_planner_ignores_outlier_frames():
+    mesh1, mesh2 = _clip_meshes(20, 2)
+    inlier = CanvasPlanner().plan([torch.cat([mesh1[:, :9], mesh1[:, 10:]], 1), torch.cat([mesh2[:, :9], mesh2[:, 10:]], 1)])
+    mesh2[:, 9] += 500.
+    mesh1[:, 9] -= 300.
+    width_min, height_min, out_width, out_height = CanvasPlanner(outlier = 0.1).plan([mesh1, mesh2])
+    # the quantiles interpolate between the frames: at 0.1 of 20 frames the outlier frame has no weight,
+    # the canvas stays within the extents of the other frames
+    assert width_min >= inlier[0] and height_min >= inlier[1]
+    assert width_min + out_width <= inlier[0] + inlier[2] and height_min + out_height <= inlier[1] + inlier[3]
+
+
+def test_canvas_planner_envelope_and_out_size():
+    mesh1, mesh2 = _clip_meshes(12, 3)
+    width_min, height_min, out_width, out_height = CanvasPlanner(envelope = (-50, -20, 650, 400)).plan([mesh1, mesh2])
+    assert [v.item() for v in (width_min, height_min, out_width, out_height)] == [-50., -20., 700., 420.]
+
+    # a fixed output size is centered on the planned canvas, larger or smaller than it
+    default = CanvasPlanner().plan([mesh1, mesh2])
+    for out_size in [(300, 400), (600, 1000)]:
+        width_min, height_min, out_width, out_height = CanvasPlanner(out_size = out_size).plan([mesh1, mesh2])
+        assert (out_height.item(), out_width.item()) == out_size
+        torch.testing.assert_close(width_min + out_width / 2, default[0] + default[2] / 2)
+        torch.testing.assert_close(height_min + out_height / 2, default[1] + default[3] / 2)
+
+    width_min, height_min, out_width, out_height = CanvasPlanner(envelope = (-50, -20, 650, 400), out_size = (300, 400)).plan([mesh1, mesh2])
+    assert [v.item() for v in (width_min, height_min, out_width, out_height)] == [100., 40., 400., 300.]
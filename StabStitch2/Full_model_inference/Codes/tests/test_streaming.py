@@ -0,0 +1,75 @@
+# coding: utf-8
+import copy
+import numpy as np
+import pytest
+import cv2
+import torch
+from feature_cache import estimate_motion
+from smooth_network import get_tsmotion_clip, smooth_clip
+from stitching import stitch_frame, CanvasPlanner
+from streaming import StreamingStabStitcher
+from video_io import to_uint8_frame
+from geometry import get_norm_rigid_mesh
+
+
+@pytest.fixture(scope='module')
+def wide_nets(nets):
+    # with random weights both views land on about the same place, and the direction between the mask
+    # centroids of linear_blender is degenerate: SpatialNet is biased to a 160-pixel baseline between the views
+    spatial_net, temporal_net, smooth_net = nets
+    spatial_net = copy.deepcopy(spatial_net)
+    with torch.no_grad():
+        spatial_net.regressNet1_part2[-1].bias += torch.tensor([160., 0.]).repeat(4)
+    return spatial_net, temporal_net, smooth_net
+
+
+def _frames(frame_num, seed):
+    # smooth random BGR frames drifting by a pixel per frame
+    rng = np.random.RandomState(seed)
+    base = cv2.resize(rng.randint(0, 256, (12, 16, 3)).astype(np.uint8), (140, 100), interpolation=cv2.INTER_CUBIC)
+    return [np.ascontiguousarray(base[k:k+90, k:k+120]) for k in range(frame_num)]
+
+def _tensors(img):
+    hr = torch.tensor(np.transpose(img.astype(np.float32), [2, 0, 1])).unsqueeze(0)
+    lr = cv2.resize(img, (480, 360)).astype(np.float32)
+    return torch.tensor(np.transpose(lr, [2, 0, 1]) / 127.5 - 1.0).unsqueeze(0), hr
+
+# the offline path of test_online_tra.py, on a canvas planned from the first window as the stitcher does
+def _offline(nets, frames1, frames2, buffer_len, fusion_mode):
+    spatial_net, temporal_net, smooth_net = nets
+    inputs1, inputs2 = [_tensors(img) for img in frames1], [_tensors(img) for img in frames2]
+    with torch.no_grad():
+        motion = estimate_motion(spatial_net, temporal_net, [x[0] for x in inputs1], [x[0] for x in inputs2], 4)
+        smesh1, smesh2, tsmotion1, tsmotion2 = get_tsmotion_clip(*[torch.cat(motion[name], 0) for name in ['smotion_list1', 'smotion_list2', 'tmotion_list1', 'tmotion_list2']], 360, 480)
+        smooth = smooth_clip(smooth_net, tsmotion1.split(1, 0), tsmotion2.split(1, 0), smesh1.split(1, 0), smesh2.split(1, 0), buffer_len)
+
+        _, _, img_h, img_w = inputs1[0][1].size()
+        meshes = [torch.stack([smooth[name][...,0]*img_w/480, smooth[name][...,1]*img_h/360], 4) for name in ['smooth_mesh1', 'smooth_mesh2']]
+        canvas = CanvasPlanner(frame_num = buffer_len).plan(meshes)
+        norm_rigid_mesh = get_norm_rigid_mesh(1, img_h, img_w)
+        return [to_uint8_frame(stitch_frame(inputs1[k][1], inputs2[k][1], meshes[0][:,k], meshes[1][:,k], norm_rigid_mesh, *canvas, 'NORMAL', fusion_mode)[0])
+                for k in range(len(frames1))]
+
+
+# 10 frames: the leading frames come from smooth_all(), the later ones from smooth_last()
+# 5 frames: shorter than one window, everything is smoothed and rendered by flush()
+@pytest.mark.parametrize('frame_num, fusion_mode', [(10, 'AVERAGE'), (10, 'LINEAR'), (5, 'LINEAR')])
+def test_streaming_matches_offline(wide_nets, frame_num, fusion_mode):
+    buffer_len = 7
+    frames1, frames2 = _frames(frame_num, 0), _frames(frame_num, 1)
+    spatial_net, temporal_net, smooth_net = wide_nets
+
+    stitcher = StreamingStabStitcher(spatial_net, temporal_net, smooth_net, fusion_mode = fusion_mode, buffer_len = buffer_len, device = 'cpu')
+    stream = []
+    for img1, img2 in zip(frames1, frames2):
+        stream.extend(stitcher.push(img1, img2))
+    stream.extend(stitcher.flush())
+    offline = _offline(wide_nets, frames1, frames2, buffer_len, fusion_mode)
+
+    # both paths quantize with to_uint8_frame (clamped to 0 ~ 255), the motions only differ by float rounding
+    assert len(stream) == len(offline) == frame_num
+    for frame, expected in zip(stream, offline):
+        assert frame.dtype == np.uint8 and frame.shape == expected.shape
+        diff = np.abs(frame.astype(np.int32) - expected.astype(np.int32))
+        # a quantization step, a little more on the few pixels where the linear blend is steep
+        assert diff.max() <= 4 and (diff > 1).mean() < 1e-3
@@ -0,0 +1,49 @@
+# coding: utf-8
+import torch
+import utils.torch_tps_transform as torch_tps_transform
+from geometry import get_rigid_mesh, get_norm_mesh
+
+
+IMG_H, IMG_W = 36, 48
+OUT_H, OUT_W = 40, 56
+
+
+def _frame(seed):
+    # a random image and a mesh slightly moved from the rigid mesh, as the smooth meshes of two frames
+    generator = torch.Generator().manual_seed(seed)
+    img = torch.rand(1, 3, IMG_H, IMG_W, generator=generator) * 255
+    rigid_mesh = get_rigid_mesh(1, IMG_H, IMG_W)
+    mesh = rigid_mesh + torch.randn(rigid_mesh.size(), generator=generator) * 1.5
+    norm_mesh = get_norm_mesh(mesh, OUT_H, OUT_W)
+    norm_rigid_mesh = get_norm_mesh(rigid_mesh, IMG_H, IMG_W)
+    return img, norm_mesh, norm_rigid_mesh
+
+
+def test_warper_matches_transformer_on_changing_meshes():
+    for mode, memory_budget in [('NORMAL', None), ('FAST', None), ('COARSE', None), ('NORMAL', 64 * 1024)]:
+        warper = torch_tps_transform.TPSWarper((OUT_H, OUT_W), mode, memory_budget)
+        for seed in (0, 1):
+            img, norm_mesh, norm_rigid_mesh = _frame(seed)
+            expected = torch_tps_transform.transformer(img, norm_mesh, norm_rigid_mesh, (OUT_H, OUT_W), mode, memory_budget)
+            assert torch.equal(warper(img, norm_mesh, norm_rigid_mesh), expected), (mode, memory_budget, seed)
+
+
+def test_warper_matches_transformer_in_window():
+    warper = torch_tps_transform.TPSWarper((OUT_H, OUT_W), 'NORMAL')
+    window = (5, 7, 20, 30)
+    for seed in (0, 1):
+        img, norm_mesh, norm_rigid_mesh = _frame(seed)
+        expected = torch_tps_transform.transformer(img, norm_mesh, norm_rigid_mesh, (OUT_H, OUT_W), 'NORMAL', window=window)
+        assert torch.equal(warper(img, norm_mesh, norm_rigid_mesh, window), expected)
+
+
+def test_warper_builds_pixel_grid_once_per_window():
+    warper = torch_tps_transform.TPSWarper((OUT_H, OUT_W), 'NORMAL')
+    for seed in range(3):
+        img, norm_mesh, norm_rigid_mesh = _frame(seed)
+        warper(img, norm_mesh, norm_rigid_mesh)
+    assert warper.grid_builds == 1
+
+    warper(img, norm_mesh, norm_rigid_mesh, (0, 0, 10, 10))
+    warper(img, norm_mesh, norm_rigid_mesh, (0, 0, 10, 10))
+    assert warper.grid_builds == 2
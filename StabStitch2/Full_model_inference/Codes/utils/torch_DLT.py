@@ -18,13 +18,9 @@ def tensor_DLT(src_p, dst_p):
    
     bs, _, _ = src_p.shape
 
-    ones = torch.ones(bs, 4, 1)
-    if torch.cuda.is_available():
-        ones = ones.cuda()
+    ones = torch.ones(bs, 4, 1, device=src_p.device)
     xy1 = torch.cat((src_p, ones), 2)
     zeros = torch.zeros_like(xy1)
-    if torch.cuda.is_available():
-        zeros = zeros.cuda()
 
     xyu, xyd = torch.cat((xy1, zeros), 2), torch.cat((zeros, xy1), 2)
     M1 = torch.cat((xyu, xyd), 2).reshape(bs, -1, 6)
@@ -42,4 +38,27 @@ def tensor_DLT(src_p, dst_p):
     h8 = torch.matmul(Ainv, b).reshape(bs, 8)
  
     H = torch.cat((h8, ones[:,0,:]), 1).reshape(bs, 3, 3)
-    return H
\ No newline at end of file
+    return H
+
+# batched 4-point DLT: the same system as tensor_DLT, solved with torch.linalg.solve (LU)
+# instead of forming A^{-1}; several homographies (e.g. H and H_tgt) can be stacked along bs
+# src_p, dst_p: shape=(bs, 4, 2) -> H: shape=(bs, 3, 3)
+def solve_DLT(src_p, dst_p):
+
+    bs = dst_p.shape[0]
+    src_p = src_p.expand(bs, -1, -1)
+
+    x, y = src_p[..., 0], src_p[..., 1]     # bs, 4
+    u, v = dst_p[..., 0], dst_p[..., 1]
+    one, zero = torch.ones_like(x), torch.zeros_like(x)
+
+    # the two rows of every point pair, interleaved as in tensor_DLT
+    A_u = torch.stack((x, y, one, zero, zero, zero, -x*u, -y*u), 2)
+    A_v = torch.stack((zero, zero, zero, x, y, one, -x*v, -y*v), 2)
+    A = torch.stack((A_u, A_v), 2).reshape(bs, 8, 8)
+    b = dst_p.reshape(bs, 8, 1)
+
+    h8 = torch.linalg.solve(A, b).reshape(bs, 8)
+
+    H = torch.cat((h8, one[:, 0:1]), 1).reshape(bs, 3, 3)
+    return H
@@ -38,15 +38,6 @@ def transformer(U, theta, out_size, **kwargs):
 
     """
 
-    def _repeat(x, n_repeats):
-
-        rep = torch.ones([n_repeats, ]).unsqueeze(0)
-        rep = rep.int()
-        x = x.int()
-
-        x = torch.matmul(x.reshape([-1,1]), rep)
-        return x.reshape([-1])
-
     def _interpolate(im, x, y, out_size):
 
         num_batch, num_channels , height, width = im.size()
@@ -72,18 +63,11 @@ def transformer(U, theta, out_size, **kwargs):
         x1 = torch.clamp(x1, zero, max_x)
         y0 = torch.clamp(y0, zero, max_y)
         y1 = torch.clamp(y1, zero, max_y)
-        dim2 = torch.from_numpy( np.array(width) )
-        dim1 = torch.from_numpy( np.array(width * height) )
-
-        base = _repeat(torch.arange(0,num_batch) * dim1, out_height * out_width)
-        if torch.cuda.is_available():
-            dim2 = dim2.cuda()
-            dim1 = dim1.cuda()
-            y0 = y0.cuda()
-            y1 = y1.cuda()
-            x0 = x0.cuda()
-            x1 = x1.cuda()
-            base = base.cuda()
+        dim2 = width
+        dim1 = width * height
+
+        # built on the device of the image, no host-to-device copy per call
+        base = torch.arange(0, num_batch, device=im.device).repeat_interleave(out_height * out_width) * dim1
         base_y0 = base + y0 * dim2
         base_y1 = base + y1 * dim2
         idx_a = base_y0 + x0
@@ -124,12 +108,12 @@ def transformer(U, theta, out_size, **kwargs):
 
         return output
 
-    def _meshgrid(height, width):
+    def _meshgrid(height, width, device):
 
-        x_t = torch.matmul(torch.ones([height, 1]),
-                               torch.transpose(torch.unsqueeze(torch.linspace(-1.0, 1.0, width), 1), 1, 0))
-        y_t = torch.matmul(torch.unsqueeze(torch.linspace(-1.0, 1.0, height), 1),
-                               torch.ones([1, width]))
+        x_t = torch.matmul(torch.ones([height, 1], device=device),
+                               torch.transpose(torch.unsqueeze(torch.linspace(-1.0, 1.0, width, device=device), 1), 1, 0))
+        y_t = torch.matmul(torch.unsqueeze(torch.linspace(-1.0, 1.0, height, device=device), 1),
+                               torch.ones([1, width], device=device))
         #x_t = torch.matmul(torch.ones([height, 1]),
         #                       torch.transpose(torch.unsqueeze(torch.linspace(0.0, width.float(), width), 1), 1, 0))
         #y_t = torch.matmul(torch.unsqueeze(torch.linspace(0.0, height.float(), height), 1),
@@ -140,8 +124,6 @@ def transformer(U, theta, out_size, **kwargs):
 
         ones = torch.ones_like(x_t_flat)
         grid = torch.cat([x_t_flat, y_t_flat, ones], 0)
-        if torch.cuda.is_available():
-            grid = grid.cuda()
         return grid
 
     def _transform(theta, input_dim, out_size):
@@ -150,7 +132,7 @@ def transformer(U, theta, out_size, **kwargs):
         theta = theta.reshape([-1, 3, 3]).float()
 
         out_height, out_width = out_size[0], out_size[1]
-        grid = _meshgrid(out_height, out_width)
+        grid = _meshgrid(out_height, out_width, theta.device)
         grid = grid.unsqueeze(0).reshape([1,-1])
         shape = grid.size()
         grid = grid.expand(num_batch,shape[1])
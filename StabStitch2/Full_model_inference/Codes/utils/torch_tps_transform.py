@@ -4,7 +4,10 @@ import cv2
 import torch.nn.functional as F
 
 
-def transformer(U, source, target, out_size, mode = 'NORMAL'):
+# spacing (output pixels) of the TPS evaluation grid of the COARSE warp mode
+COARSE_STEP = 8
+
+def transformer(U, source, target, out_size, mode = 'NORMAL', memory_budget = None, coarse_step = COARSE_STEP, window = None):
     """
     Thin Plate Spline Spatial Transformer Layer
   TPS control points are arranged in arbitrary positions given by `source`.
@@ -16,221 +19,422 @@ def transformer(U, source, target, out_size, mode = 'NORMAL'):
     The target position of the control points.
   out_size: tuple of two integers [height, width]
     The size of the output of the network (height, width)
+  memory_budget: int (bytes) or None
+    If given, the output is computed in bands of rows so that the temporary tensors of
+    each band stay within this budget. The result is the same as without tiling.
+    (ignored by the COARSE mode, which never builds the dense basis)
+  mode: 'NORMAL', 'FAST' or 'COARSE'
+    COARSE evaluates the TPS every `coarse_step` output pixels only and bilinearly
+    upsamples the sampling field (see coarse_error for its accuracy).
+  window: tuple of four integers (row, col, height, width) or None
+    If given, only this rectangle of the output is computed, and the result is
+    [num_batch, num_channels, height, width]: the same pixels as the full output.
     """
 
-    def _repeat(x, n_repeats):
-
-        rep = torch.ones([n_repeats, ]).unsqueeze(0)
-        rep = rep.int()
-        x = x.int()
-
-        x = torch.matmul(x.reshape([-1,1]), rep)
-        return x.reshape([-1])
-
-    def _interpolate(im, x, y, out_size):
-
-        num_batch, num_channels , height, width = im.size()
-
-        height_f = height
-        width_f = width
-        out_height, out_width = out_size[0], out_size[1]
-
-        zero = 0
-        max_y = height - 1
-        max_x = width - 1
-
-        x = (x + 1.0)*(width_f) / 2.0
-        y = (y + 1.0) * (height_f) / 2.0
-
-        # do sampling
-        x0 = torch.floor(x).int()
-        x1 = x0 + 1
-        y0 = torch.floor(y).int()
-        y1 = y0 + 1
-
-        x0 = torch.clamp(x0, zero, max_x)
-        x1 = torch.clamp(x1, zero, max_x)
-        y0 = torch.clamp(y0, zero, max_y)
-        y1 = torch.clamp(y1, zero, max_y)
-        dim2 = torch.from_numpy( np.array(width) )
-        dim1 = torch.from_numpy( np.array(width * height) )
-
-        base = _repeat(torch.arange(0,num_batch) * dim1, out_height * out_width)
-        if torch.cuda.is_available():
-            dim2 = dim2.cuda()
-            dim1 = dim1.cuda()
-            y0 = y0.cuda()
-            y1 = y1.cuda()
-            x0 = x0.cuda()
-            x1 = x1.cuda()
-            base = base.cuda()
-        base_y0 = base + y0 * dim2
-        base_y1 = base + y1 * dim2
-        idx_a = base_y0 + x0
-        idx_b = base_y1 + x0
-        idx_c = base_y0 + x1
-        idx_d = base_y1 + x1
-
-        # channels dim
-        im = im.permute(0,2,3,1)
-        im_flat = im.reshape([-1, num_channels]).float()
-
-
-        idx_a = idx_a.unsqueeze(-1).long()
-        idx_a = idx_a.expand(out_height * out_width * num_batch,num_channels)
-        Ia = torch.gather(im_flat, 0, idx_a)
-
-        idx_b = idx_b.unsqueeze(-1).long()
-        idx_b = idx_b.expand(out_height * out_width * num_batch, num_channels)
-        Ib = torch.gather(im_flat, 0, idx_b)
-
-        idx_c = idx_c.unsqueeze(-1).long()
-        idx_c = idx_c.expand(out_height * out_width * num_batch, num_channels)
-        Ic = torch.gather(im_flat, 0, idx_c)
-
-        idx_d = idx_d.unsqueeze(-1).long()
-        idx_d = idx_d.expand(out_height * out_width * num_batch, num_channels)
-        Id = torch.gather(im_flat, 0, idx_d)
-
-        x0_f = x0.float()
-        x1_f = x1.float()
-        y0_f = y0.float()
-        y1_f = y1.float()
-
-        wa = torch.unsqueeze(((x1_f - x) * (y1_f - y)), 1)
-        wb = torch.unsqueeze(((x1_f - x) * (y - y0_f)), 1)
-        wc = torch.unsqueeze(((x - x0_f) * (y1_f - y)), 1)
-        wd = torch.unsqueeze(((x - x0_f) * (y - y0_f)), 1)
-        output = wa*Ia+wb*Ib+wc*Ic+wd*Id
+    T = _solve_system(source, target)
+    #t = np.load("ttt.npy")
+    #t = torch.tensor(t).cuda()
+    #T = t.expand(source.size()[0],-1,-1)
+    #print("xxxxxxxxxxxxxxxxxxxx")
+    #print(T[0].cpu().detach().numpy())
+    if mode == 'COARSE':
+        output = _transform_coarse(T, source, U, out_size, coarse_step, window=window)
+    else:
+        pixel_grid = None
+        if window is not None:
+            pixel_grid = _pixel_grid(int(out_size[0]), int(out_size[1]), source.device, window)
+            out_size = window[2:]
+        if memory_budget is None:
+            output = _transform(T, source, U, out_size, mode, _meshgrid(out_size[0], out_size[1], source, pixel_grid))
+        else:
+            output = _transform_tiled(T, source, U, out_size, mode, memory_budget, pixel_grid)
+
+    return output#, condition
+
+
+
+class TPSWarper(object):
+    """
+    TPS warping into a fixed output size, keeping the terms that do not change between frames.
+
+    The normalized pixel grid of the output (or of its coarse grid, or of a window) only depends
+    on the output size, so the warper builds it once and reuses it across the frames of a clip.
+    The basis [bn, 3+pn, h*w] and the inverse of the TPS system depend on the source control
+    points, which are the per-frame smooth meshes in the stitching pipeline: they are built
+    again on every call, as in transformer(). The output is identical to transformer().
+
+    With a memory_budget (bytes), the output is computed in bands of rows as in
+    transformer(..., memory_budget).
+
+    A window (row, col, height, width) restricts the warp to a rectangle of the output, as
+    in transformer(..., window). The pixel grid is kept for the last window, so use one
+    warper per view when several views are warped into their own windows.
+
+    T: optional TPS parameters of (source, target) from solve_system(), when the caller already
+    solved them (e.g. to bound the warped image on the output).
+
+    grid_builds counts how many times the pixel grid was built.
+
+    Usage:
+        warper = TPSWarper((out_height, out_width), mode = 'NORMAL')
+        for ...:
+            output = warper(U, source, target)   # == transformer(U, source, target, out_size, mode)
+    """
+
+    def __init__(self, out_size, mode = 'NORMAL', memory_budget = None, coarse_step = COARSE_STEP):
+        self.out_size = (int(out_size[0]), int(out_size[1]))
+        self.mode = mode
+        self.memory_budget = memory_budget
+        self.coarse_step = coarse_step
+        self.grid_builds = 0
+        self.clear()
+
+    def clear(self):
+        self.pixel_grid = None
+        self.window = None
+
+    # update the pixel grid for `window` on the device of `source`
+    def _update(self, source, window):
+        out_height, out_width = self.out_size
+        if self.mode == 'COARSE':
+            out_height, out_width = _coarse_size(self.out_size, self.coarse_step)
+            # the coarse field always covers the whole output, the window is cut after upsampling
+            window = None
+        if self.pixel_grid is None or self.pixel_grid[0].device != source.device or self.window != window:
+            self.pixel_grid = _pixel_grid(out_height, out_width, source.device, window)
+            self.window = window
+            self.grid_builds += 1
+
+    def __call__(self, U, source, target, window = None, T = None):
+        if window is not None:
+            window = tuple(int(v) for v in window)
+        self._update(source, window)
+        if T is None:
+            T = _solve_system(source, target)
+        out_size = self.out_size if window is None else window[2:]
+        if self.mode == 'COARSE':
+            coarse_height, coarse_width = _coarse_size(self.out_size, self.coarse_step)
+            grid = _meshgrid(coarse_height, coarse_width, source, self.pixel_grid)
+            output = _transform_coarse(T, source, U, self.out_size, self.coarse_step, grid, window)
+        elif self.memory_budget is None:
+            output = _transform(T, source, U, out_size, self.mode, _meshgrid(out_size[0], out_size[1], source, self.pixel_grid))
+        else:
+            output = _transform_tiled(T, source, U, out_size, self.mode, self.memory_budget, self.pixel_grid)
 
         return output
 
-    def _meshgrid(height, width, source):
-
-        x_t = torch.matmul(torch.ones([height, 1]), torch.unsqueeze(torch.linspace(-1.0, 1.0, width), 0))
-        y_t = torch.matmul(torch.unsqueeze(torch.linspace(-1.0, 1.0, height), 1), torch.ones([1, width]))
-        if torch.cuda.is_available():
-            x_t = x_t.cuda()
-            y_t = y_t.cuda()
-
-        x_t_flat = x_t.reshape([1, 1, -1])
-        y_t_flat = y_t.reshape([1, 1, -1])
-
-        num_batch = source.size()[0]
-        px = torch.unsqueeze(source[:,:,0], 2)  # [bn, pn, 1]
-        py = torch.unsqueeze(source[:,:,1], 2)  # [bn, pn, 1]
-        if torch.cuda.is_available():
-            px = px.cuda()
-            py = py.cuda()
-        d2 = torch.square(x_t_flat - px) + torch.square(y_t_flat - py)
-        r = d2 * torch.log(d2 + 1e-6) # [bn, pn, h*w]
-        x_t_flat_g = x_t_flat.expand(num_batch, -1, -1)  # [bn, 1, h*w]
-        y_t_flat_g = y_t_flat.expand(num_batch, -1, -1)  # [bn, 1, h*w]
-        ones = torch.ones_like(x_t_flat_g) # [bn, 1, h*w]
-        if torch.cuda.is_available():
-            ones = ones.cuda()
-
-        grid = torch.cat((ones, x_t_flat_g, y_t_flat_g, r), 1) # [bn, 3+pn, h*w]
-
-        #if torch.cuda.is_available():
-        #    grid = grid.cuda()
-        return grid
-
-    def _transform(T, source, input_dim, out_size, mode):
-        num_batch, num_channels, height, width = input_dim.size()
-
-        out_height, out_width = out_size[0], out_size[1]
+
+
+def _interpolate(im, x, y, out_size):
+
+    num_batch, num_channels , height, width = im.size()
+
+    height_f = height
+    width_f = width
+    out_height, out_width = out_size[0], out_size[1]
+
+    zero = 0
+    max_y = height - 1
+    max_x = width - 1
+
+    x = (x + 1.0)*(width_f) / 2.0
+    y = (y + 1.0) * (height_f) / 2.0
+
+    # do sampling
+    x0 = torch.floor(x).int()
+    x1 = x0 + 1
+    y0 = torch.floor(y).int()
+    y1 = y0 + 1
+
+    x0 = torch.clamp(x0, zero, max_x)
+    x1 = torch.clamp(x1, zero, max_x)
+    y0 = torch.clamp(y0, zero, max_y)
+    y1 = torch.clamp(y1, zero, max_y)
+    dim2 = width
+    dim1 = width * height
+
+    # built on the device of the image, no host-to-device copy per call
+    base = torch.arange(0, num_batch, device=im.device).repeat_interleave(out_height * out_width) * dim1
+    base_y0 = base + y0 * dim2
+    base_y1 = base + y1 * dim2
+    idx_a = base_y0 + x0
+    idx_b = base_y1 + x0
+    idx_c = base_y0 + x1
+    idx_d = base_y1 + x1
+
+    # channels dim
+    im = im.permute(0,2,3,1)
+    im_flat = im.reshape([-1, num_channels]).float()
+
+
+    idx_a = idx_a.unsqueeze(-1).long()
+    idx_a = idx_a.expand(out_height * out_width * num_batch,num_channels)
+    Ia = torch.gather(im_flat, 0, idx_a)
+
+    idx_b = idx_b.unsqueeze(-1).long()
+    idx_b = idx_b.expand(out_height * out_width * num_batch, num_channels)
+    Ib = torch.gather(im_flat, 0, idx_b)
+
+    idx_c = idx_c.unsqueeze(-1).long()
+    idx_c = idx_c.expand(out_height * out_width * num_batch, num_channels)
+    Ic = torch.gather(im_flat, 0, idx_c)
+
+    idx_d = idx_d.unsqueeze(-1).long()
+    idx_d = idx_d.expand(out_height * out_width * num_batch, num_channels)
+    Id = torch.gather(im_flat, 0, idx_d)
+
+    x0_f = x0.float()
+    x1_f = x1.float()
+    y0_f = y0.float()
+    y1_f = y1.float()
+
+    wa = torch.unsqueeze(((x1_f - x) * (y1_f - y)), 1)
+    wb = torch.unsqueeze(((x1_f - x) * (y - y0_f)), 1)
+    wc = torch.unsqueeze(((x - x0_f) * (y1_f - y)), 1)
+    wd = torch.unsqueeze(((x - x0_f) * (y - y0_f)), 1)
+    output = wa*Ia+wb*Ib+wc*Ic+wd*Id
+
+    return output
+
+# pixel coordinates of the output, normalized to -1 ~ 1: two [1, 1, h*w] tensors
+# window: (row, col, height, width), only the pixels of this rectangle (with their coordinates in the full output)
+def _pixel_grid(height, width, device, window=None):
+
+    x_c = torch.linspace(-1.0, 1.0, width, device=device)
+    y_c = torch.linspace(-1.0, 1.0, height, device=device)
+    if window is not None:
+        row, col, height, width = window
+        x_c = x_c[col:col+width]
+        y_c = y_c[row:row+height]
+    x_t = torch.matmul(torch.ones([height, 1], device=device), torch.unsqueeze(x_c, 0))
+    y_t = torch.matmul(torch.unsqueeze(y_c, 1), torch.ones([1, width], device=device))
+
+    x_t_flat = x_t.reshape([1, 1, -1])
+    y_t_flat = y_t.reshape([1, 1, -1])
+
+    return x_t_flat, y_t_flat
+
+def _meshgrid(height, width, source, pixel_grid=None):
+
+    if pixel_grid is None:
+        pixel_grid = _pixel_grid(height, width, source.device)
+    x_t_flat, y_t_flat = pixel_grid
+
+    num_batch = source.size()[0]
+    px = torch.unsqueeze(source[:,:,0], 2)  # [bn, pn, 1]
+    py = torch.unsqueeze(source[:,:,1], 2)  # [bn, pn, 1]
+    d2 = torch.square(x_t_flat - px) + torch.square(y_t_flat - py)
+    r = d2 * torch.log(d2 + 1e-6) # [bn, pn, h*w]
+    x_t_flat_g = x_t_flat.expand(num_batch, -1, -1)  # [bn, 1, h*w]
+    y_t_flat_g = y_t_flat.expand(num_batch, -1, -1)  # [bn, 1, h*w]
+    ones = torch.ones_like(x_t_flat_g) # [bn, 1, h*w]
+
+    grid = torch.cat((ones, x_t_flat_g, y_t_flat_g, r), 1) # [bn, 3+pn, h*w]
+
+    #if torch.cuda.is_available():
+    #    grid = grid.cuda()
+    return grid
+
+# grid: optional precomputed _meshgrid of source (see TPSWarper)
+def _transform(T, source, input_dim, out_size, mode, grid=None):
+    num_batch, num_channels, height, width = input_dim.size()
+
+    out_height, out_width = out_size[0], out_size[1]
+    if grid is None:
         grid = _meshgrid(out_height, out_width, source) # [bn, 3+pn, h*w]
 
-        # transform A x (1, x_t, y_t, r1, r2, ..., rn) -> (x_s, y_s)
-        # [bn, 2, pn+3] x [bn, pn+3, h*w] -> [bn, 2, h*w]
-        T_g = torch.matmul(T, grid)
-        x_s = T_g[:,0,:]
-        y_s = T_g[:,1,:]
-
-        if mode == 'NORMAL':
-            # original iterpolation implementation
-            x_s_flat = x_s.reshape([-1])
-            y_s_flat = y_s.reshape([-1])
-            input_transformed = _interpolate(input_dim, x_s_flat, y_s_flat, out_size)
-            output = input_transformed.reshape([num_batch, out_height, out_width, num_channels])
-            output = output.permute(0,3,1,2)
-        else:
-            # using F.grid_sample to implement
-            x_s_flat = x_s.reshape([num_batch, 1, out_height, out_width])
-            y_s_flat = y_s.reshape([num_batch, 1, out_height, out_width])
-            output = F.grid_sample(input_dim, torch.cat([x_s_flat, y_s_flat], 1).permute(0,2,3,1), align_corners=True)
+    # transform A x (1, x_t, y_t, r1, r2, ..., rn) -> (x_s, y_s)
+    # [bn, 2, pn+3] x [bn, pn+3, h*w] -> [bn, 2, h*w]
+    T_g = torch.matmul(T, grid)
+    x_s = T_g[:,0,:]
+    y_s = T_g[:,1,:]
 
+    if mode == 'NORMAL':
+        # original iterpolation implementation
+        x_s_flat = x_s.reshape([-1])
+        y_s_flat = y_s.reshape([-1])
+        input_transformed = _interpolate(input_dim, x_s_flat, y_s_flat, out_size)
+        output = input_transformed.reshape([num_batch, out_height, out_width, num_channels])
+        output = output.permute(0,3,1,2)
+    else:
+        # using F.grid_sample to implement
+        x_s_flat = x_s.reshape([num_batch, 1, out_height, out_width])
+        y_s_flat = y_s.reshape([num_batch, 1, out_height, out_width])
+        output = F.grid_sample(input_dim, torch.cat([x_s_flat, y_s_flat], 1).permute(0,2,3,1), align_corners=True)
 
-        return output
 
+    return output
+
+
+# size of the coarse evaluation grid: about one node every coarse_step pixels, including both borders
+def _coarse_size(out_size, coarse_step):
+    out_height, out_width = int(out_size[0]), int(out_size[1])
+    coarse_height = max(2, -(-(out_height - 1) // coarse_step) + 1)
+    coarse_width = max(2, -(-(out_width - 1) // coarse_step) + 1)
+
+    return coarse_height, coarse_width
+
+# TPS sampling field evaluated on the coarse grid: [bn, 2, coarse_height, coarse_width]
+def _coarse_field(T, source, out_size, coarse_step, grid=None):
+    coarse_height, coarse_width = _coarse_size(out_size, coarse_step)
+    if grid is None:
+        grid = _meshgrid(coarse_height, coarse_width, source)
+
+    T_g = torch.matmul(T, grid) # [bn, 2, ch*cw]
+
+    return T_g.reshape([-1, 2, coarse_height, coarse_width])
 
-    def _solve_system(source, target):
-        num_batch  = source.size()[0]
-        num_point  = source.size()[1]
-
-        np.set_printoptions(precision=8)
-
-        ones = torch.ones(num_batch, num_point, 1).float()
-        if torch.cuda.is_available():
-            ones = ones.cuda()
-        p = torch.cat([ones, source], 2) # [bn, pn, 3]
-
-        p_1 = p.reshape([num_batch, -1, 1, 3]) # [bn, pn, 1, 3]
-        p_2 = p.reshape([num_batch, 1, -1, 3])  # [bn, 1, pn, 3]
-        d2 = torch.sum(torch.square(p_1-p_2), 3) # p1 - p2: [bn, pn, pn, 3]   final output: [bn, pn, pn]
-        #print("xxxxxxxxxxxxxxxxxxxx")
-        #torch.set_printoptions(precision=8)
-        #print(d2[0])
-        #print(d2.dtype)
-        r = d2 * torch.log(d2 + 1e-6) # [bn, pn, pn]
-        #print("xxxxxxxxxxxxxxxxxxxx")
-        #print(torch.log(d2 + 1e-6)[0].cpu().detach().numpy())
-        #print("xxxxxxxxxxxxxxxxxxxx")
-        #print(r[0].cpu().detach().numpy())
-        #print("---------------------------------------------------------")
-
-        zeros = torch.zeros(num_batch, 3, 3).float()
-        if torch.cuda.is_available():
-            zeros = zeros.cuda()
-        W_0 = torch.cat((p, r), 2) # [bn, pn, 3+pn]
-        W_1 = torch.cat((zeros, p.permute(0,2,1)), 2) # [bn, 3, pn+3]
-        W = torch.cat((W_0, W_1), 1) # [bn, pn+3, pn+3]
-
-        #w = np.load("www.npy")
-        #w = torch.tensor(w).cuda()
-        #W = w.expand(source.size()[0],-1,-1)
-        #print("xxxxxxxxxxxxxxxxxxxx")
-        #print("W")
-        #print(W[0].cpu().detach().numpy())
-        W_inv = torch.inverse(W.type(torch.float64))
-
-        #W_inv_np = np.linalg.inv(W.cpu().detach().numpy())
-        #W_inv = torch.tensor(W_inv_np).cuda()
-        #print("xxxxxxxxxxxxxxxxxxxx")
-        #print("W_inv")
-        #print(W_inv[0].cpu().detach().numpy())
-
-        zeros2 = torch.zeros(num_batch, 3, 2)
-        if torch.cuda.is_available():
-            zeros2 = zeros2.cuda()
-        tp = torch.cat((target, zeros2), 1) # [bn, pn+3, 2]
-        #print("xxxxxxxxxxxxxxxxxxxx")
-        #print(tp[0].cpu().detach().numpy())
-        T = torch.matmul(W_inv, tp.type(torch.float64)) # [bn, pn+3, 2]
-        T = T.permute(0, 2, 1) # [bn, 2, pn+3]
-        #print("xxxxxxxxxxxxxxxxxxxx")
-        #print(T[0].cpu().detach().numpy())
-        #print(T.size())
-
-        return T.type(torch.float32)
+# COARSE mode: exact TPS on the coarse grid, bilinearly upsampled to every output pixel,
+# then sampled by F.grid_sample with the pixel convention of the NORMAL mode
+# window: (row, col, height, width), only this rectangle of the upsampled field is sampled
+def _transform_coarse(T, source, input_dim, out_size, coarse_step, grid=None, window=None):
+    num_batch, num_channels, height, width = input_dim.size()
 
+    out_height, out_width = int(out_size[0]), int(out_size[1])
+    field = _coarse_field(T, source, out_size, coarse_step, grid)
+    # the coarse nodes and the output pixels both span -1 ~ 1 corner to corner
+    field = F.interpolate(field, size=(out_height, out_width), mode='bilinear', align_corners=True)
+    if window is not None:
+        row, col, win_height, win_width = window
+        field = field[:, :, row:row+win_height, col:col+win_width]
+
+    # NORMAL samples x at (x+1)*W/2, grid_sample(align_corners=False) at ((x+1)*W-1)/2
+    shift = torch.tensor([1. / width, 1. / height], device=field.device).reshape([1, 2, 1, 1])
+    output = F.grid_sample(input_dim, (field + shift).permute(0,2,3,1), mode='bilinear', padding_mode='zeros', align_corners=False)
+
+    return output
+
+def coarse_error(source, target, out_size, in_size, coarse_step = COARSE_STEP):
+    """
+    Estimate how far the COARSE warp mode samples from the exact TPS.
+    The TPS is evaluated exactly at the centers and edge midpoints of the coarse cells,
+    where bilinear interpolation of a smooth field deviates the most, and compared
+    with the interpolated field.
+  source, target, out_size: as in transformer()
+  in_size: (height, width) of the warped input, to express the error in input pixels
+  Returns (max_error, mean_error) in input pixels, per batch element: two [bn] tensors.
+    """
+
+    in_height, in_width = int(in_size[0]), int(in_size[1])
     T = _solve_system(source, target)
-    #t = np.load("ttt.npy")
-    #t = torch.tensor(t).cuda()
-    #T = t.expand(source.size()[0],-1,-1)
+    field = _coarse_field(T, source, out_size, coarse_step) # [bn, 2, ch, cw]
+    coarse_height, coarse_width = field.size()[2], field.size()[3]
+
+    # cell centers and midpoints of the horizontal and vertical edges, with their interpolated values
+    device = source.device
+    x_c = torch.linspace(-1.0, 1.0, 2 * coarse_width - 1, device=device)
+    y_c = torch.linspace(-1.0, 1.0, 2 * coarse_height - 1, device=device)
+    field_fine = F.interpolate(field, size=(2 * coarse_height - 1, 2 * coarse_width - 1), mode='bilinear', align_corners=True)
+    odd = torch.zeros(2 * coarse_height - 1, 2 * coarse_width - 1, dtype=torch.bool, device=device)
+    odd[1::2, :] = True
+    odd[:, 1::2] = True
+    x_t = x_c.unsqueeze(0).expand(2 * coarse_height - 1, -1)[odd].reshape([1, 1, -1])
+    y_t = y_c.unsqueeze(1).expand(-1, 2 * coarse_width - 1)[odd].reshape([1, 1, -1])
+
+    grid = _meshgrid(1, x_t.size()[2], source, (x_t, y_t))
+    exact = torch.matmul(T, grid) # [bn, 2, n]
+    approx = field_fine.reshape([field.size()[0], 2, -1])[..., odd.reshape([-1])]
+
+    scale = torch.tensor([in_width / 2., in_height / 2.], device=device).reshape([1, 2, 1])
+    error = torch.sqrt(torch.sum(torch.square((exact - approx) * scale), 1)) # [bn, n]
+
+    return error.max(1)[0], error.mean(1)
+
+# inverse of the TPS system matrix W [bn, pn+3, pn+3] (float64), it only depends on source
+def _system_inverse(source):
+    num_batch  = source.size()[0]
+    num_point  = source.size()[1]
+
+    np.set_printoptions(precision=8)
+
+    ones = torch.ones(num_batch, num_point, 1, device=source.device).float()
+    p = torch.cat([ones, source], 2) # [bn, pn, 3]
+
+    p_1 = p.reshape([num_batch, -1, 1, 3]) # [bn, pn, 1, 3]
+    p_2 = p.reshape([num_batch, 1, -1, 3])  # [bn, 1, pn, 3]
+    d2 = torch.sum(torch.square(p_1-p_2), 3) # p1 - p2: [bn, pn, pn, 3]   final output: [bn, pn, pn]
+    #print("xxxxxxxxxxxxxxxxxxxx")
+    #torch.set_printoptions(precision=8)
+    #print(d2[0])
+    #print(d2.dtype)
+    r = d2 * torch.log(d2 + 1e-6) # [bn, pn, pn]
+    #print("xxxxxxxxxxxxxxxxxxxx")
+    #print(torch.log(d2 + 1e-6)[0].cpu().detach().numpy())
+    #print("xxxxxxxxxxxxxxxxxxxx")
+    #print(r[0].cpu().detach().numpy())
+    #print("---------------------------------------------------------")
+
+    zeros = torch.zeros(num_batch, 3, 3, device=source.device).float()
+    W_0 = torch.cat((p, r), 2) # [bn, pn, 3+pn]
+    W_1 = torch.cat((zeros, p.permute(0,2,1)), 2) # [bn, 3, pn+3]
+    W = torch.cat((W_0, W_1), 1) # [bn, pn+3, pn+3]
+
+    #w = np.load("www.npy")
+    #w = torch.tensor(w).cuda()
+    #W = w.expand(source.size()[0],-1,-1)
+    #print("xxxxxxxxxxxxxxxxxxxx")
+    #print("W")
+    #print(W[0].cpu().detach().numpy())
+    W_inv = torch.inverse(W.type(torch.float64))
+
+    #W_inv_np = np.linalg.inv(W.cpu().detach().numpy())
+    #W_inv = torch.tensor(W_inv_np).cuda()
+    #print("xxxxxxxxxxxxxxxxxxxx")
+    #print("W_inv")
+    #print(W_inv[0].cpu().detach().numpy())
+
+    return W_inv
+
+# number of output rows per band so that the temporaries of a band fit in memory_budget bytes
+# per output pixel and batch element: the basis column (3+pn) and its d2/log temporaries (~4*pn),
+# the sampling coordinates, indices and weights (~35 words), the four gathers and the blend (~7*C)
+def _band_rows(num_batch, num_point, num_channels, out_width, memory_budget):
+    pixel_bytes = 4 * (5 * num_point + 7 * num_channels + 35)
+    band_rows = int(memory_budget) // (num_batch * int(out_width) * pixel_bytes)
+
+    return max(1, band_rows)
+
+# same as _transform, computing the output in bands of rows
+# every output pixel goes through the same operations as in _transform, only fewer at a time
+def _transform_tiled(T, source, input_dim, out_size, mode, memory_budget, pixel_grid=None):
+    num_batch, num_channels, height, width = input_dim.size()
+
+    out_height, out_width = int(out_size[0]), int(out_size[1])
+    if pixel_grid is None:
+        pixel_grid = _pixel_grid(out_height, out_width, source.device)
+    x_t_flat, y_t_flat = pixel_grid
+
+    band_rows = _band_rows(num_batch, source.size()[1], num_channels, out_width, memory_budget)
+    output = torch.empty([num_batch, num_channels, out_height, out_width], device=input_dim.device)
+    for row in range(0, out_height, band_rows):
+        rows = min(band_rows, out_height - row)
+        band_grid = (x_t_flat[..., row*out_width:(row+rows)*out_width], y_t_flat[..., row*out_width:(row+rows)*out_width])
+        grid = _meshgrid(rows, out_width, source, band_grid) # [bn, 3+pn, rows*w]
+        output[:, :, row:row+rows] = _transform(T, source, input_dim, (rows, out_width), mode, grid)
+
+    return output
+
+# TPS parameters [bn, 2, pn+3] mapping the control points source to target, for TPSWarper(..., T)
+# and torch_tps_transform_point.transform_points
+def solve_system(source, target):
+    return _solve_system(source, target)
+
+# T: [bn, 2, pn+3], the TPS parameters mapping source to target
+# W_inv: optional precomputed _system_inverse(source)
+def _solve_system(source, target, W_inv=None):
+    num_batch  = source.size()[0]
+
+    if W_inv is None:
+        W_inv = _system_inverse(source)
+
+    zeros2 = torch.zeros(num_batch, 3, 2, device=target.device)
+    tp = torch.cat((target, zeros2), 1) # [bn, pn+3, 2]
+    #print("xxxxxxxxxxxxxxxxxxxx")
+    #print(tp[0].cpu().detach().numpy())
+    T = torch.matmul(W_inv, tp.type(torch.float64)) # [bn, pn+3, 2]
+    T = T.permute(0, 2, 1) # [bn, 2, pn+3]
     #print("xxxxxxxxxxxxxxxxxxxx")
     #print(T[0].cpu().detach().numpy())
-    output = _transform(T, source, U, out_size, mode)
+    #print(T.size())
 
-    return output#, condition
\ No newline at end of file
+    return T.type(torch.float32)
@@ -0,0 +1,225 @@
+# coding: utf-8
+import os
+import glob
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import torch
+from frame_source import VIDEO_EXTENSIONS, STORE_SUFFIX, is_video, is_frame_store, find_store, open_video, read_frame
+
+
+
+# rendered frame to what cv2.VideoWriter expects: [3, H, W] float (0 ~ 255) -> [H, W, 3] uint8 numpy array
+# the frame is quantized on its device, so only a quarter of the float data goes to the host
+# values are clamped to 0 ~ 255, then truncated as numpy's astype(np.uint8) does: the frames match the
+# former astype(np.uint8) output up to clamping (astype wraps the values out of 0 ~ 255)
+def to_uint8_frame(frame):
+    return frame.clamp(0, 255).to(torch.uint8).permute(1, 2, 0).contiguous().cpu().numpy()
+
+
+# high-resolution network input: BGR uint8 [H, W, 3] -> float32 [1, 3, H, W] tensor (0 ~ 255)
+def to_hr_tensor(img):
+    return torch.tensor(np.transpose(img.astype(np.float32), [2, 0, 1])).unsqueeze(0)
+
+
+class LazyFrameList(object):
+    """
+    Full-resolution frames of a clip, decoded only when they are used.
+
+    Behaves like the list of [1, 3, H, W] float32 tensors (len() and indexing) but only keeps the
+    sources of the frames: image paths, compact BGR uint8 [H, W, 3] arrays (e.g. views of a
+    frame_source.FrameStore), or a VideoFrames decoding them from a video file. A frame is read and converted when it is indexed. When the
+    frames are used in order, the next `prefetch` ones are decoded by a background thread while
+    the current one is warped, and at most prefetch+1 converted frames are held in memory.
+
+    Usage:
+        img_hr_tensor_list = LazyFrameList(sorted(glob.glob(path + '*.jpg')), prefetch = 2)
+        for i in range(len(img_hr_tensor_list)):
+            img_hr_tensor = img_hr_tensor_list[i]
+    """
+
+    def __init__(self, sources, prefetch = 2):
+        self.sources = sources if isinstance(sources, VideoFrames) else list(sources)
+        self.prefetch = prefetch
+        self.executor = None
+        # index -> future of the frames being prefetched
+        self.pending = {}
+        # last returned frame, indexing the same frame again does not decode it twice
+        self.last = (None, None)
+
+    def __len__(self):
+        return len(self.sources)
+
+    def _load(self, index):
+        source = self.sources[index]
+        img = read_frame(source) if isinstance(source, str) else source
+        return to_hr_tensor(img)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("frame index out of range")
+        if self.last[0] == index:
+            return self.last[1]
+
+        future = self.pending.pop(index, None)
+        frame = self._load(index) if future is None else future.result()
+
+        # keep only the frames ahead of this one, and request the missing ones
+        for k in [k for k in self.pending if not index < k <= index + self.prefetch]:
+            self.pending.pop(k).cancel()
+        if self.prefetch > 0:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers = 1)
+            for k in range(index + 1, min(index + self.prefetch, len(self) - 1) + 1):
+                if k not in self.pending:
+                    self.pending[k] = self.executor.submit(self._load, k)
+
+        self.last = (index, frame)
+        return frame
+
+
+class VideoFrames(object):
+    """
+    First `length` frames of a video file as a sequence of BGR uint8 [H, W, 3] arrays,
+    decoded when they are indexed.
+
+    Indexing the frames in order decodes the stream once. Going backwards reopens the video,
+    and skipped frames are grabbed without being decoded, so the frames are always exactly
+    those of a sequential read (seeking with CAP_PROP_POS_FRAMES is not frame-accurate for
+    every codec). Safe to index from a prefetch thread (see LazyFrameList).
+    """
+
+    def __init__(self, path, length = None):
+        self.path = path
+        if length is None:
+            capture = open_video(path)
+            length = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+            capture.release()
+        self.length = length
+        self.capture = None
+        # index of the frame the capture reads next
+        self.next_index = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("frame index out of range")
+
+        with self.lock:
+            if self.capture is None or index < self.next_index:
+                self.release()
+                self.capture = open_video(self.path)
+                self.next_index = 0
+            while self.next_index < index:
+                if not self.capture.grab():
+                    break
+                self.next_index += 1
+            ok, img = self.capture.read()
+            if not ok:
+                raise IOError("cannot read frame {} of {}".format(index, self.path))
+            self.next_index += 1
+            return img
+
+    def release(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+
+# frames of an input view: the sorted .jpg files of a folder, or a video file (kept as its path, decoded on the fly)
+# a frame store built for the folder or the video (see frame_source.FrameStore) is used in their place
+def list_view(path):
+    store = find_store(path)
+    if store is not None:
+        return store.path
+    if is_video(path):
+        return path
+    return sorted(glob.glob(os.path.join(path, '*.jpg')))
+
+# view `name` of a clip: the frame folder clip_path/name/, or else the video file clip_path/name.mp4 (.mkv, ...),
+# or else the frame store clip_path/name.frames
+def find_view(clip_path, name):
+    view = os.path.join(clip_path, name)
+    if not os.path.isdir(view):
+        for ext in VIDEO_EXTENSIONS:
+            if os.path.isfile(view + ext):
+                return list_view(view + ext)
+        if is_frame_store(view + STORE_SUFFIX):
+            return view + STORE_SUFFIX
+    return list_view(view)
+
+# full-resolution frames of the first `length` frames of a view (see list_view), read lazily
+def lazy_view(view, length, prefetch = 2):
+    store = find_store(view) if isinstance(view, str) else None
+    if store is not None:
+        sources = store.native[:length]
+    elif is_video(view):
+        sources = VideoFrames(view, length)
+    else:
+        sources = view[:length]
+    return LazyFrameList(sources, prefetch)
+
+
+class AsyncVideoWriter(object):
+    """
+    cv2.VideoWriter that encodes in a background thread.
+
+    write() puts the frame into a bounded queue and returns as soon as there is room, so the
+    encoding of a frame overlaps with the rendering of the next ones, and at most queue_size
+    frames wait in memory. release() waits for the queued frames and closes the file.
+    An error of the encoder is raised by the next write() or by release().
+
+    Frames are uint8 [H, W, 3] BGR arrays (see to_uint8_frame), they must not be modified
+    after write().
+
+    Usage:
+        writer = AsyncVideoWriter(path, cv2.VideoWriter_fourcc('m', 'p', '4', 'v'), 30, (out_width, out_height))
+        for ...:
+            writer.write(to_uint8_frame(fusion[0]))
+        writer.release()
+    """
+
+    def __init__(self, path, fourcc, fps, frame_size, queue_size = 8):
+        self.writer = cv2.VideoWriter(path, fourcc, fps, (int(frame_size[0]), int(frame_size[1])))
+        self.queue = queue.Queue(maxsize = max(1, queue_size))
+        self.error = None
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def isOpened(self):
+        return self.writer.isOpened()
+
+    def _run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            # after an error, keep draining the queue so that write() never blocks
+            if self.error is None:
+                try:
+                    self.writer.write(frame)
+                except Exception as e:
+                    self.error = e
+
+    def write(self, frame):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(frame)
+
+    def release(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            self.writer.release()
+        if self.error is not None:
+            raise self.error
@@ -5,6 +5,7 @@ import os
 import glob
 from collections import OrderedDict
 import random
+from frame_source import load_frames
 
 
 class TrainDataset(Dataset):
@@ -80,8 +81,6 @@ class TrainDataset(Dataset):
         SMotion_tensor_list1 = []
         TMotion_tensor_list2 = []
         SMotion_tensor_list2 = []
-        img_tensor_list1 = []
-        img_tensor_list2 = []
 
         for i in range(0, self.selected_frame_num):
 
@@ -107,23 +106,10 @@ class TrainDataset(Dataset):
             smesh_tensor2 = torch.tensor(smotion2)
             SMotion_tensor_list2.append(smesh_tensor2)
 
-
-            # load imgs
-            img1 = cv2.imread(self.datas['img1'][ran[i]][index])
-            img1 = cv2.resize(img1, (self.width, self.height)).astype(dtype=np.float32)
-            img1 = (img1 / 127.5) - 1.0
-            img1 = np.transpose(img1, [2, 0, 1])
-            img_tensor1 = torch.tensor(img1)
-            img_tensor_list1.append(img_tensor1)
-
-            img2 = cv2.imread(self.datas['img2'][ran[i]][index])
-            img2 = cv2.resize(img2, (self.width, self.height)).astype(dtype=np.float32)
-            img2 = (img2 / 127.5) - 1.0
-            img2 = np.transpose(img2, [2, 0, 1])
-            img_tensor2 = torch.tensor(img2)
-            img_tensor_list2.append(img_tensor2)
-
-
+        # load imgs (decoded in parallel)
+        img_tensor_list = load_frames([self.datas['img1'][r][index] for r in ran] + [self.datas['img2'][r][index] for r in ran], self.width, self.height)
+        img_tensor_list1 = img_tensor_list[:self.selected_frame_num]
+        img_tensor_list2 = img_tensor_list[self.selected_frame_num:]
 
         return (TMotion_tensor_list1, TMotion_tensor_list2, SMotion_tensor_list1, SMotion_tensor_list2, img_tensor_list1, img_tensor_list2)
 
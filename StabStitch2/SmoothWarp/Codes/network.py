@@ -13,67 +13,13 @@ import torchvision.transforms as T
 import random
 from torch import nn, einsum
 from einops import rearrange
+from geometry import H2Mesh, get_rigid_mesh, get_norm_mesh, get_norm_rigid_mesh, recover_mesh
 
 import grid_res
 grid_h = grid_res.GRID_H
 grid_w = grid_res.GRID_W
 
 
-#Covert global homo into mesh
-def H2Mesh(H, rigid_mesh):
-
-    H_inv = torch.inverse(H)
-    ori_pt = rigid_mesh.reshape(rigid_mesh.size()[0], -1, 2)
-    ones = torch.ones(rigid_mesh.size()[0], (grid_h+1)*(grid_w+1),1)
-    if torch.cuda.is_available():
-        ori_pt = ori_pt.cuda()
-        ones = ones.cuda()
-
-    ori_pt = torch.cat((ori_pt, ones), 2) # bs*(grid_h+1)*(grid_w+1)*3
-    tar_pt = torch.matmul(H_inv, ori_pt.permute(0,2,1)) # bs*3*(grid_h+1)*(grid_w+1)
-
-    mesh_x = torch.unsqueeze(tar_pt[:,0,:]/tar_pt[:,2,:], 2)
-    mesh_y = torch.unsqueeze(tar_pt[:,1,:]/tar_pt[:,2,:], 2)
-    mesh = torch.cat((mesh_x, mesh_y), 2).reshape([rigid_mesh.size()[0], grid_h+1, grid_w+1, 2])
-
-    return mesh
-
-
-def get_rigid_mesh(batch_size, height, width):
-
-
-    ww = torch.matmul(torch.ones([grid_h+1, 1]), torch.unsqueeze(torch.linspace(0., float(width), grid_w+1), 0))
-    hh = torch.matmul(torch.unsqueeze(torch.linspace(0.0, float(height), grid_h+1), 1), torch.ones([1, grid_w+1]))
-    if torch.cuda.is_available():
-        ww = ww.cuda()
-        hh = hh.cuda()
-
-    ori_pt = torch.cat((ww.unsqueeze(2), hh.unsqueeze(2)),2) # (grid_h+1)*(grid_w+1)*2
-    ori_pt = ori_pt.unsqueeze(0).expand(batch_size, -1, -1, -1)
-
-    return ori_pt
-
-def get_norm_mesh(mesh, height, width):
-    batch_size = mesh.size()[0]
-    mesh_w = mesh[...,0]*2./float(width) - 1.
-    mesh_h = mesh[...,1]*2./float(height) - 1.
-    norm_mesh = torch.stack([mesh_w, mesh_h], 3) # bs*(grid_h+1)*(grid_w+1)*2
-
-    return norm_mesh.reshape([batch_size, -1, 2]) # bs*-1*2
-
-def recover_mesh(norm_mesh, height, width):
-    #from [bs, pn, 2] to [bs, grid_h+1, grid_w+1, 2]
-
-    batch_size = norm_mesh.size()[0]
-    mesh_w = (norm_mesh[...,0]+1) * float(width) / 2.
-    mesh_h = (norm_mesh[...,1]+1) * float(height) / 2.
-    mesh = torch.stack([mesh_w, mesh_h], 2) # [bs,(grid_h+1)*(grid_w+1),2]
-
-    return mesh.reshape([batch_size, grid_h+1, grid_w+1, 2])
-
-
-
-
 def build_model(net, tmotion_tensor_list1, tmotion_tensor_list2, smotion_tensor_list1, smotion_tensor_list2, img_list1, img_list2):
 
     batch_size, _, img_h, img_w = img_list1[0].size()
@@ -83,7 +29,7 @@ def build_model(net, tmotion_tensor_list1, tmotion_tensor_list2, smotion_tensor_
     #############   data preparation  ############
     # converting tmotion (t-th frame) into tsmotion ( (t-1)-th frame )
     rigid_mesh = get_rigid_mesh(batch_size, img_h, img_w)
-    norm_rigid_mesh = get_norm_mesh(rigid_mesh, img_h, img_w)
+    norm_rigid_mesh = get_norm_rigid_mesh(batch_size, img_h, img_w)
     smesh_list1 = []
     tsmotion_list1 = []
     smesh_list2 = []
@@ -147,8 +93,7 @@ def build_model(net, tmotion_tensor_list1, tmotion_tensor_list2, smotion_tensor_
     mask_img = torch.ones_like(img1[:,0,...].unsqueeze(1)).cuda()
     norm_target_mesh1 = get_norm_mesh(target_mesh1[:,-1,...], img_h, img_w)
     norm_target_mesh2 = get_norm_mesh(target_mesh2[:,-1,...], img_h, img_w)
-    rigid_mesh = get_rigid_mesh(img1.shape[0], img_h, img_w)
-    norm_rigid_mesh = get_norm_mesh(rigid_mesh, img_h, img_w)
+    norm_rigid_mesh = get_norm_rigid_mesh(img1.shape[0], img_h, img_w)
     out1_img = torch_tps_transform.transformer(torch.cat([img1, mask_img], 1), norm_target_mesh1, norm_rigid_mesh,(img_h, img_w))
     out2_img = torch_tps_transform.transformer(torch.cat([img2, mask_img], 1), norm_target_mesh2, norm_rigid_mesh,(img_h, img_w))
     ovmask_img = (out1_img[:,-1,...] * out2_img[:,-1,...]).unsqueeze(1)
@@ -165,8 +110,7 @@ def build_model(net, tmotion_tensor_list1, tmotion_tensor_list2, smotion_tensor_
     #######################
     # step 2: get overlapping masks from target mesh12
     mask_spath = torch.ones_like(dense_spath1[:,0,...].unsqueeze(1)).cuda()
-    rigid_mesh = get_rigid_mesh(dense_spath1.shape[0], img_h, img_w)
-    norm_rigid_mesh = get_norm_mesh(rigid_mesh, img_h, img_w)
+    norm_rigid_mesh = get_norm_rigid_mesh(dense_spath1.shape[0], img_h, img_w)
     norm_target_mesh1 = get_norm_mesh(target_mesh1.reshape(-1, grid_h+1, grid_w+1, 2), img_h, img_w)
     norm_target_mesh2 = get_norm_mesh(target_mesh2.reshape(-1, grid_h+1, grid_w+1, 2), img_h, img_w)
     out1_spath = torch_tps_transform.transformer(torch.cat([dense_spath1, mask_spath], 1), norm_target_mesh1,norm_rigid_mesh, (int(img_h/4), int(img_w/4)))
@@ -5,6 +5,7 @@ import os
 import glob
 from collections import OrderedDict
 import random
+from frame_source import load_frames
 
 
 class TrainDataset(Dataset):
@@ -32,23 +33,8 @@ class TrainDataset(Dataset):
 
     def __getitem__(self, index):
 
-        # load image1
-        input1 = cv2.imread(self.datas['video1'][index])
-        input1 = cv2.resize(input1, (self.width, self.height))
-        input1 = input1.astype(dtype=np.float32)
-        input1 = (input1 / 127.5) - 1.0
-        input1 = np.transpose(input1, [2, 0, 1])
-
-        # load image2
-        input2 = cv2.imread(self.datas['video2'][index])
-        input2 = cv2.resize(input2, (self.width, self.height))
-        input2 = input2.astype(dtype=np.float32)
-        input2 = (input2 / 127.5) - 1.0
-        input2 = np.transpose(input2, [2, 0, 1])
-
-        # convert to tensor
-        input1_tensor = torch.tensor(input1)
-        input2_tensor = torch.tensor(input2)
+        # load image1 and image2 (decoded in parallel)
+        input1_tensor, input2_tensor = load_frames([self.datas['video1'][index], self.datas['video2'][index]], self.width, self.height)
 
         if_exchange = random.randint(0,1)
         if if_exchange == 0:
@@ -89,23 +75,8 @@ class TestDataset(Dataset):
 
     def __getitem__(self, index):
 
-        # load image1
-        input1 = cv2.imread(self.datas['video1'][index])
-        input1 = cv2.resize(input1, (self.width, self.height))
-        input1 = input1.astype(dtype=np.float32)
-        input1 = (input1 / 127.5) - 1.0
-        input1 = np.transpose(input1, [2, 0, 1])
-
-        # load image2
-        input2 = cv2.imread(self.datas['video2'][index])
-        input2 = cv2.resize(input2, (self.width, self.height))
-        input2 = input2.astype(dtype=np.float32)
-        input2 = (input2 / 127.5) - 1.0
-        input2 = np.transpose(input2, [2, 0, 1])
-
-        # convert to tensor
-        input1_tensor = torch.tensor(input1)
-        input2_tensor = torch.tensor(input2)
+        # load image1 and image2 (decoded in parallel)
+        input1_tensor, input2_tensor = load_frames([self.datas['video1'][index], self.datas['video2'][index]], self.width, self.height)
 
         data_name = self.datas['video2'][index]
 
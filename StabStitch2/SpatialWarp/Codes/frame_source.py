@@ -0,0 +1,273 @@
+# coding: utf-8
+# decoding of the input frames, shared by the datasets and the test scripts
+# the same file is used by SpatialWarp, TemporalWarp, SmoothWarp and Full_model_inference
+import os
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import torch
+
+
+# size of the network inputs
+IMG_H = 360
+IMG_W = 480
+
+
+# containers decoded with cv2.VideoCapture instead of being read as images
+# (the same list as VIDEO_EXTENSIONS in src/Utils/utils.py)
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.avi', '.mov')
+
+def is_video(path):
+    return isinstance(path, str) and os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS
+
+def open_video(path):
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise IOError("cannot open video {}".format(path))
+    return capture
+
+# next frame of an opened video, None at the end of the stream
+def read_video_frame(capture):
+    ok, img = capture.read()
+    return img if ok else None
+
+
+# decoded frame store, built once by build_frame_store (src/Utils/utils.py): a folder holding index.json and
+# the BGR uint8 [T, H, W, 3] arrays native.u8 (original resolution) and lr.u8 (network input size)
+# by default it sits next to its source, as <frame folder or video file>.frames, and is then used in its place
+STORE_SUFFIX = '.frames'
+
+def is_frame_store(path):
+    return isinstance(path, str) and os.path.isfile(os.path.join(path, 'index.json'))
+
+
+class FrameStore(object):
+    """
+    Frames of a frame store, memory-mapped.
+
+    native and lr are read-only [T, H, W, 3] np.memmap arrays: a frame is a view of the file,
+    nothing is decoded or resized, and its pages are read when the frame is used (and stay in
+    the page cache of the OS from one run to the next).
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        self.path = path
+        self.names = index['names']
+        self.native = np.memmap(os.path.join(path, 'native.u8'), dtype=np.uint8, mode='r', shape=tuple(index['native_shape']))
+        self.lr = np.memmap(os.path.join(path, 'lr.u8'), dtype=np.uint8, mode='r', shape=tuple(index['lr_shape']))
+        # frame name -> index, to find the frames of an image folder
+        self.name_index = {name: k for k, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.native)
+
+    # same as prepare_frame(self.native[k]), the stored lr frame is used if it has the requested size
+    def prepare(self, k, hr=False, width=IMG_W, height=IMG_H):
+        img_lr = self.lr[k] if self.lr.shape[1:3] == (height, width) else None
+        return prepare_frame(self.native[k], hr, width, height, img_lr)
+
+
+# stores opened by this process, and store of each image folder (None if it has none)
+_stores = {}
+_folder_stores = {}
+
+def open_store(path):
+    path = os.path.abspath(path)
+    if path not in _stores:
+        _stores[path] = FrameStore(path)
+    return _stores[path]
+
+# the store of a frame folder or video file, or the store itself, None if it has not been built
+def find_store(path):
+    if not isinstance(path, str):
+        return None
+    path = path.rstrip('/\\')
+    for store_path in (path, path + STORE_SUFFIX):
+        if is_frame_store(store_path):
+            return open_store(store_path)
+    return None
+
+# store and index of an image file, (None, None) if it is not in a store
+def _stored_frame(path):
+    folder = os.path.dirname(os.path.abspath(path))
+    if folder not in _folder_stores:
+        _folder_stores[folder] = find_store(folder)
+    store = _folder_stores[folder]
+    k = None if store is None else store.name_index.get(os.path.basename(path))
+    return (None, None) if k is None else (store, k)
+
+
+# BGR uint8 [H, W, 3] frame of an image file, a view of its store if it has one (see FrameStore)
+def read_frame(path):
+    store, k = _stored_frame(path)
+    if store is not None:
+        return store.native[k]
+    img = cv2.imread(path)
+    if img is None:
+        raise IOError("cannot read frame {}".format(path))
+    return img
+
+# read one frame: the network input [3, IMG_H, IMG_W] (-1 ~ 1) and, if hr, the full-resolution
+# frame [3, H, W] (0 ~ 255), both float32 tensors (hr is None otherwise)
+def load_frame(path, hr=False, width=IMG_W, height=IMG_H):
+    store, k = _stored_frame(path)
+    if store is not None:
+        return store.prepare(k, hr, width, height)
+    return prepare_frame(read_frame(path), hr, width, height)
+
+# same as load_frame, for a BGR uint8 [H, W, 3] image already in memory (e.g. a decoded video frame)
+# img_lr: the image already resized to width x height, if available
+def prepare_frame(img, hr=False, width=IMG_W, height=IMG_H, img_lr=None):
+    if img_lr is None:
+        img_lr = cv2.resize(img, (width, height))
+    img_lr = img_lr.astype(dtype=np.float32)
+    img_lr = (img_lr / 127.5) - 1.0
+    img_lr = torch.tensor(np.transpose(img_lr, [2, 0, 1]))
+
+    img_hr = None
+    if hr:
+        img_hr = torch.tensor(np.transpose(img.astype(dtype=np.float32), [2, 0, 1]))
+
+    return img_lr, img_hr
+
+
+# thread pool of load_frames, created on first use (so in each DataLoader worker after the fork)
+_pool = None
+_pool_size = 4
+
+def set_pool_size(num_workers):
+    global _pool, _pool_size
+    if _pool is not None:
+        _pool.shutdown(wait=False)
+        _pool = None
+    _pool_size = max(1, num_workers)
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=_pool_size)
+    return _pool
+
+# network inputs of several frames decoded in parallel: list of [3, IMG_H, IMG_W] tensors, in the order of paths
+# (cv2 releases the GIL while decoding and resizing, so the threads run concurrently)
+def load_frames(paths, width=IMG_W, height=IMG_H):
+    if len(paths) <= 1:
+        return [load_frame(path, False, width, height)[0] for path in paths]
+
+    return [img_lr for img_lr, _ in _get_pool().map(lambda path: load_frame(path, False, width, height), paths)]
+
+
+class FrameSource(object):
+    """
+    Frames of a sequence, decoded by a pool of threads ahead of their use.
+
+    Iterating yields the frames in order, as (img_lr, img_hr) pairs of load_frame. Up to
+    `lookahead` frames are decoded ahead of the consumer by `num_workers` threads, so decoding
+    overlaps with whatever is done with the previous frames, and the memory of the pending
+    frames stays bounded.
+    A video file is decoded on the fly by its own thread (the stream can only be read in
+    order) and its frames are converted by the pool. Iterating several sources together
+    (e.g. with zip) reads the views of a clip in lockstep. Frames in a frame store (see
+    FrameStore) are read from it instead of being decoded.
+  frames: the image files in frame order, a video file (see is_video) or a frame store
+  hr: also return the full-resolution frames (img_hr is None otherwise)
+  raw: yield the BGR uint8 [H, W, 3] frames as read instead of (img_lr, img_hr)
+  keep_raw: yield (img_lr, img) with the BGR uint8 frame as read in place of img_hr, so that the
+    full-resolution frame can be converted later without decoding it again (a view of the
+    frame store if there is one)
+
+    Usage:
+        for img_lr, img_hr in FrameSource(img_name_list, hr = True):
+            ...
+        for img_lr, img in FrameSource('video1.mp4', keep_raw = True):
+            ...
+        for img1, img2 in zip(FrameSource('video1.mp4', raw = True), FrameSource('video2.mp4', raw = True)):
+            ...
+    """
+
+    def __init__(self, frames, hr=False, num_workers=4, lookahead=8, raw=False, width=IMG_W, height=IMG_H, keep_raw=False):
+        self.store = find_store(frames) if isinstance(frames, str) else None
+        self.video = frames if self.store is None and is_video(frames) else None
+        # image paths, or indices of the frames of the store
+        if self.store is not None:
+            self.paths = list(range(len(self.store)))
+        else:
+            self.paths = [] if self.video is not None else list(frames)
+        self.hr = hr
+        self.num_workers = max(1, num_workers)
+        self.lookahead = max(1, lookahead)
+        self.raw = raw
+        self.keep_raw = keep_raw
+        self.width = width
+        self.height = height
+
+    # number of frames (for a video, the count of its header, which may be approximate)
+    def __len__(self):
+        if self.video is not None:
+            capture = open_video(self.video)
+            num_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+            capture.release()
+            return num_frames
+        return len(self.paths)
+
+    def _prepare(self, img):
+        if self.raw:
+            return img
+        if self.keep_raw:
+            return prepare_frame(img, False, self.width, self.height)[0], img
+        return prepare_frame(img, self.hr, self.width, self.height)
+
+    def _load(self, path):
+        if self.store is not None:
+            if self.raw:
+                return self.store.native[path]
+            if self.keep_raw:
+                return self.store.prepare(path, False, self.width, self.height)[0], self.store.native[path]
+            return self.store.prepare(path, self.hr, self.width, self.height)
+        if self.raw or self.keep_raw:
+            return self._prepare(read_frame(path))
+        return load_frame(path, self.hr, self.width, self.height)
+
+    # converts a frame being decoded, None past the end of the video
+    def _convert(self, read):
+        img = read.result()
+        return None if img is None else self._prepare(img)
+
+    def __iter__(self):
+        executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        pending = deque()
+        reads = deque()
+        next_index = 0
+        if self.video is not None:
+            capture = open_video(self.video)
+            decoder = ThreadPoolExecutor(max_workers=1)
+        try:
+            while True:
+                while len(pending) < self.lookahead and (self.video is not None or next_index < len(self.paths)):
+                    if self.video is not None:
+                        reads.append(decoder.submit(read_video_frame, capture))
+                        pending.append(executor.submit(self._convert, reads[-1]))
+                    else:
+                        pending.append(executor.submit(self._load, self.paths[next_index]))
+                    next_index += 1
+                if len(pending) == 0:
+                    break
+                frame = pending.popleft().result()
+                if self.video is not None:
+                    reads.popleft()
+                    if frame is None:
+                        break
+                yield frame
+        finally:
+            # the consumer may stop early: drop the frames decoded for nothing
+            for future in list(reads) + list(pending):
+                future.cancel()
+            executor.shutdown(wait=False)
+            if self.video is not None:
+                # the capture is released once the frame being decoded is read
+                decoder.shutdown(wait=True)
+                capture.release()
@@ -0,0 +1,99 @@
+# coding: utf-8
+# mesh geometry shared by the networks and the scripts
+# the same file is used by SpatialWarp, TemporalWarp, SmoothWarp and Full_model_inference
+import torch
+
+import grid_res
+grid_h = grid_res.GRID_H
+grid_w = grid_res.GRID_W
+
+
+
+# constant meshes, built once per (name, height, width, grid, device, dtype)
+# callers must not modify the returned tensors in place
+_mesh_cache = {}
+
+def _cached_mesh(name, height, width, device, dtype, build_fn):
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    device = torch.device(device)
+    # 'cuda' and 'cuda:0' must share the same meshes
+    if device.type == 'cuda' and device.index is None:
+        device = torch.device('cuda', torch.cuda.current_device())
+
+    key = (name, height, width, grid_h, grid_w, device, dtype)
+    if key not in _mesh_cache:
+        _mesh_cache[key] = build_fn().to(device=device, dtype=dtype)
+
+    return _mesh_cache[key]
+
+
+# get rigid mesh: bs*(grid_h+1)*(grid_w+1)*2
+def get_rigid_mesh(batch_size, height, width, device=None, dtype=torch.float32):
+
+    def _build():
+        ww = torch.matmul(torch.ones([grid_h+1, 1]), torch.unsqueeze(torch.linspace(0., float(width), grid_w+1), 0))
+        hh = torch.matmul(torch.unsqueeze(torch.linspace(0.0, float(height), grid_h+1), 1), torch.ones([1, grid_w+1]))
+        return torch.cat((ww.unsqueeze(2), hh.unsqueeze(2)),2) # (grid_h+1)*(grid_w+1)*2
+
+    ori_pt = _cached_mesh('rigid_mesh', height, width, device, dtype, _build)
+
+    return ori_pt.unsqueeze(0).expand(batch_size, -1, -1, -1)
+
+# normalized rigid mesh (-1 ~ 1): bs*-1*2
+def get_norm_rigid_mesh(batch_size, height, width, device=None, dtype=torch.float32):
+
+    def _build():
+        return get_norm_mesh(get_rigid_mesh(1, height, width, device, dtype), height, width)[0]
+
+    norm_pt = _cached_mesh('norm_rigid_mesh', height, width, device, dtype, _build)
+
+    return norm_pt.unsqueeze(0).expand(batch_size, -1, -1)
+
+# normalize mesh from -1 ~ 1
+def get_norm_mesh(mesh, height, width):
+    batch_size = mesh.size()[0]
+    mesh_w = mesh[...,0]*2./float(width) - 1.
+    mesh_h = mesh[...,1]*2./float(height) - 1.
+    norm_mesh = torch.stack([mesh_w, mesh_h], 3) # bs*(grid_h+1)*(grid_w+1)*2
+
+    return norm_mesh.reshape([batch_size, -1, 2]) # bs*-1*2
+
+def recover_mesh(norm_mesh, height, width):
+    #from [bs, pn, 2] to [bs, grid_h+1, grid_w+1, 2]
+
+    batch_size = norm_mesh.size()[0]
+    mesh_w = (norm_mesh[...,0]+1) * float(width) / 2.
+    mesh_h = (norm_mesh[...,1]+1) * float(height) / 2.
+    mesh = torch.stack([mesh_w, mesh_h], 2) # [bs,(grid_h+1)*(grid_w+1),2]
+
+    return mesh.reshape([batch_size, grid_h+1, grid_w+1, 2])
+
+# analytic inverse of a batch of 3x3 matrices (adjugate / determinant): bs*3*3
+def inverse_3x3(M):
+    a, b, c = M[...,0,0], M[...,0,1], M[...,0,2]
+    d, e, f = M[...,1,0], M[...,1,1], M[...,1,2]
+    g, h, i = M[...,2,0], M[...,2,1], M[...,2,2]
+
+    co_a, co_b, co_c = e*i - f*h, f*g - d*i, d*h - e*g
+    det = a*co_a + b*co_b + c*co_c
+    adj = torch.stack([co_a, c*h - b*i, b*f - c*e,
+                       co_b, a*i - c*g, c*d - a*f,
+                       co_c, b*g - a*h, a*e - b*d], -1).reshape(M.shape)
+
+    return adj / det[..., None, None]
+
+#Covert global homo into mesh
+def H2Mesh(H, rigid_mesh):
+
+    H_inv = inverse_3x3(H)
+    ori_pt = rigid_mesh.reshape(rigid_mesh.size()[0], -1, 2)
+
+    # H_inv x (x, y, 1): the homogeneous 1 only selects the last column, so no ones tensor is needed
+    tar_pt = torch.matmul(H_inv[:, :, 0:2], ori_pt.permute(0,2,1)) + H_inv[:, :, 2:3] # bs*3*(grid_h+1)*(grid_w+1)
+
+    mesh_x = torch.unsqueeze(tar_pt[:,0,:]/tar_pt[:,2,:], 2)
+    mesh_y = torch.unsqueeze(tar_pt[:,1,:]/tar_pt[:,2,:], 2)
+    mesh = torch.cat((mesh_x, mesh_y), 2).reshape([rigid_mesh.size()[0], grid_h+1, grid_w+1, 2])
+
+    return mesh
@@ -9,6 +9,7 @@ import cv2
 import numpy as np
 import torchvision.models as models
 import torchvision.transforms as T
+from geometry import H2Mesh, get_rigid_mesh, get_norm_mesh, get_norm_rigid_mesh
 
 import grid_res
 grid_h = grid_res.GRID_H
@@ -16,50 +17,6 @@ grid_w = grid_res.GRID_W
 
 
 
-#Covert global homo into mesh
-def H2Mesh(H, rigid_mesh):
-
-    H_inv = torch.inverse(H)
-    ori_pt = rigid_mesh.reshape(rigid_mesh.size()[0], -1, 2)
-    ones = torch.ones(rigid_mesh.size()[0], (grid_h+1)*(grid_w+1),1)
-    if torch.cuda.is_available():
-        ori_pt = ori_pt.cuda()
-        ones = ones.cuda()
-
-    ori_pt = torch.cat((ori_pt, ones), 2) # bs*(grid_h+1)*(grid_w+1)*3
-    tar_pt = torch.matmul(H_inv, ori_pt.permute(0,2,1)) # bs*3*(grid_h+1)*(grid_w+1)
-
-    mesh_x = torch.unsqueeze(tar_pt[:,0,:]/tar_pt[:,2,:], 2)
-    mesh_y = torch.unsqueeze(tar_pt[:,1,:]/tar_pt[:,2,:], 2)
-    mesh = torch.cat((mesh_x, mesh_y), 2).reshape([rigid_mesh.size()[0], grid_h+1, grid_w+1, 2])
-
-    return mesh
-
-# get rigid mesh
-def get_rigid_mesh(batch_size, height, width):
-
-    ww = torch.matmul(torch.ones([grid_h+1, 1]), torch.unsqueeze(torch.linspace(0., float(width), grid_w+1), 0))
-    hh = torch.matmul(torch.unsqueeze(torch.linspace(0.0, float(height), grid_h+1), 1), torch.ones([1, grid_w+1]))
-    if torch.cuda.is_available():
-        ww = ww.cuda()
-        hh = hh.cuda()
-
-    ori_pt = torch.cat((ww.unsqueeze(2), hh.unsqueeze(2)),2) # (grid_h+1)*(grid_w+1)*2
-    ori_pt = ori_pt.unsqueeze(0).expand(batch_size, -1, -1, -1)
-
-    return ori_pt
-
-# normalize mesh from -1 ~ 1
-def get_norm_mesh(mesh, height, width):
-    batch_size = mesh.size()[0]
-    mesh_w = mesh[...,0]*2./float(width) - 1.
-    mesh_h = mesh[...,1]*2./float(height) - 1.
-    norm_mesh = torch.stack([mesh_w, mesh_h], 3) # bs*(grid_h+1)*(grid_w+1)*2
-
-    return norm_mesh.reshape([batch_size, -1, 2]) # bs*-1*2
-
-
-
 # random augmentation
 # it seems to do nothing to the performance
 def data_aug(img1, img2):
@@ -138,7 +95,7 @@ def build_model(net, input1_tensor, input2_tensor, is_training = True):
     ini_mesh_tgt = H2Mesh(H_tgt, rigid_mesh)
     mesh_tgt = ini_mesh_tgt + mesh_motion_tgt
     # normalization
-    norm_rigid_mesh = get_norm_mesh(rigid_mesh, img_h, img_w)
+    norm_rigid_mesh = get_norm_rigid_mesh(batch_size, img_h, img_w)
     norm_mesh_ref = get_norm_mesh(mesh_ref, img_h, img_w)
     norm_mesh_tgt = get_norm_mesh(mesh_tgt, img_h, img_w)
 
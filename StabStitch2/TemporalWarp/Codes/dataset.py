@@ -5,6 +5,7 @@ import os
 import glob
 from collections import OrderedDict
 import random
+from frame_source import load_frames
 
 # Note: In the training stage, we only use the frames from video2.
 class TrainDataset(Dataset):
@@ -37,20 +38,8 @@ class TrainDataset(Dataset):
         ran = random.sample(range(0, self.train_frame_num), self.selected_frame_num)
         ran = sorted(ran)
 
-        # load images
-        input1 = cv2.imread(self.datas['video2'][ran[0]][index])
-        input1 = cv2.resize(input1, (self.width, self.height))
-        input1 = input1.astype(dtype=np.float32)
-        input1 = (input1 / 127.5) - 1.0
-        input1 = np.transpose(input1, [2, 0, 1])
-        input1_tensor = torch.tensor(input1)
-
-        input2 = cv2.imread(self.datas['video2'][ran[1]][index])
-        input2 = cv2.resize(input2, (self.width, self.height))
-        input2 = input2.astype(dtype=np.float32)
-        input2 = (input2 / 127.5) - 1.0
-        input2 = np.transpose(input2, [2, 0, 1])
-        input2_tensor = torch.tensor(input2)
+        # load images (decoded in parallel)
+        input1_tensor, input2_tensor = load_frames([self.datas['video2'][ran[0]][index], self.datas['video2'][ran[1]][index]], self.width, self.height)
 
         return (input1_tensor, input2_tensor)
 
@@ -93,30 +82,8 @@ class TestDataset(Dataset):
         # get video_name
         data_name = self.datas['video2'][1][index]
 
-        # load images
-        input1 = cv2.imread(self.datas['video1'][0][index])
-        input1 = cv2.resize(input1, (self.width, self.height)).astype(dtype=np.float32)
-        input1 = (input1 / 127.5) - 1.0
-        input1 = np.transpose(input1, [2, 0, 1])
-        input1_tensor = torch.tensor(input1)
-
-        input2 = cv2.imread(self.datas['video1'][1][index])
-        input2 = cv2.resize(input2, (self.width, self.height)).astype(dtype=np.float32)
-        input2 = (input2 / 127.5) - 1.0
-        input2 = np.transpose(input2, [2, 0, 1])
-        input2_tensor = torch.tensor(input2)
-
-        input3 = cv2.imread(self.datas['video2'][0][index])
-        input3 = cv2.resize(input3, (self.width, self.height)).astype(dtype=np.float32)
-        input3 = (input3 / 127.5) - 1.0
-        input3 = np.transpose(input3, [2, 0, 1])
-        input3_tensor = torch.tensor(input3)
-
-        input4 = cv2.imread(self.datas['video2'][1][index])
-        input4 = cv2.resize(input4, (self.width, self.height)).astype(dtype=np.float32)
-        input4 = (input4 / 127.5) - 1.0
-        input4 = np.transpose(input4, [2, 0, 1])
-        input4_tensor = torch.tensor(input4)
+        # load images (decoded in parallel)
+        input1_tensor, input2_tensor, input3_tensor, input4_tensor = load_frames([self.datas['video1'][0][index], self.datas['video1'][1][index], self.datas['video2'][0][index], self.datas['video2'][1][index]], self.width, self.height)
 
 
 
@@ -12,6 +12,7 @@ import torchvision.transforms as T
 import random
 from torch import nn, einsum
 from einops import rearrange
+from geometry import get_rigid_mesh, get_norm_mesh, get_norm_rigid_mesh
 
 import grid_res
 grid_h = grid_res.GRID_H
@@ -19,29 +20,6 @@ grid_w = grid_res.GRID_W
 
 
 
-def get_rigid_mesh(batch_size, height, width):
-
-    ww = torch.matmul(torch.ones([grid_h+1, 1]), torch.unsqueeze(torch.linspace(0., float(width), grid_w+1), 0))
-    hh = torch.matmul(torch.unsqueeze(torch.linspace(0.0, float(height), grid_h+1), 1), torch.ones([1, grid_w+1]))
-    if torch.cuda.is_available():
-        ww = ww.cuda()
-        hh = hh.cuda()
-
-    ori_pt = torch.cat((ww.unsqueeze(2), hh.unsqueeze(2)),2) # (grid_h+1)*(grid_w+1)*2
-    ori_pt = ori_pt.unsqueeze(0).expand(batch_size, -1, -1, -1)
-
-    return ori_pt
-
-
-def get_norm_mesh(mesh, height, width):
-    batch_size = mesh.size()[0]
-    mesh_w = mesh[...,0]*2./float(width) - 1.
-    mesh_h = mesh[...,1]*2./float(height) - 1.
-    norm_mesh = torch.stack([mesh_w, mesh_h], 3) # bs*(grid_h+1)*(grid_w+1)*2
-
-    return norm_mesh.reshape([batch_size, -1, 2]) # bs*-1*2
-
-
 # random augmentation
 # it seems to do nothing to the performance
 def data_aug(img1, img2):
@@ -83,7 +61,7 @@ def build_model(net, input1_tensor, input2_tensor, is_training = True):
         mask = mask.cuda()
     rigid_mesh = get_rigid_mesh(batch_size, img_h, img_w)
     mesh = rigid_mesh + Mesh_motion
-    norm_rigid_mesh = get_norm_mesh(rigid_mesh, img_h, img_w)
+    norm_rigid_mesh = get_norm_rigid_mesh(batch_size, img_h, img_w)
     norm_mesh = get_norm_mesh(mesh, img_h, img_w)
     output_tps = torch_tps_transform.transformer(torch.cat((input2_tensor, mask), 1), norm_mesh, norm_rigid_mesh, (img_h, img_w))
 
@@ -1,10 +1,15 @@
 import pandas as pd
+import numpy as np
 import logging
+import json
 import cv2
+import glob
 import os
 import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple, Optional
-from typing import List
+from typing import List, Iterator
 from moviepy.video.io.VideoFileClip import VideoFileClip
 
 logger = logging.getLogger(__name__)
@@ -27,15 +32,62 @@ def read_parquet_file(path: str) -> pd.DataFrame:
         logger.error(f"Failed to read {path}: {e}")
         return pd.DataFrame()
     
-def extract_frames_from_video(video_path: str, output_dir: str = None, output_format: str = "png") -> None:
+# Default quality per output format: JPEG quality (0-100), PNG compression level (0-9), unused for raw npy
+DEFAULT_FRAME_QUALITY = {"jpg": 95, "jpeg": 95, "png": 1, "npy": None}
+
+def _frame_write_params(output_format: str, quality: Optional[int]) -> list:
+    """
+    Returns the cv2.imwrite parameters of an output format, validating the format.
+    """
+    if output_format not in DEFAULT_FRAME_QUALITY:
+        raise ValueError(f"Unsupported output format: {output_format} (expected one of {sorted(DEFAULT_FRAME_QUALITY)})")
+    if quality is None:
+        quality = DEFAULT_FRAME_QUALITY[output_format]
+    if output_format in ("jpg", "jpeg"):
+        return [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+    if output_format == "png":
+        return [cv2.IMWRITE_PNG_COMPRESSION, int(quality)]
+    return []
+
+def _write_frame(frame_filename: str, frame, params: list) -> None:
+    """
+    Writes one extracted frame: a raw NumPy array for .npy, an encoded image otherwise.
+    """
+    if frame_filename.endswith(".npy"):
+        np.save(frame_filename, frame)
+    elif not cv2.imwrite(frame_filename, frame, params):
+        raise IOError(f"Failed to write frame {frame_filename}")
+
+def extract_frames_from_video(video_path: str, output_dir: str = None, output_format: str = "png",
+                              start: int = 0, end: Optional[int] = None, stride: int = 1,
+                              quality: Optional[int] = None, num_workers: int = 4,
+                              encoder_pool: Optional[ThreadPoolExecutor] = None) -> int:
     """
     Extracts frames from a video file and saves them as images in a folder named after the video file.
 
+    The calling thread decodes the video and hands the frames to a pool of encoder threads (cv2 releases
+    the GIL while encoding), with at most 2 * num_workers frames waiting in memory. Frames are named after
+    their index in the video (frame_00042.png), so a range or a stride keeps the original numbering.
+
     Args:
         video_path (str): Path to the video file.
         output_dir (str, optional): Directory where the folder will be created. Defaults to the video's directory.
-        output_format (str, optional): Image format for saved frames (e.g., 'png', 'jpg'). Defaults to 'png'.
+        output_format (str, optional): 'png', 'jpg' (or 'jpeg') or 'npy' for raw BGR arrays. Defaults to 'png'.
+        start (int, optional): Index of the first frame to extract. Defaults to 0.
+        end (int, optional): Index after the last frame to extract. Defaults to the end of the video.
+        stride (int, optional): Extract every stride-th frame from start. Defaults to 1.
+        quality (int, optional): JPEG quality (0-100) or PNG compression level (0-9). Defaults to DEFAULT_FRAME_QUALITY.
+        num_workers (int, optional): Number of encoder threads. Defaults to 4.
+        encoder_pool (ThreadPoolExecutor, optional): Encoder pool shared with other extractions (num_workers is then its size).
+
+    Returns:
+        int: Number of frames written.
     """
+    output_format = output_format.lower().lstrip(".")
+    params = _frame_write_params(output_format, quality)
+    if stride < 1:
+        raise ValueError(f"stride must be at least 1, got {stride}")
+
     # Get the base name of the video file (without extension)
     video_name = os.path.splitext(os.path.basename(video_path))[0]
 
@@ -51,22 +103,79 @@ def extract_frames_from_video(video_path: str, output_dir: str = None, output_fo
     cap = cv2.VideoCapture(video_path)
     if not cap.isOpened():
         print(f"Error: Cannot open video file {video_path}")
-        return
+        return 0
 
+    own_pool = encoder_pool is None
+    if own_pool:
+        encoder_pool = ThreadPoolExecutor(max_workers=num_workers)
+    pending = deque()
     frame_count = 0
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break  # End of video
+    try:
+        frame_index = 0
+        while end is None or frame_index < end:
+            # grab() only demuxes and decodes: frames outside the range or the stride are never converted
+            if not cap.grab():
+                break  # End of video
+            if frame_index >= start and (frame_index - start) % stride == 0:
+                ret, frame = cap.retrieve()
+                if not ret:
+                    break
+                frame_filename = os.path.join(frame_folder, f"frame_{frame_index:05d}.{output_format}")
+                pending.append(encoder_pool.submit(_write_frame, frame_filename, frame, params))
+                frame_count += 1
+                # Bound the frames waiting for the encoders (and surface their errors early)
+                while len(pending) > 2 * num_workers:
+                    pending.popleft().result()
+            frame_index += 1
+
+        while pending:
+            pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        cap.release()
+        if own_pool:
+            encoder_pool.shutdown(wait=True)
+
+    return frame_count
+
+def extract_frames_from_videos(video_paths: List[str], output_dir: str = None, output_format: str = "png",
+                               start: int = 0, end: Optional[int] = None, stride: int = 1,
+                               quality: Optional[int] = None, num_workers: int = 8,
+                               max_videos: Optional[int] = None) -> dict:
+    """
+    Extracts the frames of several videos (e.g. all the camera streams of a recording) concurrently.
 
-        # Save frame as image
-        frame_filename = os.path.join(frame_folder, f"frame_{frame_count:05d}.png")
-        # Save frame as image with specified format
-        frame_filename = os.path.join(frame_folder, f"frame_{frame_count:05d}.{output_format}")
-        cv2.imwrite(frame_filename, frame)
-        frame_count += 1
+    Each video is decoded by its own thread, up to max_videos at a time, and all of them feed one shared pool of
+    num_workers encoder threads. The options are those of extract_frames_from_video and apply to every video.
 
-    cap.release()
+    Args:
+        video_paths (List[str]): Paths to the video files.
+        output_dir (str, optional): Directory where the frame folders will be created. Defaults to each video's directory.
+        output_format, start, end, stride, quality: See extract_frames_from_video.
+        num_workers (int, optional): Number of encoder threads shared by all the videos. Defaults to 8.
+        max_videos (int, optional): Number of videos decoded at the same time. Defaults to all of them.
+
+    Returns:
+        dict: Number of frames written per video path.
+    """
+    if not video_paths:
+        return {}
+    if max_videos is None:
+        max_videos = len(video_paths)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as encoder_pool, \
+         ThreadPoolExecutor(max_workers=max_videos) as decoder_pool:
+        futures = {
+            video_path: decoder_pool.submit(extract_frames_from_video, video_path, output_dir, output_format,
+                                            start, end, stride, quality, num_workers, encoder_pool)
+            for video_path in video_paths
+        }
+        counts = {}
+        for video_path, future in futures.items():
+            counts[video_path] = future.result()
+            logger.info(f"Extracted {counts[video_path]} frames from {video_path}")
+    return counts
 
 def read_image(image_path: str) -> any:
     """
@@ -87,6 +196,132 @@ def read_video(video_path: str) -> cv2.VideoCapture:
         return None
     return cap
 
+# Containers decoded with cv2.VideoCapture instead of being read as images
+# (the same list as VIDEO_EXTENSIONS in the StabStitch2 frame_source modules)
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.avi', '.mov')
+
+def is_video_file(path: str) -> bool:
+    """
+    Checks whether a path points to a video file (by its extension, see VIDEO_EXTENSIONS) rather than an image or a folder.
+    """
+    return isinstance(path, str) and os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS
+
+def read_synchronized_frames(video_paths: List[str]) -> Iterator[Tuple]:
+    """
+    Decodes several camera streams in lockstep, without writing their frames to disk.
+    Each stream is decoded by its own thread, and the iteration stops at the end of the shortest one.
+
+    Args:
+        video_paths (List[str]): Paths to the video files, one per camera.
+
+    Yields:
+        Tuple: The BGR frames (NumPy arrays) of one time step, in the order of video_paths.
+
+    Raises:
+        IOError: If one of the videos cannot be opened.
+    """
+    captures = [read_video(video_path) for video_path in video_paths]
+    try:
+        failed = [video_path for video_path, cap in zip(video_paths, captures) if cap is None]
+        if failed:
+            raise IOError(f"Cannot open video file(s) {', '.join(failed)}")
+        with ThreadPoolExecutor(max_workers=len(captures)) as pool:
+            while True:
+                results = list(pool.map(lambda cap: cap.read(), captures))
+                if not all(ret for ret, _ in results):
+                    break  # End of the shortest video
+                yield tuple(frame for _, frame in results)
+    finally:
+        for cap in captures:
+            if cap is not None:
+                cap.release()
+
+# Frames of a folder held by a frame store: the StabStitch2 loaders (video_io.list_view and the training
+# datasets) only read the .jpg files of a frame folder, so the store must list exactly the same ones
+FRAME_STORE_PATTERN = "*.jpg"
+
+def build_frame_store(source: str, output_dir: Optional[str] = None, lr_size: Tuple[int, int] = (480, 360)) -> str:
+    """
+    Decodes a video file or a folder of images once into a frame store, so later runs read the frames
+    from memory-mapped arrays instead of decoding them again.
+
+    The store is a folder with two raw uint8 arrays of shape [T, H, W, 3] (BGR), native.u8 at the
+    original resolution and lr.u8 resized to lr_size, plus an index.json describing them (shapes and
+    frame names). The index is written last, so an interrupted build never looks like a valid store.
+    The StabStitch2 loaders (frame_source.FrameStore) pick the store up automatically when it sits
+    next to its source, which is the default location.
+
+    Args:
+        source (str): Path to the video file or to the folder of .jpg frames (sorted by name, see FRAME_STORE_PATTERN).
+        output_dir (str, optional): Folder of the store. Defaults to the source path with a '.frames' suffix.
+        lr_size (Tuple[int, int]): Resolution (width, height) of the resized copy. Defaults to the network input size.
+
+    Returns:
+        str: Path to the frame store.
+    """
+    if output_dir is None:
+        output_dir = source.rstrip('/\\') + ".frames"
+    os.makedirs(output_dir, exist_ok=True)
+    index_path = os.path.join(output_dir, "index.json")
+    if os.path.exists(index_path):
+        os.remove(index_path)  # Rebuild: invalidate the old store first
+
+    if is_video_file(source):
+        cap = read_video(source)
+        if cap is None:
+            raise IOError(f"Cannot open video file {source}")
+
+        def frames():
+            try:
+                while True:
+                    ret, frame = cap.read()
+                    if not ret:
+                        break
+                    yield frame
+            finally:
+                cap.release()
+        names = None
+    else:
+        image_paths = sorted(glob.glob(os.path.join(source, FRAME_STORE_PATTERN)))
+        names = [os.path.basename(path) for path in image_paths]
+
+        def frames():
+            # Images are decoded ahead by a thread pool (cv2 releases the GIL while decoding)
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                for path, frame in zip(image_paths, pool.map(cv2.imread, image_paths)):
+                    if frame is None:
+                        raise IOError(f"Failed to read image: {path}")
+                    yield frame
+
+    frame_count = 0
+    native_shape = None
+    with open(os.path.join(output_dir, "native.u8"), "wb") as native_file, \
+         open(os.path.join(output_dir, "lr.u8"), "wb") as lr_file:
+        for frame in frames():
+            if native_shape is None:
+                native_shape = frame.shape
+            elif frame.shape != native_shape:
+                raise ValueError(f"Frame {frame_count} of {source} is {frame.shape}, expected {native_shape}")
+            native_file.write(np.ascontiguousarray(frame).tobytes())
+            lr_file.write(cv2.resize(frame, lr_size).tobytes())
+            frame_count += 1
+
+    if frame_count == 0:
+        raise ValueError(f"No frames found in {source}")
+
+    index = {
+        "source": os.path.abspath(source),
+        "count": frame_count,
+        "native_shape": [frame_count, native_shape[0], native_shape[1], 3],
+        "lr_shape": [frame_count, lr_size[1], lr_size[0], 3],
+        "dtype": "uint8",
+        "names": names if names is not None else [f"frame_{k:05d}" for k in range(frame_count)],
+    }
+    with open(index_path, "w") as f:
+        json.dump(index, f)
+    logger.info(f"Built frame store {output_dir} ({frame_count} frames)")
+    return output_dir
+
 def natural_sort_key(s: str) -> list:
     """
     Generates a key for natural sorting of strings with embedded numbers.
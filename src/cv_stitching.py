@@ -6,15 +6,28 @@ from Utils import utils
 
 
 def stitch_image_pairs(list1, list2, output_dir="stitched"):
+    """
+    Stitches two synchronized views frame by frame.
+
+    Each view is a list of image paths or a video file (mp4, mkv, ...). Video files are decoded
+    on the fly, in lockstep, instead of being extracted to images first.
+    """
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
     stitcher = Stitcher(detector="sift", confidence_threshold=0.2)
 
-    for i, (img1_path, img2_path) in enumerate(zip(list1, list2)):
+    if utils.is_video_file(list1) and utils.is_video_file(list2):
+        pairs = utils.read_synchronized_frames([list1, list2])
+        names = lambda i: f"frame {i} of {list1} + {list2}"
+    else:
+        pairs = zip(list1, list2)
+        names = lambda i: f"{list1[i]} + {list2[i]}"
+
+    for i, (img1, img2) in enumerate(pairs):
         try:
-            print(f"Stitching pair {i+1}: {img1_path} + {img2_path}")
-            result = stitcher.stitch([img1_path, img2_path])
+            print(f"Stitching pair {i+1}: {names(i)}")
+            result = stitcher.stitch([img1, img2])
             output_path = os.path.join(output_dir, f"stitched_{i+1}.jpg")
             cv2.imwrite(output_path, result)
         except Exception as e: